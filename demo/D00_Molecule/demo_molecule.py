@@ -14,6 +14,7 @@ The rotation angle is given in degrees and can be used to set
     5. to add an increment to the current angle.
 
 6. A Molecule can also be initilized with an AtomGroup (from Prody)
+7. A Molecule can be cloned. The clone shares the topology but has its own coordinates
 
 """
 
@@ -57,3 +58,12 @@ myGlycan =  gl.Molecule('glycan')
 HIV_env = pd.parsePDB(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/examples/env_4tvp.pdb'))
 myGlycan.set_AtomGroup(HIV_env.select('resid 1088 to 1094'), update_bonds = True)
 myGlycan.writePDB('myglycan.pdb')
+
+############################################################################
+# 7. Cloning a molecule
+myClone = myMan9.clone('mannose9_clone')
+coords = myMan9.atom_group.getCoords()
+myClone.rotate_bond(idx, 90., absolute = True)
+myClone.atom_group.setCoords(myClone.atom_group.getCoords() + 1.)
+assert (myMan9.atom_group.getCoords() == coords).all(), 'changing the coordinates of a clone changed the original molecule'
+print 'Dihedral angle of original: {}, of clone: {}'.format(myMan9.measure_dihedral_angle(idx), myClone.measure_dihedral_angle(idx))
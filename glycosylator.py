@@ -25,29 +25,61 @@ import sys
 import re
 import copy
 import math
+import importlib
 import numpy as np
 import networkx as nx
 from prody import *
 from itertools import izip
-from collections import defaultdict
-from scipy.spatial import distance
-#from scipy.interpolate import interp1d
-from scipy.interpolate import InterpolatedUnivariateSpline
-#from scipy import optimize 
+from collections import defaultdict, OrderedDict
 import random
 from operator import itemgetter
-import sqlite3
 
-from matplotlib.patches import Circle, Rectangle, Polygon
-from matplotlib.collections import PatchCollection
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
+class LazyModule:
+    """Module that is only imported when one of its attributes is first used.
+    Keeps matplotlib (which can initialize a GUI backend), sqlite3 and scipy out of the import of glycosylator, e.g. for batch workers that never draw
+        Attributes:
+            name: full name of module
+            module: imported module (None until first use)
+    """
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if attribute in ['name', 'module']:
+            raise AttributeError(attribute)
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+distance = LazyModule('scipy.spatial.distance')
+interpolate = LazyModule('scipy.interpolate')
+sqlite3 = LazyModule('sqlite3')
+mpatches = LazyModule('matplotlib.patches')
+mcollections = LazyModule('matplotlib.collections')
+plt = LazyModule('matplotlib.pyplot')
+mlines = LazyModule('matplotlib.lines')
 
 import time
+import hashlib
+import inspect
+import cPickle as pickle
+import json
+import multiprocessing
+import heapq
 
 
 
 GLYCOSYLATOR_PATH = os.path.dirname(os.path.realpath(__file__))
+#Directory for the binary cache of parsed topology and parameter files
+CACHE_PATH = os.environ.get('GLYCOSYLATOR_CACHE', os.path.join(os.path.expanduser('~'), '.glycosylator', 'cache'))
+#Increase when the structure of parsed files changes, to invalidate old cache files. 
+#Cache files are also keyed by the source code of the parser (see get_cache_file)
+CACHE_VERSION = 2
+#Digest of the source code of each parser class
+CACHE_CODE_DIGESTS = {}
+#Glycosylator shared with the worker processes of Glycosylator.glycosylate_all
+GLYCOSYLATOR_WORKER = None
 #SELF_BIN = os.path.dirname(os.path.realpath(sys.argv[0]))
 #sys.path.insert(0, SELF_BIN + '/support')
 
@@ -69,6 +101,207 @@ def readLinesFromFile(fileName):
     file.close()                                  # close the file
     return lines
 
+def get_cache_file(fileName, tag, parser = None):
+    """Returns the path of the cache file of a parsed file. The name is based on the hash of the content of the file, 
+    CACHE_VERSION and the hash of the source code of the parser, so that cache files are invalidated when the parser changes
+    Parameters:
+        fileName: path to parsed file
+        tag: type of parsed data (e.g. topology)
+        parser: class that parses the file (e.g. CHARMMTopology)
+    Returns:
+        cache_file: path to cache file
+    """
+    sha = hashlib.sha1()
+    with open(fileName, 'rb') as f:
+        sha.update(f.read())
+    if parser is not None:
+        if parser not in CACHE_CODE_DIGESTS:
+            try:
+                CACHE_CODE_DIGESTS[parser] = hashlib.sha1(inspect.getsource(parser)).hexdigest()
+            except (IOError, TypeError):
+                CACHE_CODE_DIGESTS[parser] = ''
+        sha.update(CACHE_CODE_DIGESTS[parser])
+    return os.path.join(CACHE_PATH, '%s_v%d_%s.pkl' % (tag, CACHE_VERSION, sha.hexdigest()))
+
+def read_cache(cache_file):
+    """Loads data from the binary cache
+    Parameters:
+        cache_file: path to cache file
+    Returns:
+        data: cached data. None if the file does not exist or cannot be read
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+def write_cache(cache_file, data):
+    """Saves data to the binary cache. The file is first written to a temporary file and then moved, 
+    so that concurrent processes never read a partial file
+    Parameters:
+        cache_file: path to cache file
+        data: data to be saved
+    """
+    tmp_file = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        if not os.path.isdir(CACHE_PATH):
+            os.makedirs(CACHE_PATH)
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        print "WARNING! Could not write cache file " + cache_file
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+def read_mmcif(fileName, title = None, chunk_size = 10000):
+    """Reads the atom_site loop of a mmCIF file. The file is streamed and converted to arrays chunk by chunk.
+    Only the first model and the first alternate location are kept. Segnames are read from label_asym_id (see StructureWriter)
+    Parameters:
+        fileName: path to mmCIF file
+        title: title of AtomGroup. Default name of file
+        chunk_size: number of atoms converted at once
+    Returns:
+        atom_group: AtomGroup
+    """
+    if not title:
+        title = os.path.splitext(os.path.basename(fileName))[0]
+    token = re.compile(r"'[^']*'|\"[^\"]*\"|\S+")
+    fields = []
+    rows = []
+    chunks = []
+    columns = None
+    model = None
+    in_loop = False
+    with open(fileName, 'r') as f:
+        for line in f:
+            if line.startswith('_atom_site.'):
+                fields.append(line.strip().split('.', 1)[1])
+                in_loop = True
+                continue
+            if not in_loop:
+                continue
+            if not (line.startswith('ATOM') or line.startswith('HETATM')):
+                if rows or chunks:
+                    break
+                continue
+            if columns is None:
+                columns = dict([(n, i) for i,n in enumerate(fields)])
+            #only enclosing quotes are removed: quotes are legal in unquoted values (e.g. C1')
+            values = [v[1:-1] if len(v) > 1 and v[0] == v[-1] and v[0] in '\'"' else v for v in token.findall(line)]
+            if 'pdbx_PDB_model_num' in columns:
+                if model is None:
+                    model = values[columns['pdbx_PDB_model_num']]
+                elif values[columns['pdbx_PDB_model_num']] != model:
+                    break
+            rows.append(values)
+            if len(rows) == chunk_size:
+                chunks.append(np.array(rows))
+                rows = []
+    if rows:
+        chunks.append(np.array(rows))
+    if not chunks:
+        print 'WARNING: no atoms found in ' + fileName
+        return None
+    data = np.concatenate(chunks)
+    
+    def get_column(*names):
+        #missing values ('.' or '?') are read from the next column
+        values = None
+        for n in names:
+            if n in columns:
+                column = data[:, columns[n]].copy()
+                column[(column == '.') | (column == '?')] = ''
+                if values is None:
+                    values = column
+                else:
+                    missing = values == ''
+                    values[missing] = column[missing]
+                if not (values == '').any():
+                    break
+        if values is None:
+            return np.array(['']*len(data))
+        return values
+
+    altlocs = get_column('label_alt_id')
+    keep = (altlocs == '') | (altlocs == 'A')
+    data = data[keep]
+    
+    atom_group = AtomGroup(title)
+    atom_group.setCoords(np.column_stack([get_column(n).astype(float) for n in ['Cartn_x', 'Cartn_y', 'Cartn_z']]))
+    atom_group.setNames(get_column('auth_atom_id', 'label_atom_id'))
+    atom_group.setResnames(get_column('auth_comp_id', 'label_comp_id'))
+    resnums = get_column('auth_seq_id', 'label_seq_id')
+    resnums[resnums == ''] = '0'
+    atom_group.setResnums(resnums.astype(int))
+    atom_group.setChids(get_column('auth_asym_id', 'label_asym_id'))
+    atom_group.setSegnames(get_column('label_asym_id'))
+    atom_group.setIcodes(get_column('pdbx_PDB_ins_code'))
+    atom_group.setAltlocs(get_column('label_alt_id'))
+    atom_group.setElements(get_column('type_symbol'))
+    atom_group.setSerials(get_column('id').astype(int))
+    for label,name in [('Occupancies', 'occupancy'), ('Betas', 'B_iso_or_equiv')]:
+        values = get_column(name)
+        values[values == ''] = '0'
+        getattr(atom_group, 'set' + label)(values.astype(float))
+    atom_group.setFlags('hetatm', get_column('group_PDB') == 'HETATM')
+    return atom_group
+
+def get_unit_keys(connect_topology):
+    """Returns the unit keys ('resname patch1 patch2 ...') of a glycan
+    Parameters:
+        connect_topology: connectivity topology of one glycan ({'UNIT': [[resname, atom, [patches]], ...], '#UNIT': n})
+    Returns:
+        list of unit keys
+    """
+    return [r[0]+' '+' '.join(r[2]) for r in connect_topology['UNIT']]
+
+def glycan_hash(keys):
+    """Returns a canonical hash of a glycan. Each unit is identified by its resname and patch path from the root, so the sorted unit keys do not depend on the order of the units
+    Parameters:
+        keys: list of unit keys
+    Returns:
+        hash (str)
+    """
+    return hashlib.sha1('|'.join(sorted(set(keys)))).hexdigest()
+
+def concatenate_atom_groups(atom_groups, title = 'AtomGroup'):
+    """Concatenates a list of AtomGroups. The memory for all atoms is allocated once,
+    instead of copying the growing AtomGroup at each addition (ag1 += ag2)
+    Parameters:
+        atom_groups: list of AtomGroups
+        title: title of the new AtomGroup
+    Returns:
+        atom_group: AtomGroup containing all atoms
+    """
+    natoms = sum([ag.numAtoms() for ag in atom_groups])
+    coords = np.zeros((natoms, 3))
+    i = 0
+    for ag in atom_groups:
+        j = i + ag.numAtoms()
+        coords[i:j, :] = ag.getCoords()
+        i = j
+    atom_group = AtomGroup(title)
+    atom_group.setCoords(coords)
+    for label in ['Names', 'Resnums', 'Resnames', 'Chids', 'Segnames', 'Occupancies', 'Betas', 'Serials', 'Icodes', 'Elements', 'Altlocs']:
+        data = [getattr(ag, 'get' + label)() for ag in atom_groups]
+        if any([d is None for d in data]):
+            continue
+        getattr(atom_group, 'set' + label)(np.concatenate(data))
+    return atom_group
+
+def glycosylate_sequon_worker(args):
+    """Builds one glycan in a worker process of Glycosylator.glycosylate_all. The Glycosylator is inherited from the parent process (GLYCOSYLATOR_WORKER)
+    Parameters:
+        args: arguments of Glycosylator.glycosylate_sequon
+    Returns:
+        sequon id, Molecule (None if the glycan could not be built) and timing
+    """
+    return GLYCOSYLATOR_WORKER.glycosylate_sequon(*args)
+
 def topological_sort(unsorted_graph):
     """Topological sorting of a graph 
     Parameters:
@@ -124,6 +357,48 @@ def rotation_matrix(axis, theta):
                      [2*(bc-ad), aa+cc-bb-dd, 2*(cd+ab)],
                      [2*(bd+ac), 2*(cd-ab), aa+dd-bb-cc]])
 
+def measure_dihedrals(coords, quadruplets):
+    """Calculates dihedral angles for a list of quadruplets of atoms in one or several frames (same convention as Molecule.measure_dihedral_angle)
+    Parameters:
+        coords: array (n_atoms, 3) or (n_frames, n_atoms, 3)
+        quadruplets: array (n_dihedrals, 4) of atom indices
+    Returns:
+        angles: array (n_dihedrals) or (n_frames, n_dihedrals) of angles in degrees
+    """
+    quadruplets = np.asarray(quadruplets, dtype = int).reshape(-1, 4)
+    c0,c1,c2,c3 = [coords[..., quadruplets[:, i], :] for i in range(4)]
+    q1 = c1 - c0
+    q2 = c2 - c1
+    q3 = c3 - c2
+    q1xq2 = np.cross(q1, q2)
+    q2xq3 = np.cross(q2, q3)
+    n1 = q1xq2 / np.sqrt(np.sum(q1xq2*q1xq2, axis = -1))[..., np.newaxis]
+    n2 = q2xq3 / np.sqrt(np.sum(q2xq3*q2xq3, axis = -1))[..., np.newaxis]
+    u3 = q2 / np.sqrt(np.sum(q2*q2, axis = -1))[..., np.newaxis]
+    u2 = np.cross(u3, n2)
+    cos_theta = np.sum(n1*n2, axis = -1)
+    sin_theta = np.sum(n1*u2, axis = -1)
+    return np.degrees(-np.arctan2(sin_theta, cos_theta))
+
+def read_patch_dihedrals(fname):
+    """Reads the preferred intervals of the interresidue dihedrals of each patch (e.g. support/topology/pres.top)
+    Parameters:
+        fname: path to file
+    Returns:
+        patches: dictionary with patch as key and list of [atom names, list of (angle1, angle2) intervals] as values. The i-th intervals of the dihedrals of a patch form one preferred conformation
+    """
+    lines  = readLinesFromFile(fname)
+    patches = defaultdict(list) 
+    for line in lines:
+        line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
+        if line:
+            if line[0]=='PRES':
+                patch = line[1]
+            if line[0]=='DIHE':
+                dihe = [line[1:5], list(pairwise(map(float, line[5:])))] 
+                patches[patch].append(dihe) 
+    return patches
+
 def rotation_matrix2(angle, direction, point=None):
     """Return matrix to rotate about axis defined by point and direction.
 
@@ -175,20 +450,20 @@ class CHARMMTopology:
     Attributes:
         topology: dictionary storing topology (RES)
                         key: resname
-                        value: dictionary with ATOM, BOND, CHARGE and IC
+                        value: dictionary with ATOM, BOND, CHARGE, IC and IC indexes (see index_ICs)
                         key: MASS contains all masses of atoms in topology
          patches: dictionary storing patches (PRES)
                         key: patchname
-                        value: dictionary with dele, ATOM, BOND, CHARGE and IC
+                        value: dictionary with dele, ATOM, BOND, CHARGE, IC and IC indexes (see index_ICs)
          atomnames_to_patch: dictionary storing patch name to connect two atoms
                         key: atom1-atom2
                         value: patchname
     """
-    def __init__(self, fileIn):
+    def __init__(self, fileIn, cache = True):
          self.topology = {}
          self.patches = {}
          self.atomnames_to_patch = {}
-         self.read_topology(fileIn)
+         self.read_topology(fileIn, cache = cache)
     
     def reset(self):
         """Resets previsously read topology
@@ -197,10 +472,11 @@ class CHARMMTopology:
         self.patches = {}
         self.atomnames_to_patch = {}
         
-    def read_topology(self, fileIn):
+    def read_topology(self, fileIn, cache = True):
         """Reads CHARMM topology file. 
         Parameters:
             fileIn: path to topology file
+            cache: use the binary cache (CACHE_PATH) of parsed files. The cache is invalidated when the content of the file or the parser changes
         Initialize:
             topology: dictionary storing topology (RES)
                         key: resname
@@ -213,12 +489,45 @@ class CHARMMTopology:
                         key: atom1-atom2
                         value: patchname
         """
+        parsed = None
+        if cache:
+            cache_file = get_cache_file(fileIn, 'topology', CHARMMTopology)
+            parsed = read_cache(cache_file)
+        if parsed is None:
+            parsed = self.parse_topology(fileIn)
+            if cache:
+                write_cache(cache_file, parsed)
+        topology,patches,atomnames_to_patch = parsed
+
+        if 'MASS' not in self.topology:
+            self.topology['MASS'] = {}
+        self.topology['MASS'].update(topology.pop('MASS'))
+        self.topology.update(topology)
+        self.patches.update(patches)
+        # Allows multiple patches
+        for key,names in atomnames_to_patch.items():
+            if key in self.atomnames_to_patch:
+                self.atomnames_to_patch[key].extend(names)
+            else:
+                self.atomnames_to_patch[key] = names
+
+    def parse_topology(self, fileIn):
+        """Parses a CHARMM topology file. 
+        Parameters:
+            fileIn: path to topology file
+        Returns:
+            topology: dictionary storing topology (RES) and masses (MASS) defined in file
+            patches: dictionary storing patches (PRES) defined in file
+            atomnames_to_patch: dictionary storing patch name to connect two atoms
+        """
         lines = readLinesFromFile(fileIn)
         topo_type=''
         residue={}
-        if 'MASS' not in self.topology:
-            self.topology['MASS'] = {}
-        masses = self.topology['MASS']
+        topology = {}
+        patches = {}
+        atomnames_to_patch = {}
+        topology['MASS'] = {}
+        masses = topology['MASS']
         
         for line in lines:                                                             # Loop through each line 
             line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
@@ -226,17 +535,17 @@ class CHARMMTopology:
                 if line[0]=='RESI' or line[0]=='PRES':
                     if residue:
                         if topo_type == 'RESI':
-                            self.topology[resname] = copy.copy(residue)
+                            topology[resname] = copy.copy(residue)
+                            self.index_ICs(topology[resname])
                         elif topo_type == 'PRES':
-                            self.patches[resname] = copy.copy(residue)
+                            patches[resname] = copy.copy(residue)
+                            self.index_ICs(patches[resname])
                             key = '-'.join(sorted([residue['BOND'][0][1:], residue['BOND'][1][1:]]))
                             # Allows multiple patches
-                            if key in self.atomnames_to_patch:
-                                res = self.atomnames_to_patch[key]
-                                res.append(resname)
-                                self.atomnames_to_patch[key] = res
+                            if key in atomnames_to_patch:
+                                atomnames_to_patch[key].append(resname)
                             else:
-                                self.atomnames_to_patch[key] = [resname]
+                                atomnames_to_patch[key] = [resname]
                     residue['dele'] = []
                     residue['ATOM'] = []
                     residue['BOND'] = []
@@ -256,18 +565,18 @@ class CHARMMTopology:
                     self.read_mass(line, masses)
                     
         if topo_type == 'RESI': 
-            self.topology[resname] = copy.copy(residue)
+            topology[resname] = copy.copy(residue)
+            self.index_ICs(topology[resname])
         elif topo_type == 'PRES':
-            self.patches[resname] = copy.copy(residue)
+            patches[resname] = copy.copy(residue)
+            self.index_ICs(patches[resname])
             key = '-'.join(sorted([residue['BOND'][0][1:], residue['BOND'][1][1:]]))
             # Allows multiple patches
-            if key in self.atomnames_to_patch:
-                res = self.atomnames_to_patch[key]
-                res.append(resname) 
-                self.atomnames_to_patch[key] = res
+            if key in atomnames_to_patch:
+                atomnames_to_patch[key].append(resname)
             else:
-                self.atomnames_to_patch[key] = [resname]
-            #self.atomnames_to_patch[key] = resname
+                atomnames_to_patch[key] = [resname]
+        return topology,patches,atomnames_to_patch
 
     def read_mass(self, mass, masses):
         mass[3]=float(mass[3])
@@ -291,6 +600,62 @@ class CHARMMTopology:
         atom_ic = ([ic for ic in ics if ic[3]==atom])
         return atom_ic
 
+    def index_ICs(self, residue):
+        """Indexes the internal coordinates of a residue or patch. Called by read_topology
+        Build orders are only computed when they are first needed (see get_IC_order)
+        Parameters:
+            residue: dictionary of a residue (RESI) or patch (PRES)
+        Initializes (in residue):
+            IC_index: dictionary with atom name as key and list of ICs defining this atom as value
+            IC_atoms: set of all atom names used in ICs
+            IC_deps: dictionary with atom name as key and list of atoms required to build it as value
+            IC_orders: dictionary with a frozenset of missing atoms as key and their build order as value
+        """
+        IC_index = {}
+        IC_atoms = set()
+        IC_deps = {}
+        for ic in residue['IC']:
+            a = ic[3]
+            if a in IC_index:
+                IC_index[a].append(ic)
+            else:
+                IC_index[a] = [ic]
+                IC_deps[a] = []
+            IC_deps[a].extend([aic.replace('*', '') for aic in ic[0:3]])
+            IC_atoms.update([aic.replace('*', '') for aic in ic[0:4]])
+        residue['IC_index'] = IC_index
+        residue['IC_atoms'] = IC_atoms
+        residue['IC_deps'] = IC_deps
+        residue['IC_orders'] = {}
+
+    def get_IC_order(self, residue, atoms):
+        """Returns the order in which missing atoms are built from the ICs of a residue or patch.
+        The order is computed from the dependency graph built by index_ICs and stored for each set of missing atoms
+        Parameters:
+            residue: dictionary of a residue (RESI) or patch (PRES)
+            atoms: list of missing atoms
+        Returns:
+            sorted list of missing atoms that can be built from ICs
+        """
+        key = frozenset(atoms)
+        orders = residue['IC_orders']
+        if key not in orders:
+            unsorted_graph = {}
+            required_atoms = set()
+            for a in key:
+                if a in residue['IC_atoms']:
+                    required_atoms.add(a)
+                    if not a in unsorted_graph:
+                        unsorted_graph[a] = []
+                    for aic in residue['IC_deps'].get(a, []):
+                        if aic in unsorted_graph:
+                            unsorted_graph[aic].append(a)
+                        else:
+                            unsorted_graph[aic] = [a]
+            sorted_graph = topological_sort(unsorted_graph)
+            orders[key] = [g[0] for g in sorted_graph if g[0] in required_atoms]
+        return orders[key]
+
     def get_atom_name(self, ATOM):
         names=[]
         for a in ATOM:
@@ -320,15 +685,24 @@ class CHARMMParameters:
                         NBFIX: atom1-atom2                  ->
                         CMAP:
                         ATOM: atom1                         -> mass
+            lazy: if True, sections are only parsed when first accessed (see LazyParameters)
     """
-    def __init__(self, fileIn):
-        self.parameters = {}
-        self.read_parameters(fileIn)
+    tags = ['BONDS', 'ANGLES', 'DIHEDRALS', 'NONBONDED', 'IMPROPER', 'NBFIX', 'CMAP', 'ATOMS']
+
+    def __init__(self, fileIn, cache = True, lazy = False):
+        self.lazy = lazy
+        if lazy:
+            self.parameters = LazyParameters(self)
+        else:
+            self.parameters = {}
+        self.read_parameters(fileIn, cache = cache)
 
-    def read_parameters(self, fileIn):
+    def read_parameters(self, fileIn, cache = True):
         """Reads CHARMM parameter file. 
+        In lazy mode, the file is only indexed by section and the cache is not used
         Parameters:
             fileIn: path to parameter file
+            cache: use the binary cache (CACHE_PATH) of parsed files. The cache is invalidated when the content of the file or the parser changes
         Initializes:
             parameters: dictionary storing parameters
                 keys: 'BONDS', 'ANGLES', 'DIHEDRALS', 'NONBONDED', 'IMPROPER', 'NBFIX', 'CMAP' and 'ATOMS'
@@ -342,30 +716,107 @@ class CHARMMParameters:
                         CMAP:
                         ATOM: atom1                         -> mass
         """
+        if self.lazy:
+            for prm_type,start,end in self.index_sections(fileIn):
+                self.parameters.add_section(prm_type, fileIn, start, end)
+            for t in self.tags:
+                if t not in self.parameters:
+                    self.parameters[t] = {}
+            return
+
+        parsed = None
+        if cache:
+            cache_file = get_cache_file(fileIn, 'parameters', CHARMMParameters)
+            parsed = read_cache(cache_file)
+        if parsed is None:
+            parsed = self.parse_parameters(fileIn)
+            if cache:
+                write_cache(cache_file, parsed)
+
+        for prm_type in parsed:
+            if prm_type in self.parameters:
+                self.parameters[prm_type].update(parsed[prm_type])
+            else:
+                self.parameters[prm_type] = parsed[prm_type]
+
+    def parse_parameters(self, fileIn):
+        """Parses a CHARMM parameter file. 
+        Parameters:
+            fileIn: path to parameter file
+        Returns:
+            parameters: dictionary storing parameters defined in file (see read_parameters)
+        """
         lines = readLinesFromFile(fileIn)
+        parameters = {}
         prm = {}
         prm_type = ''
-        tags = ['BONDS', 'ANGLES', 'DIHEDRALS', 'NONBONDED', 'IMPROPER', 'NBFIX', 'CMAP', 'ATOMS']
+        tags = self.tags
         #initialize parameter dictionary
         for t in tags:
-            if not t in self.parameters:
-                self.parameters[t] = {}
+            parameters[t] = {}
         for line in lines:                                                             # Loop through each line 
             line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
             if line:
                 if line[0] in tags:
                     if prm:
-                        if prm_type in self.parameters:
-                            self.parameters[prm_type] = dict(self.parameters[prm_type].items() + prm.items()) 
-                        else:
-                         self.parameters[prm_type] = copy.copy(prm)
+                        parameters[prm_type].update(prm)
                     prm_type = line[0]
                     prm = {}
+                    read_prm = getattr(self, 'read_'+prm_type)
                     continue
                 if prm_type:
-                    eval('self.read_'+prm_type+'(line, prm)')
-        self.parameters[prm_type] = copy.copy(prm)
+                    read_prm(line, prm)
+        if prm_type:
+            parameters[prm_type].update(prm)
+        return parameters
 
+    def index_sections(self, fileIn):
+        """Indexes the sections of a CHARMM parameter file in a single scan, without parsing parameters
+        Parameters:
+            fileIn: path to parameter file
+        Returns:
+            sections: list of sections (section name, start offset, end offset), in order of appearance. Offsets are in bytes
+        """
+        sections = []
+        tags = tuple(self.tags)
+        prm_type = ''
+        offset = 0
+        start = 0
+        with open(fileIn, 'rb') as f:
+            for line in f:
+                stripped = line.lstrip()
+                if stripped.startswith(tags):
+                    header = stripped.split('!')[0].split()
+                    if header and header[0] in tags:
+                        if prm_type:
+                            sections.append((prm_type, start, offset))
+                        prm_type = header[0]
+                        start = offset + len(line)
+                offset += len(line)
+        if prm_type:
+            sections.append((prm_type, start, offset))
+        return sections
+
+    def parse_section(self, prm_type, fileIn, start, end):
+        """Parses one section of a CHARMM parameter file
+        Parameters:
+            prm_type: name of section (e.g. DIHEDRALS)
+            fileIn: path to parameter file
+            start: offset of the first line of the section (bytes)
+            end: offset of the end of the section (bytes)
+        Returns:
+            prm: dictionary of parameters of the section
+        """
+        with open(fileIn, 'rb') as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines()
+        prm = {}
+        read_prm = getattr(self, 'read_'+prm_type)
+        for line in lines:
+            line = line.split('!')[0].split() #remove comments
+            if line:
+                read_prm(line, prm)
+        return prm
 
     def read_BONDS(self, bond, prm):
         #    CC311D     NC2D1     320.00    1.430
@@ -423,11 +874,405 @@ class CHARMMParameters:
         else:
             print "Invalid ATOM/MASS: "+' '.join(atom)
 
+    def compile_parameters(self):
+        """Returns an array representation of the parameters, keyed by atom type ids (see CHARMMParameterTables)
+        """
+        return CHARMMParameterTables(self.parameters)
+
+class LazyParameters(dict):
+    """Dictionary of CHARMM parameters in which sections are parsed on first access.
+    Sections of several files are parsed in the order the files were read and merged into a single dictionary.
+        Attributes:
+            parser: CHARMMParameters instance used to parse the sections
+            pending: dictionary with section name as key and list of (path, start offset, end offset) still to be parsed as value
+    """
+    def __init__(self, parser):
+        dict.__init__(self)
+        self.parser = parser
+        self.pending = {}
+
+    def add_section(self, prm_type, fileIn, start, end):
+        """Adds a section of a file. If the section has already been accessed, it is parsed and merged immediately
+        """
+        if dict.__contains__(self, prm_type):
+            dict.__getitem__(self, prm_type).update(self.parser.parse_section(prm_type, fileIn, start, end))
+        elif prm_type in self.pending:
+            self.pending[prm_type].append((fileIn, start, end))
+        else:
+            self.pending[prm_type] = [(fileIn, start, end)]
+
+    def __missing__(self, prm_type):
+        if prm_type not in self.pending:
+            raise KeyError(prm_type)
+        prm = {}
+        for fileIn,start,end in self.pending.pop(prm_type):
+            prm.update(self.parser.parse_section(prm_type, fileIn, start, end))
+        dict.__setitem__(self, prm_type, prm)
+        return prm
+
+    def __contains__(self, prm_type):
+        return dict.__contains__(self, prm_type) or prm_type in self.pending
+
+    def get(self, prm_type, default = None):
+        if prm_type in self:
+            return self[prm_type]
+        return default
+
+    def parse_all(self):
+        """Parses all pending sections
+        """
+        for prm_type in self.pending.keys():
+            self[prm_type]
+
+    def __iter__(self):
+        self.parse_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        return len(dict.keys(self)) + len(self.pending)
+
+    def keys(self):
+        self.parse_all()
+        return dict.keys(self)
+
+    def values(self):
+        self.parse_all()
+        return dict.values(self)
+
+    def items(self):
+        self.parse_all()
+        return dict.items(self)
+
+class CHARMMParameterTables:
+    """Array representation of CHARMM parameters. Atom types are interned to integer ids and 
+    the parameters are stored in NumPy arrays, which allows vectorized lookups.
+        Attributes:
+            type_ids: dictionary with atom type as key and integer id as value. The CHARMM wildcard X has its own id
+            types: list of atom types (index is the type id)
+            nb_epsilon, nb_rmin_half, nb_epsilon14, nb_rmin14_half: NONBONDED parameters indexed by type id (nan if missing)
+            bond_k0, bond_d0: BONDS parameters indexed by bond row
+            angle_k0, angle_a0, angle_kub, angle_s0: ANGLES parameters indexed by angle row
+            dihedral_ptr: index of the first term of each dihedral row in dihedral_k, dihedral_n and dihedral_d (CSR like)
+            dihedral_k, dihedral_n, dihedral_d: terms of all dihedrals
+            dihedral_keys: original key (atom1-atom2-atom3-atom4) of each dihedral row
+    """
+    def __init__(self, parameters):
+        """
+        Parameters:
+            parameters: dictionary of parameters (CHARMMParameters.parameters). Only BONDS, ANGLES, DIHEDRALS and NONBONDED are used
+        """
+        self.type_ids = {}
+        self.types = []
+        self.wildcard = self.get_type_id('X')
+        #collect all atom types
+        for prm_type in ['NONBONDED', 'BONDS', 'ANGLES', 'DIHEDRALS']:
+            for key in parameters.get(prm_type, {}):
+                for t in key.split('-'):
+                    self.get_type_id(t)
+        self.ntypes = len(self.types)
+        ntypes = self.ntypes
+
+        nonbonded = parameters.get('NONBONDED', {})
+        self.nb_epsilon = np.full(ntypes, np.nan)
+        self.nb_rmin_half = np.full(ntypes, np.nan)
+        self.nb_epsilon14 = np.full(ntypes, np.nan)
+        self.nb_rmin14_half = np.full(ntypes, np.nan)
+        for t,prm in nonbonded.items():
+            i = self.type_ids[t]
+            self.nb_epsilon[i],self.nb_rmin_half[i] = prm[:2]
+            if len(prm) > 4:
+                self.nb_epsilon14[i],self.nb_rmin14_half[i] = prm[3:5]
+            else:
+                self.nb_epsilon14[i],self.nb_rmin14_half[i] = prm[:2]
+
+        bonds = parameters.get('BONDS', {})
+        self.bond_codes,self.bond_rows,keys = self.build_codes(bonds.keys())
+        self.bond_k0 = np.array([bonds[k][0] for k in keys])
+        self.bond_d0 = np.array([bonds[k][1] for k in keys])
+
+        angles = parameters.get('ANGLES', {})
+        self.angle_codes,self.angle_rows,keys = self.build_codes(angles.keys())
+        self.angle_k0 = np.array([angles[k][0] for k in keys])
+        self.angle_a0 = np.array([angles[k][1] for k in keys])
+        self.angle_kub = np.array([angles[k][2] if len(angles[k]) > 3 else 0. for k in keys])
+        self.angle_s0 = np.array([angles[k][3] if len(angles[k]) > 3 else 0. for k in keys])
+
+        dihedrals = parameters.get('DIHEDRALS', {})
+        self.dihedral_codes,self.dihedral_rows,self.dihedral_keys = self.build_codes(dihedrals.keys())
+        self.dihedral_ptr = np.zeros(len(self.dihedral_keys)+1, dtype = int)
+        terms = []
+        for i,k in enumerate(self.dihedral_keys):
+            terms.extend(dihedrals[k])
+            self.dihedral_ptr[i+1] = len(terms)
+        terms = np.array(terms, dtype = float).reshape(-1, 3)
+        self.dihedral_k = terms[:, 0]
+        self.dihedral_n = terms[:, 1]
+        self.dihedral_d = terms[:, 2]
+
+    def get_type_id(self, atom_type):
+        """Returns the id of an atom type. New types are added to the table (only while building the tables)
+        """
+        if atom_type not in self.type_ids:
+            self.type_ids[atom_type] = len(self.types)
+            self.types.append(atom_type)
+        return self.type_ids[atom_type]
+
+    def get_type_ids(self, atom_types):
+        """Returns an array of type ids for a list of atom types. Unknown types have an id of -1
+        """
+        return np.array([self.type_ids.get(t, -1) for t in atom_types], dtype = int)
+
+    def encode(self, ids):
+        """Encodes tuples of type ids into a single integer
+        Parameters:
+            ids: array of type ids (n, m)
+        Returns:
+            codes: array of codes (n). -1 for tuples with unknown types
+        """
+        ids = np.asarray(ids, dtype = np.int64)
+        codes = np.zeros(ids.shape[0], dtype = np.int64)
+        for j in range(ids.shape[1]):
+            codes = codes*self.ntypes + ids[:, j]
+        codes[np.any(ids < 0, axis = 1)] = -1
+        return codes
+
+    def build_codes(self, keys):
+        """Builds the sorted codes of parameter keys (atom1-atom2-...)
+        Returns:
+            codes: sorted array of codes
+            rows: row of the parameter corresponding to each code
+            keys: list of keys (index is row)
+        """
+        keys = sorted(keys)
+        if not keys:
+            return np.zeros(0, dtype = np.int64),np.zeros(0, dtype = int),keys
+        codes = self.encode([[self.type_ids[t] for t in k.split('-')] for k in keys])
+        order = np.argsort(codes)
+        return codes[order],order,keys
+
+    def search(self, codes, rows, ids):
+        """Vectorized search of tuples of type ids. Both orientations and the wildcard X are considered
+        Parameters:
+            codes: sorted codes of the parameter table
+            rows: rows corresponding to codes
+            ids: array of type ids (n, m)
+        Returns:
+            found_rows: array of rows (n). -1 if no parameter was found
+        """
+        if not len(ids):
+            return np.full(0, -1, dtype = int)
+        ids = np.asarray(ids, dtype = np.int64).reshape(len(ids), -1)
+        found_rows = np.full(ids.shape[0], -1, dtype = int)
+        if not len(codes):
+            return found_rows
+        candidates = [ids, ids[:, ::-1]]
+        if ids.shape[1] == 4:
+            #X-B-C-X wildcards
+            wildcard = ids.copy()
+            wildcard[:, [0, 3]] = self.wildcard
+            candidates.extend([wildcard, wildcard[:, ::-1]])
+        for candidate in candidates:
+            missing = found_rows < 0
+            if not np.any(missing):
+                break
+            c = self.encode(candidate[missing])
+            idx = np.searchsorted(codes, c)
+            idx[idx >= len(codes)] = 0
+            match = (codes[idx] == c) & (c >= 0)
+            rows_missing = np.flatnonzero(missing)
+            found_rows[rows_missing[match]] = rows[idx[match]]
+        return found_rows
+
+    def get_bond_rows(self, atom_types):
+        """Returns the rows of BONDS parameters for a list of pairs of atom types (-1 if missing)
+        """
+        return self.search(self.bond_codes, self.bond_rows, [self.get_type_ids(t) for t in atom_types])
+
+    def get_angle_rows(self, atom_types):
+        """Returns the rows of ANGLES parameters for a list of triplets of atom types (-1 if missing)
+        """
+        return self.search(self.angle_codes, self.angle_rows, [self.get_type_ids(t) for t in atom_types])
+
+    def get_dihedral_rows(self, atom_types):
+        """Returns the rows of DIHEDRALS parameters for a list of quadruplets of atom types (-1 if missing)
+        """
+        return self.search(self.dihedral_codes, self.dihedral_rows, [self.get_type_ids(t) for t in atom_types])
+
+    def get_dihedral_terms(self, row):
+        """Returns the list of [k, n, d] terms of a dihedral row
+        """
+        i0,i1 = self.dihedral_ptr[row:row+2]
+        return np.column_stack((self.dihedral_k[i0:i1], self.dihedral_n[i0:i1], self.dihedral_d[i0:i1]))
+
+    def get_vdw(self, atom_types):
+        """Returns the van der Waals parameters for a list of atom types
+        Parameters:
+            atom_types: list of atom types
+        Returns:
+            epsilon: array of epsilon
+            rmin_half: array of rmin/2
+        """
+        ids = self.get_type_ids(atom_types)
+        missing = [t for t,i in zip(atom_types, ids) if i < 0 or np.isnan(self.nb_epsilon[i])]
+        if missing:
+            raise KeyError('Missing NONBONDED parameters for ' + ' '.join(sorted(set(missing))))
+        return self.nb_epsilon[ids],self.nb_rmin_half[ids]
+
 
 
 #####################################################################################
 #                                    Molecule                                        #
 #####################################################################################
+class CompactConnectivity:
+    """Array representation of the connectivity and directed connectivity of a Molecule. 
+    Atoms are identified by their index in the AtomGroup, so coordinates can be read and changed without selections.
+    It is kept in addition to the NetworkX graphs, which remain the representation that is edited, so it increases the memory of a molecule; it is used to speed up rotations and clash exclusions
+    Attributes:
+        serials: serial number of each atom
+        index: atom index of each serial number (-1 if not in AtomGroup)
+        atoms: structured array with serial, id, name, type, element and charge of each atom (empty or nan if not assigned)
+        indptr, indices: bonded atoms of atom i are indices[indptr[i]:indptr[i+1]]
+        graph_nodes: sorted serial numbers of the nodes of connectivity
+        nodes: nodes of the directed connectivity (serial number or cycle key)
+        node_offsets, node_atoms: atoms of node i are node_atoms[node_offsets[i]:node_offsets[i+1]]
+        atom_node: node of each atom (-1 if not in directed connectivity)
+        parent: parent of each node (-1 for root)
+        children_ptr, children: children of node i are children[children_ptr[i]:children_ptr[i+1]]
+        moving: dictionary with node as key and indices of atoms moved by a rotation around its parent bond
+        exclude_1_3: 1-2 and 1-3 neighbors of each atom (None until get_exclude_1_3 is called)
+    """
+    def __init__(self, molecule):
+        """
+        Parameters:
+            molecule: Molecule with connectivity and directed_connectivity
+        """
+        self.serials = molecule.atom_group.getSerials()
+        n = len(self.serials)
+        self.index = np.full(self.serials.max() + 1, -1, dtype = int)
+        self.index[self.serials] = np.arange(n)
+        
+        G = molecule.connectivity
+        self.graph_nodes = np.array(sorted(G.nodes()), dtype = int)
+        columns = {}
+        dtype = [('serial', int)]
+        for attribute in ['id', 'name', 'type', 'element']:
+            values = nx.get_node_attributes(G, attribute)
+            columns[attribute] = values
+            dtype.append((attribute, 'S%d' % max([1] + map(len, values.values()))))
+        columns['charge'] = nx.get_node_attributes(G, 'charge')
+        dtype.append(('charge', float))
+        self.atoms = np.zeros(n, dtype = dtype)
+        self.atoms['serial'] = self.serials
+        self.atoms['charge'] = np.nan
+        for attribute,values in columns.items():
+            if values:
+                self.atoms[attribute][self.index[values.keys()]] = values.values()
+
+        #bonds between atoms
+        rows = []
+        cols = []
+        for a,neighbors in G.adjacency():
+            rows.extend([a]*len(neighbors))
+            cols.extend(neighbors)
+        rows = self.index[np.array(rows, dtype = int)]
+        cols = self.index[np.array(cols, dtype = int)]
+        order = np.lexsort((cols, rows))
+        self.indices = cols[order]
+        self.indptr = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength = n))))
+        
+        #directed connectivity with collapsed cycles
+        D = molecule.directed_connectivity
+        self.nodes = list(D.nodes())
+        node_index = dict(zip(self.nodes, range(len(self.nodes))))
+        node_atoms = []
+        node_sizes = []
+        for node in self.nodes:
+            if type(node) == str:
+                atoms = map(int, node.split('-'))
+            else:
+                atoms = [node]
+            node_atoms.extend(atoms)
+            node_sizes.append(len(atoms))
+        self.node_atoms = self.index[np.array(node_atoms, dtype = int)]
+        self.node_offsets = np.concatenate(([0], np.cumsum(node_sizes))).astype(int)
+        self.atom_node = np.full(n, -1, dtype = int)
+        self.atom_node[self.node_atoms] = np.repeat(np.arange(len(self.nodes)), node_sizes)
+        self.parent = np.full(len(self.nodes), -1, dtype = int)
+        edges = np.array([(node_index[u], node_index[v]) for u,v in D.edges()], dtype = int).reshape(-1, 2)
+        self.parent[edges[:, 1]] = edges[:, 0]
+        edges = edges[np.argsort(edges[:, 0], kind = 'mergesort')]
+        self.children = edges[:, 1]
+        self.children_ptr = np.concatenate(([0], np.cumsum(np.bincount(edges[:, 0], minlength = len(self.nodes))))).astype(int)
+        self.moving = {}
+        self.exclude_1_3 = None
+
+    def get_atoms(self, serials):
+        """Returns the atom indices of a list of serial numbers
+        """
+        return self.index[np.asarray(serials, dtype = int)]
+
+    def get_moving_atoms(self, serial):
+        """Returns the indices of the atoms that move with an atom (its node and all descendants in the directed connectivity)
+        Parameters:
+            serial: serial number of atom
+        Returns:
+            atoms: sorted array of atom indices
+        """
+        node = self.atom_node[self.index[serial]]
+        if node not in self.moving:
+            nodes = set([node])
+            stack = [node]
+            while stack:
+                k = stack.pop()
+                for c in self.children[self.children_ptr[k]:self.children_ptr[k+1]]:
+                    if c not in nodes:
+                        nodes.add(c)
+                        stack.append(c)
+            atoms = [self.node_atoms[self.node_offsets[k]:self.node_offsets[k+1]] for k in nodes]
+            self.moving[node] = np.sort(np.concatenate(atoms))
+        return self.moving[node]
+
+    def get_exclude_1_3(self):
+        """Returns the 1-2 and 1-3 neighbors of each node of connectivity, in the order of the sorted nodes (as used by the samplers)
+        Returns:
+            exclude: list of sets of serial numbers
+        """
+        if self.exclude_1_3 is None:
+            self.exclude_1_3 = []
+            for i in self.index[self.graph_nodes]:
+                neighbors = self.indices[self.indptr[i]:self.indptr[i+1]]
+                atoms = [neighbors]
+                atoms.extend([self.indices[self.indptr[j]:self.indptr[j+1]] for j in neighbors])
+                self.exclude_1_3.append(set(self.serials[np.concatenate(atoms)].tolist()))
+        return self.exclude_1_3
+
+    def to_networkx(self):
+        """Exports the connectivity and the directed connectivity to NetworkX
+        Returns:
+            connectivity: Graph with atom serial numbers as nodes and their attributes
+            directed_connectivity: DiGraph with serial numbers or cycle keys as nodes 
+        """
+        G = nx.Graph()
+        for atom in self.atoms:
+            attributes = {}
+            for attribute in ['id', 'name', 'type', 'element']:
+                if atom[attribute]:
+                    attributes[attribute] = atom[attribute]
+            if not np.isnan(atom['charge']):
+                attributes['charge'] = atom['charge']
+            G.add_node(int(atom['serial']), **attributes)
+        rows = np.repeat(np.arange(len(self.serials)), np.diff(self.indptr))
+        G.add_edges_from(zip(self.serials[rows].tolist(), self.serials[self.indices].tolist()))
+        D = nx.DiGraph()
+        for node in self.nodes:
+            if type(node) == str:
+                D.add_node(node, iscycle = True, cycle_id = map(int, node.split('-')))
+            else:
+                D.add_node(node, iscycle = False, cycle_id = [])
+        rows = np.repeat(np.arange(len(self.nodes)), np.diff(self.children_ptr))
+        D.add_edges_from([(self.nodes[u], self.nodes[v]) for u,v in zip(rows, self.children)])
+        return G,D
+
 class Molecule:
     """Class for saving a molecule
     Attributes:
@@ -443,6 +1288,9 @@ class Molecule:
             connectivity: graph for connectivity of molecule (bonds)
             directed_connectivity: directed acyclique graph of molecule
             interresidue_connectivity: directed acyclique graph representing the interresidue bonds
+            compact: CompactConnectivity of connectivity and directed_connectivity (None if not built)
+            ensemble: array (n_conformers, n_atoms, 3) of stored conformers (None if empty)
+            ensemble_scores: score of each conformer (lower is better)
     """
     def __init__(self, name, chain = 'X', segn = 'X'):
         """initialize AtomGroup used to build pdb from scratch
@@ -476,6 +1324,10 @@ class Molecule:
         self.cycle_id = {}
         self.torsionals = []
         self.bonded_uptodate = False
+        self.residue_index = None
+        self.compact = None
+        self.ensemble = None
+        self.ensemble_scores = None
 
         self.prefix = ['segment', 'chain', 'resid', 'icode']
         #Defines distance for bond length between different element used in guess_bonds()
@@ -488,6 +1340,129 @@ class Molecule:
         self.bond_length['C-N'] = 1.7
         self.bond_length['C-O'] = 1.7
 
+    def clone(self, name = None):
+        """Returns a copy of the molecule that shares the topology (graphs, bonds, torsionals, cycles, compact connectivity) with this molecule. 
+        The clone has its own AtomGroup (copies of the atom labels and coordinates), which can be changed without affecting this molecule.
+        The shared topology should not be modified; use copy.deepcopy for an independent molecule
+        Parameters:
+            name: name of the clone. Default name of the molecule
+        Returns:
+            molecule: Molecule
+        """
+        molecule = copy.copy(self)
+        if name:
+            molecule.name = name
+        atom_group = AtomGroup(molecule.name)
+        for label in self.atom_group.getDataLabels():
+            atom_group.setData(label, self.atom_group.getData(label))
+        atom_group.setCoords(self.atom_group.getCoords())
+        molecule.atom_group = atom_group
+        molecule.residue_index = None
+        return molecule
+
+    def add_conformers(self, coords, scores):
+        """Adds conformers to the ensemble
+        Parameters:
+            coords: array (n_conformers, n_atoms, 3) or (n_atoms, 3)
+            scores: score of each conformer (lower is better)
+        """
+        coords = np.array(coords, dtype = float).reshape(-1, self.atom_group.numAtoms(), 3)
+        scores = np.array(scores, dtype = float).reshape(-1)
+        if self.ensemble is None:
+            self.ensemble = coords
+            self.ensemble_scores = scores
+        else:
+            self.ensemble = np.concatenate((self.ensemble, coords))
+            self.ensemble_scores = np.concatenate((self.ensemble_scores, scores))
+
+    def add_conformer(self, score = 0.):
+        """Adds the current coordinates to the ensemble
+        Parameters:
+            score: score of the conformer (lower is better)
+        """
+        self.add_conformers(self.atom_group.getCoords(), [score])
+
+    def get_ensemble(self):
+        """Returns the stored conformers and their scores
+        Returns:
+            coords: array (n_conformers, n_atoms, 3)
+            scores: array of scores
+        """
+        if self.ensemble is None:
+            return np.zeros((0, self.atom_group.numAtoms(), 3)),np.zeros(0)
+        return self.ensemble,self.ensemble_scores
+
+    def set_conformer(self, index):
+        """Sets the coordinates of the molecule to a conformer of the ensemble
+        Parameters:
+            index: index of conformer
+        """
+        self.atom_group.setCoords(self.ensemble[index])
+
+    def clear_conformers(self):
+        """Removes all the conformers
+        """
+        self.ensemble = None
+        self.ensemble_scores = None
+
+    def keep_best_conformers(self, n_conformers):
+        """Sorts the ensemble by score and keeps the n_conformers best conformers
+        """
+        if self.ensemble is None:
+            return
+        order = np.argsort(self.ensemble_scores, kind = 'mergesort')[:n_conformers]
+        self.ensemble = self.ensemble[order]
+        self.ensemble_scores = self.ensemble_scores[order]
+
+    def remove_duplicate_conformers(self, rmsd_threshold = 0.5):
+        """Removes conformers that are within rmsd_threshold of a conformer with a better score. 
+        Conformers are compared without superposition, since the molecule is anchored in its environment
+        Parameters:
+            rmsd_threshold: minimum RMSD (Angstrom) between two conformers
+        Returns:
+            kept: indices of the kept conformers (sorted by score)
+        """
+        if self.ensemble is None:
+            return []
+        order = np.argsort(self.ensemble_scores, kind = 'mergesort')
+        n_atoms = self.ensemble.shape[1]
+        kept = []
+        for i in order:
+            if kept:
+                diff = self.ensemble[kept] - self.ensemble[i]
+                rmsd = np.sqrt(np.einsum('kij,kij->k', diff, diff) / n_atoms)
+                if rmsd.min() < rmsd_threshold:
+                    continue
+            kept.append(i)
+        self.ensemble = self.ensemble[kept]
+        self.ensemble_scores = self.ensemble_scores[kept]
+        return kept
+
+    def get_conformers_rmsd(self):
+        """Returns the RMSD matrix between all the conformers (without superposition)
+        """
+        coords,scores = self.get_ensemble()
+        flat = coords.reshape(len(coords), -1)
+        sq = np.einsum('ij,ij->i', flat, flat)
+        d2 = sq[:, np.newaxis] + sq[np.newaxis, :] - 2 * flat.dot(flat.T)
+        return np.sqrt(np.maximum(d2, 0.) / coords.shape[1])
+
+    def write_ensemble(self, filename):
+        """Saves all the conformers, sorted as in the ensemble. DCD files (.dcd) only contain coordinates, other files are written as multi-model PDB
+        Parameters:
+            filename: path to output file
+        """
+        coords,scores = self.get_ensemble()
+        if not len(coords):
+            print 'No conformers in ensemble'
+            return -1
+        atom_group = self.atom_group.copy()
+        atom_group.setCoords(coords, label = ['score %g' % score for score in scores])
+        if os.path.splitext(filename)[1].lower() == '.dcd':
+            writeDCD(filename, atom_group)
+        else:
+            writePDB(filename, atom_group)
+
     def writePDB(self, filename, selection = 'all'):
         """Saves molecule to a PDB file
         Parameters:
@@ -496,6 +1471,18 @@ class Molecule:
         """
         writePDB(filename, self.atom_group.select(selection))
 
+    def writeMMCIF(self, filename, selection = 'all'):
+        """Saves molecule to a mmCIF file
+        Parameters:
+            filename: path to mmCIF file
+            selection: selection of a subset of the molecule (str)
+        """
+        writer = StructureWriter(filename, 'cif', title = self.name)
+        try:
+            writer.write(self.atom_group.select(selection))
+        finally:
+            writer.close()
+
     def read_molecule_from_PDB(self, filename, rootAtom = 1, update_bonds = True, **kwargs):
         """Initialize molecule from a PDB file
         Parameters:
@@ -536,6 +1523,18 @@ class Molecule:
             return -1
         return 0
 
+    def read_molecule_from_mmCIF(self, filename, rootAtom = 1, update_bonds = True):
+        """Initialize molecule from a mmCIF file (see read_mmcif)
+        Parameters:
+            filename: path to mmCIF file
+            rootAtom: serial number of root atom
+            update_bonds: guess bonds, angles, dihedrals and connectivity based on the distance between atoms
+        """
+        molecule = read_mmcif(filename)
+        if molecule is None:
+            return -1
+        return self.set_AtomGroup(molecule, rootAtom = rootAtom, update_bonds = update_bonds)
+
     def set_id(self):
         segn = self.atom_group.getSegnames()
         chid = self.atom_group.getChids()
@@ -567,16 +1566,17 @@ class Molecule:
     def get_segname(self):
         return self.segn
     
+    def get_residue_index(self):
+        """Returns the ResidueIndex of atom_group. The index is rebuilt when atom_group changes
+        """
+        if not self.residue_index or not self.residue_index.is_valid(self.atom_group):
+            self.residue_index = ResidueIndex(self.atom_group)
+        return self.residue_index
+
     def get_residue(self, res_id):
         """Returns an AtomGroup of given atom id; composed of 'segname,chain,resid,icode,atomName'
         """
-        
-        sel = []
-        for p,s in zip(self.prefix, res_id.split(',')):
-            if s:
-                sel .append(p + ' ' + s)
-        sel = ' and '.join(sel)
-        return self.atom_group.select(sel)
+        return self.get_residue_index().get_residue(res_id)
         
     def get_atom(self, a_id, atom_name):
         """Returns an AtomGroup of given atom id; composed of 'segname,chain,resid,icode'
@@ -592,6 +1592,15 @@ class Molecule:
         """Assignes atom name, type and charge to each atom in the connectivity graph
         """
         self.connectivity.add_nodes_from(atom_type.items())
+        self.compact = None
+
+    def get_compact_connectivity(self):
+        """Returns the CompactConnectivity of the molecule. It is built on first use and rebuilt after the graphs change.
+        When it is built, rotate_bond and measure_dihedral_angle use atom indices instead of selections
+        """
+        if self.compact is None or len(self.compact.serials) != self.atom_group.numAtoms():
+            self.compact = CompactConnectivity(self)
+        return self.compact
 
     def build_connectivity_graph(self):
         """Builds a connectivity graph for molecules (not protein) in AtomGroup
@@ -781,47 +1790,112 @@ class Molecule:
             default_bond_length: maximum distance between two connected heavy atoms (Angstrom), if not present in bond_length dictionary
         """
         self.connectivity = nx.Graph()
-        for a in self.atom_group:
-            bonds = []
-            sel = ''
-            a_elem = a.getElement()
-            if a_elem:
-                # use predefined bond length for atom pairs 
-                for e in self.elements:
-                    key = '-'.join(sorted([a_elem, e]))
-                    if key in self.bond_length:
-                        if sel:
-                            sel += ' or '
-                        sel += '((element ' + e + ') and (within ' + str(self.bond_length[key]) + ' of serial ' + str(a.getSerial()) + '))'
-            if not sel:
-                sel = 'within ' + str(default_bond_length) + ' of serial ' + str(a.getSerial())
-            sel = '(' + sel + ') and (not serial ' + str(a.getSerial()) + ')'
-            
-            # search for all neighboring atoms
-            neighbors =  self.atom_group.select(sel)
-            if neighbors:
-                for aa in neighbors:
-                        bonds.append((a.getSerial(), aa.getSerial()))
-
-            self.connectivity.add_edges_from(bonds)
+        n = self.atom_group.numAtoms()
+        elements = self.atom_group.getElements()
+        if elements is None:
+            elements = np.array(['']*n)
+        #bond length between each element of the molecule (rows) and each element in self.elements (last column: other elements)
+        unique_elements, element_type = np.unique(elements, return_inverse = True)
+        ne = len(self.elements)
+        lengths = np.full((len(unique_elements), ne + 1), -1.)
+        for i,e1 in enumerate(unique_elements):
+            for j,e2 in enumerate(self.elements):
+                key = '-'.join(sorted([e1, e2]))
+                if e1 and key in self.bond_length:
+                    lengths[i, j] = self.bond_length[key]
+        #atoms without predefined bond length are bonded to any atom within default_bond_length
+        use_default = (lengths < 0).all(axis = 1)
+        lengths[use_default, :] = default_bond_length
+        known = dict([(e, i) for i,e in enumerate(self.elements)])
+        column = np.array([known.get(e, ne) for e in unique_elements], dtype = int)[element_type]
+        
+        kd = KDTree(self.atom_group.getCoords())
+        kd.search(max(lengths.max(), default_bond_length))
+        pairs = kd.getIndices()
+        if pairs is not None and len(pairs):
+            pairs = np.array(pairs, dtype = int).reshape(-1, 2)
+            distances = np.array(kd.getDistances()).reshape(-1)
+            #neighbors are searched from each atom, in the order of atoms
+            pairs = np.vstack([pairs, pairs[:, ::-1]])
+            distances = np.concatenate([distances, distances])
+            cutoff = lengths[element_type[pairs[:, 0]], column[pairs[:, 1]]]
+            pairs = pairs[distances <= cutoff]
+            pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+            self.connectivity.add_edges_from(self.atom_group.getSerials()[pairs].tolist())
         self.bonds = self.connectivity.edges()
     
-
     def guess_angles(self):
         """Searches for all angles in a molecule based on the connectivity
         """
-        self.angles = []
-        for node in self.connectivity.nodes():
-            self.angles.extend(self.find_paths(self.connectivity, node, 2))
-
+        self.angles = self.enumerate_paths(2)
 
     def guess_dihedrals(self):
         """Searches for all dihedrals in a molecule based on the connectivity
         """
-        self.dihedrals = []
-        for node in self.connectivity.nodes():
-            self.dihedrals.extend(self.find_paths(self.connectivity, node, 3))
-        
+        self.dihedrals = self.enumerate_paths(3)
+
+    def get_adjacency(self, G = None):
+        """Returns the adjacency of a graph in compressed sparse row format. Neighbors are kept in the order of the graph
+        Parameters:
+            G: graph (networkx). Default connectivity
+        Returns:
+            nodes: list of nodes
+            indptr: neighbors of node i are indices[indptr[i]:indptr[i+1]]
+            indices: index of neighbors in nodes
+        """
+        if G is None:
+            G = self.connectivity
+        nodes = list(G.nodes())
+        index = dict(zip(nodes, range(len(nodes))))
+        indptr = np.zeros(len(nodes) + 1, dtype = int)
+        indices = []
+        for i,n in enumerate(nodes):
+            neighbors = G.neighbors(n)
+            indices.extend([index[m] for m in neighbors])
+            indptr[i+1] = len(indices)
+        return nodes, indptr, np.array(indices, dtype = int)
+
+    def enumerate_paths(self, length, G = None):
+        """Finds all simple paths of a given length in a graph. Paths are expanded from the adjacency all at once. 
+        Each path is only returned once (a path and its reverse are the same), in the orientation and order it is first found by find_paths starting from every node
+        Parameters:
+            G: graph (networkx). Default connectivity
+            length: length of paths (number of edges)
+        Returns:
+            paths: list of paths (list of nodes)
+        """
+        nodes, indptr, indices = self.get_adjacency(G)
+        paths = np.arange(len(nodes)).reshape(-1, 1)
+        degree = np.diff(indptr)
+        for l in range(length):
+            last = paths[:, -1]
+            counts = degree[last]
+            total = counts.sum()
+            if not total:
+                paths = np.zeros((0, l + 2), dtype = int)
+                break
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            neighbors = indices[np.repeat(indptr[last], counts) + offsets]
+            paths = np.hstack([np.repeat(paths, counts, axis = 0), neighbors.reshape(-1, 1)])
+            # paths are simple: the new node is not already in the path
+            keep = np.ones(len(paths), dtype = bool)
+            for i in range(l + 1):
+                keep &= paths[:, i] != neighbors
+            paths = paths[keep]
+        if not len(paths):
+            return []
+        # canonical orientation: path or its reverse, whichever is smaller
+        reverse = paths[:, ::-1]
+        diff = paths != reverse
+        first = np.argmax(diff, axis = 1)
+        rows = np.arange(len(paths))
+        flip = diff[rows, first] & (reverse[rows, first] < paths[rows, first])
+        canonical = np.where(flip[:, np.newaxis], reverse, paths)
+        canonical = np.ascontiguousarray(canonical).view(np.dtype((np.void, canonical.dtype.itemsize * canonical.shape[1]))).ravel()
+        u,idx = np.unique(canonical, return_index = True)
+        nodes = np.array(nodes + [None], dtype = object)[:-1]
+        return nodes[paths[np.sort(idx)]].tolist()
+
     def find_paths(self, G, node, length, excludeSet = None):
         """Finds all paths of a given length
         Parameters:
@@ -864,6 +1938,7 @@ class Molecule:
                                         not cycle: serial number of atom
                                         cycle: string with all serial number joined by a '-'
         """
+        self.compact = None
         cycles = nx.cycle_basis(self.connectivity, self.rootAtom)
         #flatten cycles
         self.cycle_id = {}
@@ -872,31 +1947,54 @@ class Molecule:
             for a in cycle:
                 self.cycle_id[a] = key
         self.directed_connectivity = nx.DiGraph()
+        edges = np.array(list(nx.dfs_edges(self.connectivity, self.rootAtom)), dtype = int).reshape(-1, 2)
+        if not len(edges):
+            return
         
-        for edge in nx.dfs_edges(self.connectivity,self.rootAtom):
+        #nodes of the directed graph: serial number or cycle key
+        nodes = []
+        added = set()
+        directed_edges = []
+        for edge in edges.tolist():
             directed_edge = []
-            atoms = []
             for node in edge:
-                atoms.append(self.atom_group.select('serial ' + str(node)))
                 if node in self.cycle_id:
                     key = self.cycle_id[node]
-                    if key not in self.directed_connectivity:
-                        self.directed_connectivity.add_node(key, iscycle = True, cycle_id = map(int, self.cycle_id[node].split('-')))
+                    if key not in added:
+                        nodes.append((key, {'iscycle': True, 'cycle_id': map(int, key.split('-'))}))
+                        added.add(key)
                     directed_edge.append(key)
                 else:
-                    self.directed_connectivity.add_node(node, iscycle = False, cycle_id = [])
+                    if node not in added:
+                        nodes.append((node, {'iscycle': False, 'cycle_id': []}))
+                        added.add(node)
                     directed_edge.append(node)
-            if directed_edge[0] == directed_edge[1]:
-                continue
-            self.directed_connectivity.add_edge(directed_edge[0], directed_edge[1])
-            a1,a2 = atoms
-            if a1.getResnums()[0] != a2.getResnums()[0]:
-                r1 = a1.getSegnames()[0] + ',' + a1.getChids()[0] + ',' + str(a1.getResnums()[0]) + ',' + a1.getIcodes()[0]
-                r2 = a2.getSegnames()[0] + ',' + a2.getChids()[0] + ',' + str(a2.getResnums()[0]) + ',' + a2.getIcodes()[0]
-                self.interresidue_connectivity.add_node(r1, resname=a1.getResnames()[0])
-                self.interresidue_connectivity.add_node(r2, resname=a2.getResnames()[0])
-                self.interresidue_connectivity.add_edge(r1, r2, patch = '', atoms = a1.getNames()[0] + ':' + a2.getNames()[0])
-                
+            if directed_edge[0] != directed_edge[1]:
+                directed_edges.append(directed_edge)
+        self.directed_connectivity.add_nodes_from(nodes)
+        self.directed_connectivity.add_edges_from(directed_edges)
+        
+        #atom indices of serial numbers
+        serials = self.atom_group.getSerials()
+        serial_index = np.zeros(max(serials.max(), edges.max()) + 1, dtype = int)
+        serial_index[serials] = np.arange(len(serials))
+        i1 = serial_index[edges[:, 0]]
+        i2 = serial_index[edges[:, 1]]
+        resnums = self.atom_group.getResnums()
+        inter = np.flatnonzero(resnums[i1] != resnums[i2])
+        if not len(inter):
+            return
+        segn = self.atom_group.getSegnames()
+        chid = self.atom_group.getChids()
+        ics = self.atom_group.getIcodes()
+        resnames = self.atom_group.getResnames()
+        names = self.atom_group.getNames()
+        for a1,a2 in zip(i1[inter], i2[inter]):
+            r1 = segn[a1] + ',' + chid[a1] + ',' + str(resnums[a1]) + ',' + ics[a1]
+            r2 = segn[a2] + ',' + chid[a2] + ',' + str(resnums[a2]) + ',' + ics[a2]
+            self.interresidue_connectivity.add_node(r1, resname = resnames[a1])
+            self.interresidue_connectivity.add_node(r2, resname = resnames[a2])
+            self.interresidue_connectivity.add_edge(r1, r2, patch = '', atoms = names[a1] + ':' + names[a2])
 
     def define_torsionals(self, hydrogens=True):
         """Builds a list with all the torsional angles that can rotate
@@ -906,6 +2004,7 @@ class Molecule:
             torsionals: a list of serial number of atom defining a torsional angle (quadruplet) 
         """
         self.torsionals = []
+        rotatable = set()
         #cycles = nx.cycle_basis(self.connectivity, self.rootAtom)
         if not hydrogens:
             elements = nx.get_node_attributes(self.connectivity, 'element')
@@ -937,16 +2036,9 @@ class Molecule:
                 if elements[dihe[0]] == 'H' or elements[dihe[-1]] == 'H':
                     continue
             #check if already in torsionals list
-            exists = False
-            if self.torsionals:
-                for t in self.torsionals:
-                    if dihe[1] == t[1] and dihe[2] == t[2]:
-                        exists = True
-                        break
-
-            if exists:
+            if (dihe[1], dihe[2]) in rotatable:
                 continue
-
+            rotatable.add((dihe[1], dihe[2]))
             self.torsionals.append(dihe)
 
     def rotate_bond(self, torsional, theta, absolute =False):
@@ -965,6 +2057,9 @@ class Molecule:
                 print "Warning torsional"
                 #return -1
 
+        if self.compact is not None:
+            return self.rotate_bond_compact(torsional, theta, absolute)
+
         atoms = []
         a1 = torsional[-2]
 
@@ -995,6 +2090,25 @@ class Molecule:
         sel.setCoords(coords.transpose() + v2 - np.dot(M,v2))
         return c_angle
 
+    def rotate_bond_compact(self, torsional, theta, absolute = False):
+        """Same as rotate_bond, with the atoms moved by the rotation taken from compact
+        """
+        atoms = self.compact.get_moving_atoms(torsional[-2])
+        all_coords = self.atom_group.getCoords()
+        v1,v2 = all_coords[self.compact.get_atoms(torsional[1:-1])]
+        axis = v2-v1
+        c_angle = 0.
+        if absolute:
+            c_angle = self.measure_dihedral_angle(torsional) 
+            theta =  theta - c_angle
+
+        coords = all_coords[atoms]
+        M = rotation_matrix(axis, np.radians(theta))
+        coords = M.dot(coords.transpose())
+        all_coords[atoms] = coords.transpose() + v2 - np.dot(M,v2)
+        self.atom_group.setCoords(all_coords)
+        return c_angle
+
     def get_all_torsional_angles(self):
         """Computes all the torsional angles of the molecule
         Return:
@@ -1007,6 +2121,23 @@ class Molecule:
         
         return angles
 
+    def get_torsional_atoms(self, torsionals = None):
+        """Returns the atom indices (in atom_group) of torsional angles, in the order used by measure_dihedral_angle
+        Parameters:
+            torsionals: list of torsionals (serial numbers). Default torsionals
+        Returns:
+            quadruplets: array (n_torsionals, 4)
+        """
+        if torsionals is None:
+            torsionals = self.torsionals
+        serials = self.atom_group.getSerials()
+        index = np.full(serials.max() + 1, -1, dtype = int)
+        index[serials] = np.arange(len(serials))
+        quadruplets = np.zeros((len(torsionals), 4), dtype = int)
+        for i,t in enumerate(torsionals):
+            quadruplets[i] = index[np.sort(t)][np.argsort(t)]
+        return quadruplets
+
     def measure_dihedral_angle(self, torsional):
         """Calculates dihedral angle for 4 atoms.
         Parameters:
@@ -1022,8 +2153,11 @@ class Molecule:
 #                return -1
 
         idx = np.argsort(torsional)
-        vec_sel = self.atom_group.select('serial ' + ' '.join(map(str, torsional)))
-        c0,c1,c2,c3 = vec_sel.getCoords()[idx, :]
+        if self.compact is not None:
+            c0,c1,c2,c3 = self.atom_group.getCoords()[self.compact.get_atoms(np.sort(torsional))[idx], :]
+        else:
+            vec_sel = self.atom_group.select('serial ' + ' '.join(map(str, torsional)))
+            c0,c1,c2,c3 = vec_sel.getCoords()[idx, :]
         
         q1 = c1 - c0
         q2 = c2 - c1
@@ -1084,20 +2218,489 @@ class Molecule:
 #####################################################################################
 #                                   Builders                                            #
 #####################################################################################
+class ResidueIndex:
+    """Index of the residues of an AtomGroup. Built once, it replaces the selection strings used to look up residues
+    Attributes:
+        atom_group: indexed AtomGroup
+        residue_ids: list of residue ids (segn,chid,resi,icode)
+        residue_names: list of residue names
+        index: dictionary with residue id as key and residue index as value
+        atom_residue: residue index of each atom
+        order: atom indices sorted by residue
+        offsets: atoms of residue i are order[offsets[i]:offsets[i+1]]
+    """
+    prefix = ['segment', 'chain', 'resid', 'icode']
+
+    def __init__(self, atom_group):
+        """
+        Parameters:
+            atom_group: AtomGroup
+        """
+        self.atom_group = atom_group
+        self.natoms = atom_group.numAtoms()
+        n = self.natoms
+        labels = []
+        for values in [atom_group.getSegnames(), atom_group.getChids(), atom_group.getResnums(), atom_group.getIcodes()]:
+            if values is None:
+                values = np.array(['']*n)
+            labels.append(values)
+        segn,chid,resi,ic = labels
+        resnames = atom_group.getResnames()
+        #runs of consecutive atoms from the same residue
+        change = np.ones(n, dtype = bool)
+        for values in labels:
+            change[1:] |= values[1:] != values[:-1]
+        starts = np.flatnonzero(change)
+        self.residue_ids = []
+        self.residue_names = []
+        self.index = {}
+        run_residue = np.empty(len(starts), dtype = int)
+        for k,i in enumerate(starts):
+            res_id = ','.join([segn[i], chid[i], str(resi[i]), ic[i]])
+            if res_id not in self.index:
+                self.index[res_id] = len(self.residue_ids)
+                self.residue_ids.append(res_id)
+                self.residue_names.append(resnames[i])
+            run_residue[k] = self.index[res_id]
+        self.atom_residue = np.repeat(run_residue, np.diff(np.append(starts, n)))
+        self.order = np.argsort(self.atom_residue, kind = 'mergesort')
+        counts = np.bincount(self.atom_residue, minlength = len(self.residue_ids))
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    def is_valid(self, atom_group):
+        """Returns True if the index was built for atom_group
+        """
+        return self.atom_group is atom_group and self.natoms == atom_group.numAtoms()
+
+    def get_indices(self, res_ids):
+        """Returns the sorted atom indices of one or several residues
+        Parameters:
+            res_ids: residue id or list of residue ids (segn,chid,resi,icode)
+        Returns:
+            indices: array of atom indices. None if a residue is not in the index
+        """
+        if isinstance(res_ids, str):
+            res_ids = [res_ids]
+        indices = []
+        for res_id in res_ids:
+            if res_id not in self.index:
+                return None
+            i = self.index[res_id]
+            indices.append(self.order[self.offsets[i]:self.offsets[i+1]])
+        if len(indices) == 1:
+            return indices[0]
+        return np.sort(np.concatenate(indices))
+
+    def get_residue(self, res_id):
+        """Returns a Selection of a residue. Partial ids (e.g. without segname) fall back to a selection string
+        Parameters:
+            res_id: residue id (segn,chid,resi,icode)
+        Returns:
+            residue: Selection (None if residue does not exist)
+        """
+        indices = self.get_indices(res_id)
+        if indices is not None:
+            return self.atom_group[indices]
+        sel = []
+        for p,s in zip(self.prefix, res_id.split(',')):
+            if s:
+                sel.append(p + ' ' + s)
+        return self.atom_group.select(' and '.join(sel))
+
+class AtomGroupBuffer:
+    """Preallocated buffer for assembling a molecule residue by residue. 
+    Atoms deleted by patches are only masked, the AtomGroup is created once all residues have been added
+    Attributes:
+        natoms: number of atoms added to buffer
+        data: dictionary with atomic data label (e.g. Names) as key and preallocated array as value
+        keep: boolean mask of atoms that are not deleted
+        residue_ranges: dictionary with residue id (segn,chid,resi,icode) as key and index range in buffer as value
+    """
+    labels = ['Coords', 'Names', 'Resnums', 'Resnames', 'Chids', 'Segnames', 'Occupancies', 'Betas', 'Serials', 'Icodes', 'Elements', 'Altlocs']
+
+    def __init__(self, size):
+        """
+        Parameters:
+            size: total number of atoms in molecule (e.g. sum of the number of atoms of each residue in topology)
+        """
+        self.size = size
+        self.natoms = 0
+        self.data = {}
+        self.keep = np.ones(size, dtype = bool)
+        self.residue_ranges = {}
+
+    def add_residue(self, residue):
+        """Copies the atoms of a residue to the buffer. The buffer grows if it is too small
+        Parameters:
+            residue: AtomGroup of one residue
+        """
+        n = residue.numAtoms()
+        i0 = self.natoms
+        i1 = i0 + n
+        if i1 > self.size:
+            self.grow(max(i1, 2*self.size))
+        for label in self.labels:
+            values = getattr(residue, 'get' + label)()
+            if values is None:
+                continue
+            if label not in self.data:
+                shape = list(values.shape)
+                shape[0] = self.size
+                self.data[label] = np.zeros(shape, dtype = values.dtype)
+            elif values.dtype.kind == 'S' and values.dtype.itemsize > self.data[label].dtype.itemsize:
+                self.data[label] = self.data[label].astype(values.dtype)
+            self.data[label][i0:i1] = values
+        segn,chid,resi,ic = residue.getSegnames()[0], residue.getChids()[0], residue.getResnums()[0], residue.getIcodes()[0]
+        self.residue_ranges[','.join([segn, chid, str(resi), ic])] = (i0, i1)
+        self.natoms = i1
+
+    def grow(self, size):
+        """Increases the size of the buffer
+        """
+        for label,values in self.data.items():
+            shape = list(values.shape)
+            shape[0] = size
+            new_values = np.zeros(shape, dtype = values.dtype)
+            new_values[:self.size] = values
+            self.data[label] = new_values
+        keep = np.ones(size, dtype = bool)
+        keep[:self.size] = self.keep
+        self.keep = keep
+        self.size = size
+
+    def delete_atoms(self, dele_atoms):
+        """Marks atoms as deleted
+        Parameters:
+            dele_atoms: list of atoms to be deleted. (segn, chid, resi, icode, atom_name)
+        """
+        names = self.data['Names']
+        for a in dele_atoms:
+            res_id,atom_name = a.rsplit(',', 1)
+            if res_id not in self.residue_ranges:
+                continue
+            i0,i1 = self.residue_ranges[res_id]
+            self.keep[i0:i1][names[i0:i1] == atom_name] = False
+
+    def get_atom_group(self, title = 'AtomGroup'):
+        """Creates an AtomGroup with all atoms that were not deleted. Atoms are renumbered from 1
+        Parameters:
+            title: title of AtomGroup
+        Returns:
+            atom_group: AtomGroup
+        """
+        keep = np.flatnonzero(self.keep[:self.natoms])
+        atom_group = AtomGroup(title)
+        atom_group.setCoords(self.data['Coords'][keep])
+        for label in self.labels[1:]:
+            if label in self.data:
+                getattr(atom_group, 'set' + label)(self.data[label][keep])
+        atom_group.setSerials(np.arange(1, len(keep)+1))
+        return atom_group
+
+class StructureWriter:
+    """Writes atoms to a PDB or mmCIF file chunk by chunk, directly from the arrays of the source AtomGroups.
+    Atoms are renumbered continuously over all written AtomGroups, so no merged copy of the structure is needed
+    Attributes:
+        stream: output file
+        file_format: 'pdb' or 'cif'
+        natoms: number of atoms written
+    """
+    chunk_size = 10000
+    pdb_line = '%-6s%5d %-4s%1s%-4s%1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f      %4s%2s\n'
+    pdb_line_hex = '%-6s%5x %-4s%1s%-4s%1s%4d%1s   %8.3f%8.3f%8.3f%6.2f%6.2f      %4s%2s\n'
+    cif_fields = ['group_PDB', 'id', 'type_symbol', 'label_atom_id', 'label_alt_id', 'label_comp_id', 'label_asym_id', 'label_entity_id', 'label_seq_id',
+                  'pdbx_PDB_ins_code', 'Cartn_x', 'Cartn_y', 'Cartn_z', 'occupancy', 'B_iso_or_equiv', 'pdbx_formal_charge', 'auth_seq_id',
+                  'auth_comp_id', 'auth_asym_id', 'auth_atom_id', 'pdbx_PDB_model_num']
+    cif_line = '%s %d %s %s %s %s %s ? %d %s %.3f %.3f %.3f %.2f %.2f ? %d %s %s %s 1\n'
+
+    def __init__(self, filename, file_format = None, title = 'Glycoprotein'):
+        """
+        Parameters:
+            filename: path to output file
+            file_format: 'pdb' or 'cif'. Default guessed from extension of filename (.cif and .mmcif for mmCIF)
+            title: title of structure
+        """
+        if not file_format:
+            file_format = 'pdb'
+            if os.path.splitext(filename)[1].lower() in ['.cif', '.mmcif']:
+                file_format = 'cif'
+        self.file_format = file_format
+        self.natoms = 0
+        self.stream = open(filename, 'w')
+        if file_format == 'cif':
+            self.stream.write('data_%s\n#\nloop_\n' % title.replace(' ', '_'))
+            self.stream.write(''.join(['_atom_site.%s\n' % f for f in self.cif_fields]))
+        else:
+            self.stream.write('REMARK AtomGroup %s\n' % title)
+
+    def write(self, atoms):
+        """Writes all the atoms of an AtomGroup or Selection
+        Parameters:
+            atoms: AtomGroup or Selection
+        """
+        n = atoms.numAtoms()
+        if not n:
+            return
+        #only the chunk being written is copied from the source arrays
+        if isinstance(atoms, AtomGroup):
+            atom_group = atoms
+            indices = np.arange(n)
+        else:
+            atom_group = atoms.getAtomGroup()
+            indices = atoms.getIndices()
+        hetero = atom_group.getFlags('hetatm')
+        if hetero is None:
+            hetero = atom_group.getFlags('hetero')
+        labels = ['Coords', 'Names', 'Altlocs', 'Resnames', 'Chids', 'Resnums', 'Icodes', 'Occupancies', 'Betas', 'Segnames', 'Elements']
+        write = self.write_cif if self.file_format == 'cif' else self.write_pdb
+        for i0 in range(0, n, self.chunk_size):
+            idx = indices[i0:i0 + self.chunk_size]
+            selection = atom_group[idx]
+            chunk = dict([(label, getattr(selection, 'get' + label)()) for label in labels])
+            chunk['Hetero'] = hetero[idx]
+            write(chunk, len(idx))
+
+    def get_column(self, chunk, label, n, default):
+        """Returns a column of a chunk, filled with default if the AtomGroup has no such data
+        """
+        if chunk[label] is None:
+            return [default]*n
+        return chunk[label]
+
+    def write_pdb(self, chunk, n):
+        """Formats and writes a chunk of atoms as PDB records. Serials larger than 99999 are written in hexadecimal (as ProDy)
+        """
+        names = [' ' + a if len(a) < 4 else a for a in chunk['Names']]
+        records = np.where(chunk['Hetero'], 'HETATM', 'ATOM')
+        altlocs = self.get_column(chunk, 'Altlocs', n, '')
+        chids = self.get_column(chunk, 'Chids', n, '')
+        icodes = self.get_column(chunk, 'Icodes', n, '')
+        occupancies = self.get_column(chunk, 'Occupancies', n, 0.)
+        betas = self.get_column(chunk, 'Betas', n, 0.)
+        segnames = self.get_column(chunk, 'Segnames', n, '')
+        elements = [e.rjust(2) for e in self.get_column(chunk, 'Elements', n, '')]
+        lines = []
+        for i,xyz in enumerate(chunk['Coords']):
+            serial = self.natoms + i + 1
+            pdb_line = self.pdb_line if serial <= 99999 else self.pdb_line_hex
+            lines.append(pdb_line % (records[i], serial, names[i], altlocs[i], chunk['Resnames'][i], chids[i], chunk['Resnums'][i], icodes[i],
+                                     xyz[0], xyz[1], xyz[2], occupancies[i], betas[i], segnames[i], elements[i]))
+        self.stream.write(''.join(lines))
+        self.natoms += n
+
+    def write_cif(self, chunk, n):
+        """Formats and writes a chunk of atoms as mmCIF atom_site records. The segname is stored in label_asym_id and the chain in auth_asym_id
+        """
+        records = np.where(chunk['Hetero'], 'HETATM', 'ATOM')
+        names = ['"%s"' % a if "'" in a else a for a in chunk['Names']]
+        altlocs = [a.strip() or '.' for a in self.get_column(chunk, 'Altlocs', n, '')]
+        chids = [c.strip() or '.' for c in self.get_column(chunk, 'Chids', n, '')]
+        segnames = [s.strip() or '.' for s in self.get_column(chunk, 'Segnames', n, '')]
+        icodes = [i.strip() or '?' for i in self.get_column(chunk, 'Icodes', n, '')]
+        elements = [e.strip() or '?' for e in self.get_column(chunk, 'Elements', n, '')]
+        occupancies = self.get_column(chunk, 'Occupancies', n, 0.)
+        betas = self.get_column(chunk, 'Betas', n, 0.)
+        lines = []
+        for i,xyz in enumerate(chunk['Coords']):
+            resname = chunk['Resnames'][i]
+            resnum = chunk['Resnums'][i]
+            lines.append(self.cif_line % (records[i], self.natoms + i + 1, elements[i], names[i], altlocs[i], resname, segnames[i], resnum, icodes[i],
+                                          xyz[0], xyz[1], xyz[2], occupancies[i], betas[i], resnum, resname, chids[i], names[i]))
+        self.stream.write(''.join(lines))
+        self.natoms += n
+
+    def close(self):
+        """Closes the file
+        """
+        if self.file_format == 'cif':
+            self.stream.write('#\n')
+        self.stream.close()
+
+class EnsembleArchive:
+    """Archive of conformers of several molecules (e.g. the glycans of a glycoprotein). The archive is a directory with:
+        header.json: molecules with number of atoms, torsionals and frames
+        <file>.cif: topology (atoms and first conformer) of each molecule
+        <file>.coords: float32 coordinates (n_frames, n_atoms, 3) of each molecule
+        <file>.meta: float32 table (n_frames, 1 + n_torsionals) with the score and the torsional angles of each frame
+    Frames are appended to the end of the files and read through memory maps, so a frame is read without loading the archive
+    Attributes:
+        path: directory of archive
+        mode: 'r' (read), 'a' (append) or 'w' (new archive)
+        header: dictionary with a description of each molecule
+        templates: AtomGroups read from the topology files
+    """
+    version = 1
+
+    def __init__(self, path, mode = 'r'):
+        """
+        Parameters:
+            path: directory of archive
+            mode: 'r' (read), 'a' (append, created if it does not exist) or 'w' (overwrite)
+        """
+        self.path = path
+        self.mode = mode
+        self.templates = {}
+        header = os.path.join(path, 'header.json')
+        if mode != 'w' and os.path.exists(header):
+            with open(header) as f:
+                self.header = json.load(f)
+            self.header['molecules'] = dict([(str(k), v) for k,v in self.header['molecules'].items()])
+        elif mode == 'r':
+            raise IOError('No ensemble archive in ' + path)
+        else:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.header = {'version': self.version, 'molecules': {}}
+            self.write_header()
+
+    def write_header(self):
+        """Writes header.json. It is replaced atomically, so the archive remains readable if a writer is interrupted
+        """
+        fname = os.path.join(self.path, 'header.json')
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.header, f, indent = 1, sort_keys = True)
+        os.rename(fname + '.tmp', fname)
+
+    def get_file(self, key, extension):
+        return os.path.join(self.path, self.header['molecules'][key]['file'] + extension)
+
+    def keys(self):
+        return self.header['molecules'].keys()
+
+    def __contains__(self, key):
+        return key in self.header['molecules']
+
+    def numFrames(self, key):
+        """Returns the number of frames of a molecule
+        """
+        return self.header['molecules'][key]['n_frames']
+
+    def add_molecule(self, key, molecule):
+        """Adds the topology of a molecule. Nothing is done if a molecule with the same key and number of atoms is already in the archive
+        Parameters:
+            key: identifier of molecule (e.g. sequon id)
+            molecule: Molecule
+        """
+        if self.mode == 'r':
+            raise IOError('Ensemble archive is read only')
+        n_atoms = molecule.atom_group.numAtoms()
+        if key in self and self.header['molecules'][key]['n_atoms'] == n_atoms:
+            return
+        if key in self:
+            fname = self.header['molecules'][key]['file']
+        else:
+            fname = 'molecule_%d' % len(self.header['molecules'])
+        self.header['molecules'][key] = {'file': fname, 'name': molecule.name, 'n_atoms': n_atoms, 'n_frames': 0,
+                                         'torsionals': [map(int, t) for t in molecule.torsionals]}
+        writer = StructureWriter(self.get_file(key, '.cif'), 'cif', title = key)
+        try:
+            writer.write(molecule.atom_group)
+        finally:
+            writer.close()
+        for extension in ['.coords', '.meta']:
+            open(self.get_file(key, extension), 'wb').close()
+        self.templates.pop(key, None)
+        self.write_header()
+
+    def append(self, key, coords, scores = None, torsions = None):
+        """Appends frames of a molecule
+        Parameters:
+            key: identifier of molecule (see add_molecule)
+            coords: array (n_frames, n_atoms, 3) or (n_atoms, 3)
+            scores: score of each frame (default 0)
+            torsions: array (n_frames, n_torsionals) of torsional angles (default nan)
+        """
+        if self.mode == 'r':
+            raise IOError('Ensemble archive is read only')
+        molecule = self.header['molecules'][key]
+        coords = np.asarray(coords, dtype = np.float32).reshape(-1, molecule['n_atoms'], 3)
+        n = len(coords)
+        meta = np.full((n, 1 + len(molecule['torsionals'])), np.nan, dtype = np.float32)
+        meta[:, 0] = 0. if scores is None else np.reshape(scores, -1)
+        if torsions is not None:
+            meta[:, 1:] = np.reshape(torsions, (n, -1))
+        with open(self.get_file(key, '.coords'), 'ab') as f:
+            f.write(coords.tostring())
+        with open(self.get_file(key, '.meta'), 'ab') as f:
+            f.write(meta.tostring())
+        molecule['n_frames'] += n
+        self.write_header()
+
+    def append_molecule(self, key, molecule, use_ensemble = True):
+        """Appends the conformers of a molecule with their scores and torsional angles
+        Parameters:
+            key: identifier of molecule
+            molecule: Molecule
+            use_ensemble: append the ensemble of the molecule (see Molecule.add_conformers) if it is not empty. Otherwise the current coordinates are appended
+        """
+        self.add_molecule(key, molecule)
+        coords,scores = molecule.get_ensemble()
+        if not use_ensemble or not len(coords):
+            coords = molecule.atom_group.getCoords()[np.newaxis]
+            scores = [0.]
+        torsions = measure_dihedrals(coords, molecule.get_torsional_atoms(self.header['molecules'][key]['torsionals']))
+        self.append(key, coords, scores, torsions)
+
+    def get_coords(self, key):
+        """Returns a read only memory map (n_frames, n_atoms, 3) of the coordinates of a molecule
+        """
+        molecule = self.header['molecules'][key]
+        if not molecule['n_frames']:
+            return np.zeros((0, molecule['n_atoms'], 3), dtype = np.float32)
+        return np.memmap(self.get_file(key, '.coords'), dtype = np.float32, mode = 'r', shape = (molecule['n_frames'], molecule['n_atoms'], 3))
+
+    def get_metadata(self, key):
+        """Returns a read only memory map (n_frames, 1 + n_torsionals) of the scores and torsional angles of a molecule
+        """
+        molecule = self.header['molecules'][key]
+        shape = (molecule['n_frames'], 1 + len(molecule['torsionals']))
+        if not molecule['n_frames']:
+            return np.zeros(shape, dtype = np.float32)
+        return np.memmap(self.get_file(key, '.meta'), dtype = np.float32, mode = 'r', shape = shape)
+
+    def get_scores(self, key):
+        return np.array(self.get_metadata(key)[:, 0])
+
+    def get_torsions(self, key):
+        """Returns the torsional angles (n_frames, n_torsionals) of a molecule. Torsionals are listed in header['molecules'][key]['torsionals']
+        """
+        return self.get_metadata(key)[:, 1:]
+
+    def get_best_frame(self, key):
+        """Returns the frame with the lowest score
+        """
+        return int(np.argmin(self.get_scores(key)))
+
+    def get_atom_group(self, key, frame = None):
+        """Returns an AtomGroup of a molecule with the coordinates of one frame
+        Parameters:
+            key: identifier of molecule
+            frame: index of frame. Default frame with lowest score
+        """
+        if key not in self.templates:
+            self.templates[key] = read_mmcif(self.get_file(key, '.cif'), title = key)
+        if frame is None:
+            frame = self.get_best_frame(key)
+        atom_group = self.templates[key].copy()
+        atom_group.setCoords(np.array(self.get_coords(key)[frame], dtype = float))
+        return atom_group
+
 class MoleculeBuilder:
     """Class for building/modifying molecule
     """
     
-    def __init__(self, topofile, paramfile, force_field = 'charmm'):
+    def __init__(self, topofile, paramfile, force_field = 'charmm', cache = True, lazy_parameters = False):
         """
         Parameters:
             topofile: path to topology file
             paramfile: path to parameters file
             force_field: force field name. Currently only CHARMM
+            cache: use the binary cache of parsed topology and parameter files
+            lazy_parameters: only parse sections of the parameter file when they are accessed
         """
         if force_field == 'charmm':
-            self.Topology = CHARMMTopology(topofile) 
-            self.Parameters = CHARMMParameters(paramfile)
+            self.Topology = CHARMMTopology(topofile, cache = cache) 
+            self.Parameters = CHARMMParameters(paramfile, cache = cache, lazy = lazy_parameters)
         else:
             print "unknown force field."
 
@@ -1242,7 +2845,7 @@ class MoleculeBuilder:
         """
         unsorted_graph = {}
         required_atoms = []
-        atomsIC = [atom.replace('*', '') for ic in ics for atom in ic[0:4]]
+        atomsIC = set([atom.replace('*', '') for ic in ics for atom in ic[0:4]])
         #Build graph
         for a in atoms:
             if a in atomsIC:
@@ -1277,10 +2880,10 @@ class MoleculeBuilder:
         ics = self.Topology.patches[patch]['IC']
         #patch_atoms = sorted(set([atom.replace('*', '')[1:] for ic in ics for atom in ic[0:4] if atom.replace('*', '')[0]=='2']))
         patch_atoms = sorted(set([atom.replace('*', '') for ic in ics for atom in ic[0:4] if atom.replace('*', '')[0]=='2']))
-        self.build_patch_missing_atom_coord(link_residue, denovo_residue, patch_atoms, ics)
+        self.build_patch_missing_atom_coord(link_residue, denovo_residue, patch_atoms, ics, patch = patch)
         missing_atoms = [a for a in missing_atoms if '2' + a not in patch_atoms]
         ics = self.Topology.topology[resname]['IC']
-        self.build_missing_atom_coord(denovo_residue, missing_atoms, ics)
+        self.build_missing_atom_coord(denovo_residue, missing_atoms, ics, resname = resname)
 
         dele_atoms,b =  self.apply_patch(patch, link_residue, denovo_residue)
         bonds.extend(b)
@@ -1392,21 +2995,20 @@ class MoleculeBuilder:
         #bonds.extend(bonds_p)
         return denovo_residue, dele_atoms, bonds
 
-    def build_patch_missing_atom_coord(self, link_residue, residue, missing_atoms, ICs):
+    def build_patch_missing_atom_coord(self, link_residue, residue, missing_atoms, ICs, patch = None):
         """Builds all missing atoms in residue from a patch linking it to link_residue
         Parameters:
             link_residue: first residue in patch (AtomGroup)
             residue: second residue in patch (AtomGroup)
             missing_atoms: list of missing atom in second residue
             ICs: list of internal coordinate to build missing atoms
+            patch: name of patch (str). If provided, the IC index and build order of the topology are used
         """
-        unsorted_graph,required_atoms = self.build_IC_graph(missing_atoms, ICs)
-        sorted_graph = topological_sort(unsorted_graph)
-        atoms=[g[0] for g in sorted_graph if g[0] in required_atoms]
+        atoms,ICs_index = self.get_build_order(missing_atoms, ICs, self.Topology.patches.get(patch))
         for a in atoms:
             atomname = a[1:]
             atom = residue.select('name ' + atomname)
-            ic = self.Topology.get_IC(ICs, a)
+            ic = ICs_index.get(a, []) if ICs_index is not None else self.Topology.get_IC(ICs, a)
             if ic:
                 ic = ic[0]
                 c = 0
@@ -1418,19 +3020,18 @@ class MoleculeBuilder:
                     c += 1
                 atom.setCoords(self.build_cartesian(xa0, xa1, xa2, ic[8], ic[7], ic[6]))
 
-    def build_missing_atom_coord(self, residue, missing_atoms, ICs):
+    def build_missing_atom_coord(self, residue, missing_atoms, ICs, resname = None):
         """Builds all missing atoms based on the provided internal coordinates
             Parameters:
                 residue: Prody residue (AtomGroup)
                 missing_atoms: list with all missing atom name
                 ICs: list of internal coordinates for building missing atoms
+                resname: name of residue (str). If provided, the IC index and build order of the topology are used
         """
-        unsorted_graph,required_atoms = self.build_IC_graph(missing_atoms, ICs)
-        sorted_graph = topological_sort(unsorted_graph)
-        atoms=[g[0] for g in sorted_graph if g[0] in required_atoms]
+        atoms,ICs_index = self.get_build_order(missing_atoms, ICs, self.Topology.topology.get(resname))
         for a in atoms:
             atom = residue.select('name ' +a)
-            ic = self.Topology.get_IC(ICs, a)
+            ic = ICs_index.get(a, []) if ICs_index is not None else self.Topology.get_IC(ICs, a)
             if ic:
                 ic = ic[0]
                 xa1 = residue.select('name ' + ic[0]).getCoords()[0]
@@ -1438,6 +3039,23 @@ class MoleculeBuilder:
                 xa3 = residue.select('name ' + ic[2].replace('*', '')).getCoords()[0]
                 atom.setCoords(self.build_cartesian(xa1, xa2, xa3, ic[8], ic[7], ic[6]))    
 
+    def get_build_order(self, missing_atoms, ICs, topo = None):
+        """Returns the order in which missing atoms should be built
+            Parameters:
+                missing_atoms: list with all missing atom name
+                ICs: list of internal coordinates for building missing atoms
+                topo: dictionary of residue or patch from Topology, indexed by CHARMMTopology.index_ICs
+            Returns:
+                atoms: sorted list of atoms to build
+                ICs_index: dictionary with atom name as key and its ICs as value. None if topo is not indexed
+        """
+        if topo and 'IC_index' in topo and topo['IC'] is ICs:
+            return self.Topology.get_IC_order(topo, missing_atoms),topo['IC_index']
+        unsorted_graph,required_atoms = self.build_IC_graph(missing_atoms, ICs)
+        sorted_graph = topological_sort(unsorted_graph)
+        atoms=[g[0] for g in sorted_graph if g[0] in required_atoms]
+        return atoms,None
+
     def build_cartesian(self, a1, a2, a3, r, theta, phi):
         """Builds missing atom from internal coordinates
             Parameters:
@@ -1481,17 +3099,330 @@ class MoleculeBuilder:
 #####################################################################################
 #                                Glycosylator                                        #
 #####################################################################################
+class GlycanLibraryIndex:
+    """Search index over a library of glycans described by unit keys ('resname patch1 patch2 ...', see Glycosylator.build_keys)
+    Attributes:
+        units: inverted index with unit key as key and set of glycan names as value
+        glycan_keys: dictionary with glycan name as key and set of unit keys as value
+    """
+    def __init__(self):
+        self.units = {}
+        self.glycan_keys = {}
+
+    def add(self, name, keys):
+        """Adds a glycan to the index
+        Parameters:
+            name: name of glycan
+            keys: list of unit keys
+        """
+        keys = set(keys)
+        self.glycan_keys[name] = keys
+        for key in keys:
+            self.units.setdefault(key, set()).add(name)
+
+    def remove(self, name, keys):
+        """Removes a glycan from the index
+        Parameters:
+            name: name of glycan
+            keys: list of unit keys used to add the glycan
+        """
+        self.glycan_keys.pop(name, None)
+        for key in set(keys):
+            self.units.get(key, set()).discard(name)
+
+    def supersets(self, keys):
+        """Returns the glycans that contain all the units of a (possibly truncated) glycan. Posting lists are intersected from the smallest one
+        Parameters:
+            keys: list of unit keys
+        Returns:
+            set of glycan names
+        """
+        postings = sorted([self.units.get(key, set()) for key in set(keys)], key = len)
+        if not postings or not postings[0]:
+            return set()
+        names = set(postings[0])
+        for p in postings[1:]:
+            names &= p
+            if not names:
+                break
+        return names
+
+    def nearest(self, keys, k = 5):
+        """Returns the k glycans sharing the most units with a glycan. Ties are broken by the number of units that differ.
+        Posting lists are read from the rarest unit. A glycan that is not in the lists read so far can share at most the remaining units, 
+        so the search stops as soon as k glycans share more units. The common units (e.g. the root unit, shared by all glycans) are then never read
+        Parameters:
+            keys: list of unit keys
+            k: number of glycans
+        Returns:
+            list of (glycan name, number of shared units, number of differing units)
+        """
+        keys = set(keys)
+        postings = sorted([self.units[key] for key in keys if self.units.get(key)], key = len)
+        scores = {}
+        for i,p in enumerate(postings):
+            for name in p:
+                if name not in scores:
+                    n = len(keys & self.glycan_keys[name])
+                    scores[name] = (-n, len(self.glycan_keys[name]) + len(keys) - 2*n, name)
+            #unread glycans share at most the units of the remaining posting lists
+            if len(scores) >= k and -heapq.nsmallest(k, scores.values())[-1][0] > len(postings) - i - 1:
+                break
+        return [(name, -n, d) for n,d,name in heapq.nsmallest(k, scores.values())]
+
+class GlycanLibrary:
+    """SQLite store of glycan connectivity topologies.
+    Glycans are kept in the table glycans (glycan_name, glycan_tree), as in previous versions, and indexed in glycan_index by name, canonical hash, number of units and residue composition.
+    Glycans are only read from the database when they are requested.
+    A library opened as readonly is never modified. If it has no (or an outdated) glycan_index, the index is built in memory when it is first searched.
+    upgrade() adds the index to a library written by previous versions.
+    Attributes:
+        filename: path to database
+        conn: sqlite3 connection
+        readonly: library is not modified
+        indexed: glycan_index is present and up to date
+    """
+    def __init__(self, filename, readonly = False):
+        """
+        Parameters:
+            filename: path to database. Created if it does not exist and readonly is False
+            readonly: open without creating tables or indices (see upgrade)
+        """
+        self.filename = filename
+        self.readonly = readonly
+        self.index_rows = None
+        if readonly and not os.path.isfile(filename):
+            raise sqlite3.OperationalError('unable to open database file ' + filename)
+        self.conn = sqlite3.connect(filename)
+        if readonly:
+            self.indexed = self.is_indexed()
+        else:
+            self.upgrade()
+
+    def is_indexed(self):
+        """Returns True if glycan_index exists and indexes every glycan
+        """
+        c = self.conn
+        if not c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'glycan_index'").fetchone():
+            return False
+        return len(self) == c.execute("SELECT COUNT(*) FROM glycan_index").fetchone()[0]
+
+    def upgrade(self):
+        """Creates the tables and indices. Glycans of libraries written by previous versions are indexed and duplicated names are removed (the last one is kept)
+        """
+        self.check_writable()
+        c = self.conn
+        c.execute("CREATE TABLE IF NOT EXISTS glycans (glycan_name text, glycan_tree text)")
+        if not c.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name = 'glycans_name'").fetchone():
+            #old libraries can contain duplicated names
+            c.execute("DELETE FROM glycans WHERE rowid NOT IN (SELECT MAX(rowid) FROM glycans GROUP BY glycan_name)")
+            c.execute("CREATE UNIQUE INDEX glycans_name ON glycans (glycan_name)")
+        c.execute("CREATE TABLE IF NOT EXISTS glycan_index (glycan_name text PRIMARY KEY, glycan_hash text, n_units integer, composition text)")
+        for column in ['glycan_hash', 'n_units', 'composition']:
+            c.execute("CREATE INDEX IF NOT EXISTS glycan_index_{0} ON glycan_index ({0})".format(column))
+        if len(self) != c.execute("SELECT COUNT(*) FROM glycan_index").fetchone()[0]:
+            rows = c.execute("SELECT glycan_name, glycan_tree FROM glycans WHERE glycan_name NOT IN (SELECT glycan_name FROM glycan_index)")
+            c.executemany("INSERT OR REPLACE INTO glycan_index VALUES (?, ?, ?, ?)", [self.get_index_row(name, self.parse_tree(tree)) for name,tree in rows])
+            c.execute("DELETE FROM glycan_index WHERE glycan_name NOT IN (SELECT glycan_name FROM glycans)")
+        c.commit()
+        self.indexed = True
+        self.index_rows = None
+
+    def check_writable(self):
+        if self.readonly:
+            raise sqlite3.OperationalError('glycan library ' + self.filename + ' was opened as readonly')
+
+    def parse_tree(self, tree):
+        """Converts a glycan tree string ('resname atom patch1 patch2|...') to a connectivity topology
+        """
+        residue = {'UNIT': []}
+        for unit in tree.split('|'):
+            unit = unit.split()
+            if len(unit) > 2:
+                residue['UNIT'].append([unit[0], unit[1], unit[2:]])
+            else:
+                residue['UNIT'].append([unit[0], ' ', []])
+        residue['#UNIT'] = len(residue['UNIT'])
+        return residue
+
+    def format_tree(self, connect_topology):
+        """Converts a connectivity topology to a glycan tree string
+        """
+        glycan = []
+        for unit in connect_topology['UNIT']:
+            v = []
+            v.extend(unit[0:2])
+            v.extend(unit[2])
+            glycan.append(' '.join(v))
+        return '|'.join(glycan)
+
+    def get_index_row(self, name, connect_topology):
+        """Returns the indexed columns of a glycan: name, canonical hash, number of units and residue composition ('BMA:1,MAN:3,NAG:2')
+        """
+        resnames = defaultdict(int)
+        for unit in connect_topology['UNIT']:
+            resnames[unit[0]] += 1
+        composition = ','.join(['%s:%d' % (rn, n) for rn,n in sorted(resnames.items())])
+        return name, glycan_hash(get_unit_keys(connect_topology)), len(connect_topology['UNIT']), composition
+
+    def upsert(self, glycans, batch_size = 1000):
+        """Adds or replaces glycans in one transaction. Other glycans of the library are kept
+        Parameters:
+            glycans: list of (name, connectivity topology)
+            batch_size: number of glycans per executemany
+        """
+        self.check_writable()
+        with self.conn:
+            self.insert(glycans, batch_size)
+        self.index_rows = None
+
+    def replace(self, glycans, batch_size = 1000):
+        """Replaces all glycans of the library in one transaction
+        Parameters:
+            glycans: list of (name, connectivity topology)
+            batch_size: number of glycans per executemany
+        """
+        self.check_writable()
+        with self.conn:
+            self.conn.execute("DELETE FROM glycans")
+            self.conn.execute("DELETE FROM glycan_index")
+            self.insert(glycans, batch_size)
+        self.index_rows = None
+
+    def insert(self, glycans, batch_size):
+        c = self.conn
+        glycans = list(glycans)
+        for i in range(0, len(glycans), batch_size):
+            batch = glycans[i:i + batch_size]
+            c.executemany("INSERT OR REPLACE INTO glycans VALUES (?, ?)", [(name, self.format_tree(g)) for name,g in batch])
+            c.executemany("INSERT OR REPLACE INTO glycan_index VALUES (?, ?, ?, ?)", [self.get_index_row(name, g) for name,g in batch])
+
+    def delete(self, names):
+        """Removes glycans from the library
+        """
+        self.check_writable()
+        with self.conn:
+            self.conn.executemany("DELETE FROM glycans WHERE glycan_name = ?", [(n,) for n in names])
+            self.conn.executemany("DELETE FROM glycan_index WHERE glycan_name = ?", [(n,) for n in names])
+        self.index_rows = None
+
+    def get(self, name):
+        """Returns the connectivity topology of a glycan (None if it is not in the library)
+        """
+        row = self.conn.execute("SELECT glycan_tree FROM glycans WHERE glycan_name = ? ORDER BY rowid DESC LIMIT 1", (name,)).fetchone()
+        if row is None:
+            return None
+        return self.parse_tree(str(row[0]))
+
+    def names(self):
+        """Returns the names of all glycans
+        """
+        return [str(r[0]) for r in self.conn.execute("SELECT DISTINCT glycan_name FROM glycans")]
+
+    def items(self):
+        """Iterates over (name, connectivity topology) of all glycans. For duplicated names (libraries of previous versions), the last glycan is returned
+        """
+        for name,tree in self.conn.execute("SELECT glycan_name, glycan_tree FROM glycans WHERE rowid IN (SELECT MAX(rowid) FROM glycans GROUP BY glycan_name)"):
+            yield str(name), self.parse_tree(str(tree))
+
+    def find(self, glycan_hash = None, n_units = None, composition = None):
+        """Returns the names of the glycans matching all given indexed columns
+        Parameters:
+            glycan_hash: canonical hash (see glycan_hash)
+            n_units: number of units
+            composition: residue composition ('BMA:1,MAN:3,NAG:2')
+        """
+        columns = [('glycan_hash', glycan_hash), ('n_units', n_units), ('composition', composition)]
+        if not self.indexed:
+            if self.index_rows is None:
+                self.index_rows = [self.get_index_row(name, g) for name,g in self.items()]
+            return [r[0] for r in self.index_rows if all([v is None or r[i+1] == v for i,(c,v) in enumerate(columns)])]
+        conditions = []
+        values = []
+        for column,value in columns:
+            if value is not None:
+                conditions.append(column + ' = ?')
+                values.append(value)
+        query = "SELECT glycan_name FROM glycan_index"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return [str(r[0]) for r in self.conn.execute(query, values)]
+
+    def __contains__(self, name):
+        return self.conn.execute("SELECT 1 FROM glycans WHERE glycan_name = ?", (name,)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(DISTINCT glycan_name) FROM glycans").fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+class LazyConnectTopology(dict):
+    """Dictionary of connectivity topologies in which glycans are read from a GlycanLibrary on first access
+        Attributes:
+            library: GlycanLibrary
+    """
+    def __init__(self, library):
+        dict.__init__(self)
+        self.library = library
+
+    def __missing__(self, name):
+        glycan = self.library.get(name)
+        if glycan is None:
+            raise KeyError(name)
+        dict.__setitem__(self, name, glycan)
+        return glycan
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self.library
+
+    def get(self, name, default = None):
+        if name in self:
+            return self[name]
+        return default
+
+    def load_all(self):
+        """Reads all glycans that have not been accessed yet
+        """
+        for name,glycan in self.library.items():
+            if not dict.__contains__(self, name):
+                dict.__setitem__(self, name, glycan)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(set(dict.keys(self)) | set(self.library.names()))
+
+    def keys(self):
+        return list(set(dict.keys(self)) | set(self.library.names()))
+
+    def values(self):
+        self.load_all()
+        return dict.values(self)
+
+    def items(self):
+        self.load_all()
+        return dict.items(self)
+
 class Glycosylator:
-    def __init__(self, topofile, paramfile, force_field = 'charmm'):
+    def __init__(self, topofile, paramfile, force_field = 'charmm', cache = True, lazy_parameters = False, glycan_cache_size = 32):
         """
         Parameters:
             topofile: path to topology file
             paramfile: path to parameter file
             force_field: name of force field. Default charmm
+            cache: use the binary cache of parsed topology and parameter files
+            lazy_parameters: only parse sections of the parameter file when they are accessed (e.g. DIHEDRALS and NONBONDED for sampling)
+            glycan_cache_size: maximum number of built glycans kept for reuse by glycosylate. 0 disables the cache
         Initializes:
             builder: MoleculeBuilder
             connect_topology: dictionary describing the topology of known glycans
             glycan_keys: dictionary for identifying glycans (built from connect_topology) 
+            glycan_hashes: dictionary with canonical hash of glycan_keys as key and list of glycan names as value
+            glycan_index: GlycanLibraryIndex of glycan_keys for substructure and nearest-match search
+            glycan_library: GlycanLibrary from which connect_topology is lazily read (see import_connectivity_topology)
+            glycan_library_indexed: all glycans of glycan_library are in glycan_index (see index_glycan_library)
             glycoprotein: Atomgroup representing the glycoprotein
             protein: Atomgroup without the identified glycans
             sequences: dictionary with protein chain as keys and sequences as value
@@ -1499,11 +3430,17 @@ class Glycosylator:
             glycanMolecules: dictionary with protein residue as keys and Molecules instances as values
             glycans: dictionary with protein residue as keys and graph of connected glycan as values
             names: dictionary of residue names for linked glycans
+            residue_index: ResidueIndex of glycoprotein
+            glycan_cache: built glycans (local frame) with connectivity tree, link patch and anchor atoms as keys. Least recently used glycans are evicted
         """
         self.topofile = topofile
-        self.builder = MoleculeBuilder(topofile, paramfile)
+        self.builder = MoleculeBuilder(topofile, paramfile, force_field, cache = cache, lazy_parameters = lazy_parameters)
         self.connect_topology = {}
         self.glycan_keys = {}
+        self.glycan_hashes = {}
+        self.glycan_index = GlycanLibraryIndex()
+        self.glycan_library = None
+        self.glycan_library_indexed = False
         self.glycoprotein = None 
         self.protein = None
         self.sequences = {}
@@ -1511,7 +3448,10 @@ class Glycosylator:
         self.glycanMolecules = {}
         self.glycans = {}
         self.names = {}
+        self.residue_index = None
         self.prefix = ['segment', 'chain', 'resid', 'icode']
+        self.glycan_cache = OrderedDict()
+        self.glycan_cache_size = glycan_cache_size
     
     def init_glycoprotein(self):
         """Initializes all the variables
@@ -1523,6 +3463,7 @@ class Glycosylator:
         self.glycanMolecules = {}
         self.glycans = {}
         self.names = {}
+        self.residue_index = None
 
 
     def read_connectivity_topology(self, connectfile):
@@ -1539,6 +3480,7 @@ class Glycosylator:
         lines = readLinesFromFile(connectfile)
         residue = {}
         self.connect_topology = {}
+        self.glycan_library = None
         nbr_units = 0
         for line in lines:                                                             # Loop through each line 
             line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
@@ -1557,38 +3499,31 @@ class Glycosylator:
         self.connect_topology[resname] = copy.copy(residue)
         self.build_keys()
     
-    def import_connectivity_topology(self, filename):
-        """Import connectivity topology from sql database
-        This function will initialize connect_topology
+    def import_connectivity_topology(self, filename, lazy = False):
+        """Import connectivity topology from sql database (see GlycanLibrary)
+        This function will initialize connect_topology. The database is opened as readonly and is not modified
         Parameters:
             filename: path to database
+            lazy: glycans are only read from the database when they are accessed or identified. 
+                  glycan_keys and glycan_index then only contain the glycans that have been read, until a search reads the keys of all glycans (see index_glycan_library)
         """
         try:
-            conn = sqlite3.connect(filename)
-        except:
+            library = GlycanLibrary(filename, readonly = True)
+        except sqlite3.Error:
             print "Error while connecting to the database " + filename
             return -1
-        cursor =  conn.cursor()
-        cursor.execute("SELECT * FROM glycans")
-        glycans = cursor.fetchall()
-
-        self.connect_topology = {}
-        for glycan in glycans:
-            name,tree =  glycan
-            residue = {}
-            residue['UNIT'] = []
-            nbr_unit = 0
-            for unit in tree.split('|'):
-                unit = unit.split(' ')
-                nbr_unit += 1
-                if len(unit) > 2:
-                    residue['UNIT'].append([unit[0],unit[1], unit[2:]])
-                else:
-                    residue['UNIT'].append([unit[0], ' ', []])
-                
-            residue['#UNIT'] = nbr_unit
-            self.connect_topology[name] = residue
-        self.build_keys()
+        if lazy:
+            self.glycan_library = library
+            self.glycan_library_indexed = False
+            self.connect_topology = LazyConnectTopology(library)
+            self.glycan_keys = {}
+            self.glycan_hashes = {}
+            self.glycan_index = GlycanLibraryIndex()
+        else:
+            self.glycan_library = None
+            self.connect_topology = dict(library.items())
+            library.close()
+            self.build_keys()
 
     def add_glycan_to_connectivity_topology(self, name, connect_tree, overwrite = True):
         """Add new glycan to connect_topology dictionary
@@ -1601,43 +3536,71 @@ class Glycosylator:
             print "Glycan with same name " + name + "already exists. Please change name or allow overwritting"
             return -1
         self.connect_topology[name] = connect_tree
+        self.add_glycan_key(name)
     
-    def export_connectivity_topology(self, filename):
-        """Export connectivity topology to sql database
-        This function will 
+    def export_connectivity_topology(self, filename, replace = True):
+        """Export connectivity topology to sql database (see GlycanLibrary)
+        Parameters:
+            filename: path to database
+            replace: the database only contains the glycans of connect_topology, as in previous versions. 
+                    Otherwise glycans are added to the database or replace glycans with the same name, and other glycans are kept
         """
         try:
-            conn = sqlite3.connect(filename)
-        except:
+            library = GlycanLibrary(filename)
+        except sqlite3.Error:
             print "Error while connecting to the database " + filename
             return -1
-        cursor =  conn.cursor()
-        tn = 'glycans'
-        gn = 'glycan_name'
-        gt = 'glycan_tree'
-        cursor.execute("DROP TABLE IF EXISTS {tn}".format(tn = tn))
-        cursor.execute("CREATE TABLE {tn} ({gn} text, {gt} text)".format(tn =  tn, gn = gn, gt = gt))
-
-        for key in self.connect_topology.keys():
-            units = self.connect_topology[key]['UNIT']
-            glycan = []
-            for unit in units:
-                v = []
-                v.extend(unit[0:2])
-                v.extend(unit[2])
-                glycan.append(' '.join(v))
-            glycan = '|'.join(glycan)
-            
-            cursor.execute("INSERT INTO {tn} VALUES (\'{gn}\', \'{gt}\')".format(tn = tn, gn = key, gt = glycan))
-
-        conn.commit()
-        conn.close()
+        if replace:
+            library.replace(self.connect_topology.items())
+        else:
+            library.upsert(self.connect_topology.items())
+        library.close()
     
     def build_keys(self):
+        """Builds the unit keys (resname and patch path) of each glycan in connect_topology and indexes them by their canonical hash
+        """
         self.glycan_keys = {}
+        self.glycan_hashes = {}
+        self.glycan_index = GlycanLibraryIndex()
         for res in self.connect_topology:
-            key = [r[0]+' '+' '.join(r[2]) for r in self.connect_topology[res]['UNIT']]
-            self.glycan_keys[res] = key
+            self.add_glycan_key(res)
+
+    def index_glycan_library(self):
+        """Adds the keys of all the glycans of a lazily loaded library (see import_connectivity_topology) to glycan_keys, glycan_hashes and glycan_index.
+        The library is read once; the glycans are not added to connect_topology
+        """
+        if self.glycan_library is None or self.glycan_library_indexed:
+            return
+        for name,connect_tree in self.glycan_library.items():
+            if name not in self.glycan_keys:
+                self.add_glycan_key(name, connect_tree)
+        self.glycan_library_indexed = True
+
+    def add_glycan_key(self, name, connect_tree = None):
+        """Adds or updates the keys of a glycan from connect_topology in glycan_keys and glycan_hashes
+        Parameters:
+            name: name of glycan
+            connect_tree: connectivity tree of glycan. Default connect_topology[name]
+        """
+        if name in self.glycan_keys:
+            names = self.glycan_hashes[self.get_glycan_hash(self.glycan_keys[name])]
+            names.remove(name)
+            self.glycan_index.remove(name, self.glycan_keys[name])
+        if connect_tree is None:
+            connect_tree = self.connect_topology[name]
+        key = get_unit_keys(connect_tree)
+        self.glycan_keys[name] = key
+        self.glycan_hashes.setdefault(self.get_glycan_hash(key), []).append(name)
+        self.glycan_index.add(name, key)
+
+    def get_glycan_hash(self, keys):
+        """Returns the canonical hash of a glycan (see glycan_hash)
+        Parameters:
+            keys: list of unit keys ('resname patch1 patch2 ...')
+        Returns:
+            hash (str)
+        """
+        return glycan_hash(keys)
 
     def read_unit(self, unit, residue):
         if len(unit)>2:
@@ -1670,12 +3633,19 @@ class Glycosylator:
     def load_glycoprotein(self, protein):
         """Load and detects glycans in a glycoprotein
         Parameters:
-            protein: Atomgroup of 
+            protein: Atomgroup of glycoprotein or path to a PDB or mmCIF (.cif, .mmcif) file. IOError is raised if no atoms can be read from the file
         """
         self.init_glycoprotein()
         if type(protein) == str:
-            protein = parsePDB(protein)
+            fileName = protein
+            if os.path.splitext(fileName)[1].lower() in ['.cif', '.mmcif']:
+                protein = read_mmcif(fileName)
+            else:
+                protein = parsePDB(fileName)
+            if protein is None:
+                raise IOError('No atoms could be read from ' + fileName)
         self.glycoprotein = protein
+        self.residue_index = ResidueIndex(self.glycoprotein)
         sel  = self.glycoprotein.select('name CA')
         segn = sel.getSegnames()
         chids = sel.getChids()
@@ -1705,91 +3675,101 @@ class Glycosylator:
         self.extract_glycans()
 
     def save_glycoprotein(self, filename):
-        """Saves glycoprotein to PDB file
+        """Saves glycoprotein (protein and all glycans) to PDB file
         Parameter:
             filename: path 
         """
-        glycosylated_protein = self.protein.copy()
-        count = 0
-        for g in self.glycanMolecules.values():
-            glycosylated_protein += g.atom_group
-            count += 1
-            if count > 5:
-                break
-            
-        writePDB(filename, glycosylated_protein)
+        self.write_glycoprotein(filename, file_format = 'pdb')
     
-    def write_glycoprotein(self, filename):
-        """Numpy array requires a continous memory block. When merging several atomGroup, the memory explodes. This function will alocate the memory first and then transfer propreties of AtomGroup
+    def write_glycoprotein(self, filename, file_format = None):
+        """Writes the protein and all the glycans with StructureWriter. Atoms are streamed chunk by chunk from each AtomGroup, so the glycoprotein is never merged in memory.
+        Glycans are written in sequon order (see get_sequon_order)
+        Parameters:
+            filename: path to output file
+            file_format: 'pdb' or 'cif'. Default guessed from extension of filename
         """
-        natoms = self.protein.numAtoms()
-        for g in self.glycanMolecules.values():
-            natoms += g.atom_group.numAtoms()
+        writer = StructureWriter(filename, file_format)
+        try:
+            writer.write(self.protein)
+            for k in self.get_sequon_order(self.glycanMolecules.keys()):
+                writer.write(self.glycanMolecules[k].atom_group)
+        finally:
+            writer.close()
+
+    def get_sequon_order(self, sequon_ids):
+        """Sorts sequon ids by the position of their residue in the glycoprotein. Ids that are not in the glycoprotein follow, sorted by segname, chain, resid and icode
+        Parameters:
+            sequon_ids: list of sequon ids (segname,chain,resid,icode)
+        Returns:
+            sorted list of sequon ids
+        """
+        def position(sequon_id):
+            if self.residue_index is not None and sequon_id in self.residue_index.index:
+                return (0, self.residue_index.index[sequon_id])
+            values = sequon_id.split(',')
+            if len(values) > 2 and values[2].lstrip('-').isdigit():
+                values[2] = int(values[2])
+            return (1, values)
+        return sorted(sequon_ids, key = position)
         
-        coords = np.zeros((natoms,3))
-        resn = []
-        resi = []
-        atoms_name = []
-        chid = []
-        segn = []
-        occupancy = []
-        beta = []
-        serial = []
-        element = []
-        icode = []
-        altloc = []
+    def write_ensemble_archive(self, path, mode = 'a'):
+        """Appends the conformers (ensemble or current coordinates) of all glycans to an EnsembleArchive, with sequon ids as keys
+        Parameters:
+            path: directory of archive
+            mode: 'a' (append) or 'w' (overwrite)
+        Returns:
+            archive: EnsembleArchive
+        """
+        archive = EnsembleArchive(path, mode)
+        for k,g in self.glycanMolecules.items():
+            archive.append_molecule(k, g)
+        return archive
 
-        #inilizalize variable
-        ag = self.protein
-        natoms = ag.numAtoms()
-        coords[0:natoms, :] = ag.getCoords()
-        atoms_name += list(ag.getNames())
-        resn += list(ag.getResnames())
-        resi += list(ag.getResnums())
-        chid += list(ag.getChids())
-        segn += list(ag.getSegnames())
-        occupancy += list(ag.getOccupancies())
-        beta += list(ag.getBetas())
-        serials = range(1, natoms+1)
-        serial += serials
-        icode += list(ag.getIcodes())
-        element += list(ag.getElements())
-        altloc += list(ag.getAltlocs())
+    def get_archived_glycans(self, archive, frames = None):
+        """Returns the glycans of one frame of an EnsembleArchive. Only the requested frames are read from the archive
+        Parameters:
+            archive: EnsembleArchive or path to archive
+            frames: index of frame for all glycans, or dictionary with sequon id as key and frame as value. Default frame with lowest score
+        Returns:
+            glycans: list of AtomGroups. Glycans without frames in the archive are taken from glycanMolecules
+        """
+        if type(archive) == str:
+            archive = EnsembleArchive(archive)
+        glycans = []
+        for k in sorted(set(self.glycanMolecules.keys()) | set(archive.keys())):
+            if k in archive and archive.numFrames(k):
+                if type(frames) == dict:
+                    frame = frames.get(k)
+                else:
+                    frame = frames
+                glycans.append(archive.get_atom_group(k, frame))
+            else:
+                glycans.append(self.glycanMolecules[k].atom_group)
+        return glycans
+
+    def get_archived_glycoprotein(self, archive, frames = None):
+        """Assembles the protein and the glycans of one frame of an EnsembleArchive (see get_archived_glycans)
+        Returns:
+            glycoprotein: AtomGroup
+        """
+        return concatenate_atom_groups([self.protein] + self.get_archived_glycans(archive, frames), title = 'glycoprotein')
+
+    def write_archived_glycoprotein(self, archive, filename, frames = None, file_format = None):
+        """Writes the protein and the glycans of one frame of an EnsembleArchive with StructureWriter (see get_archived_glycans)
+        Parameters:
+            archive: EnsembleArchive or path to archive
+            filename: path to output file
+            frames: index of frame for all glycans, or dictionary with sequon id as key and frame as value. Default frame with lowest score
+            file_format: 'pdb' or 'cif'. Default guessed from extension of filename
+        """
+        writer = StructureWriter(filename, file_format)
+        try:
+            writer.write(self.protein)
+            for g in self.get_archived_glycans(archive, frames):
+                writer.write(g)
+        finally:
+            writer.close()
 
-        for g in self.glycanMolecules.values():
-            ag = g.atom_group
-            nnatoms = natoms+ag.numAtoms()
-            coords[natoms:nnatoms, :] = ag.getCoords()
-            resn += list(ag.getResnames())
-            resi += list(ag.getResnums())
-            chid += list(ag.getChids())
-            segn += list(ag.getSegnames())
-            occupancy += list(ag.getOccupancies())
-            beta += list(ag.getBetas())
-            atoms_name += list(ag.getNames())
-            serials = range(natoms+1, nnatoms+1)
-            serial += serials
-            icode += list(ag.getIcodes())
-            element += list(ag.getElements())
-            altloc += list(ag.getAltlocs())
-            natoms = nnatoms
-
-        glycoprotein = AtomGroup('Glycoprotein')
-        glycoprotein.setCoords(coords)
-
-        glycoprotein.setNames(atoms_name)
-        glycoprotein.setResnums(resi)
-        glycoprotein.setResnames(resn)
-        glycoprotein.setChids(chid)
-        glycoprotein.setSegnames(segn)
-        glycoprotein.setOccupancies(occupancy)
-        glycoprotein.setBetas(beta)
-        glycoprotein.setSerials(serial)
-        glycoprotein.setIcodes(icode)
-        glycoprotein.setElements(element)
-        glycoprotein.setAltlocs(altloc)
-        writePDB(filename, glycoprotein)
-        
     def write_psfgen(self, dirName, proteinName=None):
         """ This function will create the configure file for psfgen. The glycans will be split from the rest of the structure.
         It will be assumed that the topology file for the protein has already been previously built. Each glycan will be saved to a seperate file
@@ -1859,12 +3839,7 @@ class Glycosylator:
     def get_residue(self, res_id):
         """Returns an AtomGroup of given atom id; composed of 'segname,chain,resid,icode,atomName'
         """
-        sel = []
-        for p,s in zip(self.prefix, res_id.split(',')):
-            if s:
-                sel .append(p + ' ' + s)
-        sel = ' and '.join(sel)
-        return self.glycoprotein.select(sel)
+        return self.residue_index.get_residue(res_id)
 
     def getSequence(self, sel):
         res =  sel.getResnames()
@@ -1906,6 +3881,29 @@ class Glycosylator:
             sequons[','.join([segn[idx], chid[idx], str(res[idx]), icodes[idx]])] = m.group()
         return sequons
     
+    def find_contacts(self, link_atoms = None, cutoff = 1.7):
+        """Finds the contacts between atoms of different residues. Only heteroatoms (not protein) and link atoms are searched
+        Parameters:
+            link_atoms: boolean mask of protein atoms that can be linked to a glycan (e.g. ND2 of ASN)
+            cutoff: distance cutoff (default 1.7A)
+        Returns:
+            contacts: array (n, 2) of glycoprotein atom indices
+        """
+        mask = ~self.glycoprotein.getFlags('protein')
+        if link_atoms is not None:
+            mask |= link_atoms
+        indices = np.flatnonzero(mask)
+        if len(indices) < 2:
+            return np.zeros((0, 2), dtype = int)
+        kd = KDTree(self.glycoprotein.getCoords()[indices])
+        kd.search(cutoff)
+        pairs = kd.getIndices()
+        if pairs is None:
+            return np.zeros((0, 2), dtype = int)
+        contacts = indices[np.array(pairs).reshape(-1, 2)]
+        residues = self.residue_index.atom_residue[contacts]
+        return contacts[residues[:, 0] != residues[:, 1]]
+
     def find_glycans(self, patch, resname):
         """Looks from all molecules (not protein) which are linked (1.7A) to residue
             Parameters:
@@ -1922,25 +3920,20 @@ class Glycosylator:
             else:
                 a2 = a[1:]
         #a2 is assumed to be the glycan atoms and a1 from protein
-        sel = self.glycoprotein.select('(not protein and name %s) or (resname %s and name %s)' % (a2,resname,a1))
-        kd = KDTree(sel.getCoords())
-        kd.search(1.7)
-        atoms = kd.getIndices()
-        if atoms is None:
+        atom_names = self.glycoprotein.getNames()
+        link_atoms = (self.glycoprotein.getResnames() == resname) & (atom_names == a1)
+        #contacts are shared with connect_all_glycans
+        contacts = self.find_contacts(link_atoms)
+        linker = link_atoms | (~self.glycoprotein.getFlags('protein') & (atom_names == a2))
+        link_contacts = contacts[linker[contacts[:, 0]] & linker[contacts[:, 1]]]
+        if not len(link_contacts):
             return {}, {}
         G = nx.Graph()
-        ids,rn = self.get_ids(sel) 
-        for a1,a2 in atoms:
-            id1 = ids[a1]
-            rn1 = rn[a1]
-            id2 = ids[a2]
-            rn2 = rn[a2]
-            
-            if id1 != id2:
-                e = (id1, id2)
-                G.add_edge(*e)
+        ids = self.residue_index.residue_ids
+        for r1,r2 in self.residue_index.atom_residue[link_contacts]:
+            G.add_edge(ids[r1], ids[r2])
                 
-        names = self.connect_all_glycans(G)
+        names = self.connect_all_glycans(G, contacts)
         glycans = {}
         for graph in list(nx.connected_component_subgraphs(G)):
             for node in graph.nodes():
@@ -1952,77 +3945,75 @@ class Glycosylator:
         return glycans,names
     
     def extract_glycans(self):
-        sel_all = []    
-        for k,v in self.glycans.items():
-            r,g = v
-            sel = []
-
+        """Creates a Molecule for each glycan detected by find_glycans and the protein (view of glycoprotein without glycans).
+        Every atom is assigned to a glycan or to the protein in a single pass over the residue index
+        """
+        index = self.residue_index
+        keys = self.glycans.keys()
+        #glycan of each residue and atom (-1: protein)
+        residue_glycan = np.full(len(index.residue_ids), -1, dtype = int)
+        for i,k in enumerate(keys):
+            r,g = self.glycans[k]
+            residue_glycan[[index.index[node] for node in g.nodes()]] = i
+        atom_glycan = residue_glycan[index.atom_residue]
+        order = np.argsort(atom_glycan, kind = 'mergesort')
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(atom_glycan + 1, minlength = len(keys) + 1))))
+        
+        names = self.glycoprotein.getNames()
+        serials = self.glycoprotein.getSerials()
+        for i,k in enumerate(keys):
+            r,g = self.glycans[k]
             # !!!hard coded!!! Should be patch dependent
-            selg = []
-            for p,s in zip(self.prefix, r.split(',')):
-                if s:
-                    selg.append(p + ' ' + s)
-            rootAtom = self.glycoprotein.select(' and '.join(selg) + ' and name C1').getSerials()[0]
-
-            for node in g.nodes():
-                selg = []
-                for p,s in zip(self.prefix, node.split(',')):
-                    if s:
-                        selg.append(p + ' ' + s)
-                sel.append(' and '.join(selg))
-            sel = '(' + ') or ('.join(sel) +')'
-            sel_all.append(sel)
+            root = index.get_indices(r)
+            rootAtom = serials[root[names[root] == 'C1'][0]]
             glycan = Molecule(k)
-            glycan.set_AtomGroup(self.glycoprotein.select(sel).copy(), rootAtom = rootAtom)
+            glycan.set_AtomGroup(self.glycoprotein[order[offsets[i+1]:offsets[i+2]]].copy(), rootAtom = rootAtom)
             glycan.interresidue_connectivity = g.copy()
             self.assign_patches(glycan) 
             self.glycanMolecules[k] = glycan
-        if sel_all:
-            self.protein = self.glycoprotein.select('not ((' + ') or ('.join(sel_all) + '))').copy()
-        else:
-            self.protein = self.glycoprotein.copy()
+        self.protein = self.glycoprotein[order[offsets[0]:offsets[1]]]
     
     def define_anomer(id1, id2, a1, a2):
         r1 = self.get_residue(id1)
         r2 = selt.get_residue(ids)
         r1.select(name)
         
-    def connect_all_glycans(self, G):
+    def connect_all_glycans(self, G, contacts = None):
         """Builds a connectivity graph for molecules (not protein) in AtomGroup. Edges with unknown patches will be removed
             Parameters:
                 G: undirected graph of connected elements
+                contacts: contacts between residues (see find_contacts). Computed if not provided
             Returns:
                 names: dictionary with residue id (get_id) as keys and residue name as value
         """
-        sel = self.glycoprotein.select('not protein')
-        kd = KDTree(sel.getCoords())
-        kd.search(1.7)
-        atoms = kd.getIndices()
-        atom_names = sel.getNames()
-        names = {} 
-        ids,rn = self.get_ids(sel)
-
-        for a1,a2 in atoms:
-            id1 = ids[a1]
-            rn1 = rn[a1]
-            id2 = ids[a2]
-            rn2 = rn[a2]
-            if id1 in G and id1 not in names:
-                names[id1] = rn1
-
-            if id2 in G and id2 not in names:
-                names[id2] = rn2
-
-            if id1 != id2:
-                e = (id1, id2)
-                an1 = atom_names[a1]
-                an2 = atom_names[a2]
-                patch = self.find_patch(an1, an2)
-                if patch:
-                    G.add_edge(id1, id2, patch = patch, atoms = an1 + ':' + an2)
-                #G.add_edge(*e)
-                names[id1] = rn1
-                names[id2] = rn2
+        if contacts is None:
+            contacts = self.find_contacts()
+        index = self.residue_index
+        protein = self.glycoprotein.getFlags('protein')
+        contacts = contacts[~(protein[contacts[:, 0]] | protein[contacts[:, 1]])]
+        
+        names = {}
+        hetero = np.zeros(len(index.residue_ids), dtype = bool)
+        hetero[index.atom_residue[~protein]] = True
+        for node in G.nodes():
+            if node in index.index and hetero[index.index[node]]:
+                names[node] = index.residue_names[index.index[node]]
+
+        #patch of each pair of atom names in contacts
+        atom_names = self.glycoprotein.getNames()
+        unique_names,codes = np.unique(atom_names[contacts], return_inverse = True)
+        codes = codes.reshape(-1, 2)
+        n = len(unique_names)
+        unique_pairs,pair_codes = np.unique(codes[:, 0]*n + codes[:, 1], return_inverse = True)
+        patches = [self.find_patch(unique_names[p // n], unique_names[p % n]) for p in unique_pairs]
+
+        residues = index.atom_residue[contacts]
+        for r in np.unique(residues):
+            names[index.residue_ids[r]] = index.residue_names[r]
+        for (a1,a2),(r1,r2),p in zip(contacts, residues, pair_codes):
+            patch = patches[p]
+            if patch:
+                G.add_edge(index.residue_ids[r1], index.residue_ids[r2], patch = patch, atoms = atom_names[a1] + ':' + atom_names[a2])
 
         return names
 
@@ -2070,7 +4061,6 @@ class Glycosylator:
 
         resid = 1
         dummy_patch = 'DUMMY_MAN'
-        prefix = ['segment', 'chain', 'resid', 'icode']
 
         if glycan_name in self.connect_topology:
             glycan_topo = self.get_connectivity_tree(glycan_name)
@@ -2083,14 +4073,25 @@ class Glycosylator:
         else:
             print "Unkown Glycan"
             return [], []
+
+        #reuse a glycan built with the same connectivity tree and patch
+        cache_key = None
+        if self.glycan_cache_size > 0 and glycan_name in self.connect_topology and not (template_glycan_tree and template_glycan):
+            cache_key,anchor = self.get_glycan_cache_key(glycan_topo, link_residue, link_patch)
+            if cache_key in self.glycan_cache:
+                return self.get_cached_glycan(cache_key, anchor, link_residue, chain, segname)
+
         #Variable for storing the new glycan
-        glycan = None
+        natoms = sum([len(self.builder.Topology.get_atoms(rn)) for rn in glycan_topo.values()])
+        assembly = AtomGroupBuffer(natoms)
+        residues = {}
         glycan_bonds = []
         built_glycan = {}
         inv_template_glycan_tree = {}
         dele_atoms = []
         if template_glycan_tree and template_glycan:
             inv_template_glycan_tree = {v: k for k, v in template_glycan_tree.items()}
+            template_index = ResidueIndex(template_glycan)
             #resid = template_glycan.getResnums()[-1] + 1
             #chain = template_glycan.getChids()[0]
             #segname = template_glycan.getSegnames()[0]
@@ -2111,13 +4112,7 @@ class Glycosylator:
             del_atom = []
             #check if residue exists
             if unit in inv_template_glycan_tree:
-                sel  = []
-                
-                for p,s in zip(prefix, inv_template_glycan_tree[unit].split(',')):
-                    if s:
-                        sel.append(p + ' ' + s)
-                sel = ' and '.join(sel)
-                sel_residue = template_glycan.select(sel)
+                sel_residue = template_index.get_residue(inv_template_glycan_tree[unit])
                 #autopsf prefers if resids are incremental
                 #resid =  sel_residue.getResnums()[0]
                 
@@ -2131,7 +4126,7 @@ class Glycosylator:
                     #built_glycan[unit] = inv_template_glycan_tree[unit]
                     new_residue,missing_atoms,bonds = self.builder.add_missing_atoms(sel_residue, resid, chain, segname)
                     ics = self.builder.Topology.topology[glycan_topo[unit]]['IC']
-                    self.builder.build_missing_atom_coord(new_residue, missing_atoms, ics)
+                    self.builder.build_missing_atom_coord(new_residue, missing_atoms, ics, resname = glycan_topo[unit])
 
                     #Check if first residue is linked to other residue
                     if link_residue and link_patch and not lunit:
@@ -2156,12 +4151,7 @@ class Glycosylator:
                     new_residue, del_atom, bonds = self.builder.build_from_DUMMY(resid, glycan_topo[unit], chain, segname, dummy_patch)
             elif previous in built_glycan and lunit:
                 patch = lunit[-1]
-                sel = []
-                for p,s in zip(prefix, built_glycan[previous].split(',')):
-                    if s:
-                        sel.append(p + ' ' + s)
-                sel = ' and '.join(sel)
-                previous_residue = glycan.select(sel)
+                previous_residue = residues[previous]
                 if new_residue:
                     del_atom, b = self.builder.apply_patch(patch,previous_residue, new_residue)
                     bonds.extend(b)
@@ -2174,18 +4164,15 @@ class Glycosylator:
             built_glycan[unit] = ','.join([segname, chain, str(resid),])
             dele_atoms += del_atom
             glycan_bonds.extend(bonds)
-            if glycan:
-                glycan += new_residue
-            else:
-                glycan = new_residue
+            residues[unit] = new_residue
+            assembly.add_residue(new_residue)
             resid += 1
 
         if dele_atoms:
-            glycan = self.builder.delete_atoms(glycan, dele_atoms)
+            assembly.delete_atoms(dele_atoms)
             # remove all non existing bonds
+            dele_atoms = set(dele_atoms)
             tmp_bonds = []
-#            print 'Bonds',glycan_bonds
-#            print 'delele',dele_atoms
             for a1,a2 in glycan_bonds:
                 if a1 in dele_atoms or a2 in dele_atoms:
                     continue
@@ -2193,12 +4180,193 @@ class Glycosylator:
                     tmp_bonds.append((a1, a2))
             glycan_bonds = tmp_bonds
 
-        #set serial number
-        for i in range(len(glycan)):
-            glycan.select('index ' + str(i)).setSerials([i+1])
+        #create AtomGroup and set serial numbers
+        glycan = assembly.get_atom_group(title = segname)
+        if cache_key:
+            self.cache_glycan(cache_key, anchor, glycan, glycan_bonds, link_residue)
 
         return glycan, glycan_bonds
+
+    def get_glycan_cache_key(self, glycan_topo, link_residue = None, link_patch = None):
+        """Returns the key of a glycan in glycan_cache and the anchor atoms of the link residue used to superimpose it
+        Parameters:
+            glycan_topo: connectivity tree (see get_connectivity_tree)
+            link_residue: residue linked to the glycan (AtomGroup)
+            link_patch: name of patch used to link the glycan
+        Returns:
+            key: connectivity tree, link patch, resname of link residue and names of anchor atoms
+            anchor: coordinates of anchor atoms (None without link residue)
+        """
+        tree = tuple(sorted(glycan_topo.items()))
+        if not (link_residue and link_patch):
+            return (tree, None, None, ()), None
+        #atoms of link residue used to build the glycan
+        ic_atoms = set([a.replace('*', '')[1:] for ic in self.builder.Topology.patches[link_patch]['IC'] for a in ic[0:4] if a.replace('*', '')[0] == '1'])
+        coords = link_residue.getCoords()
+        names = []
+        anchor = []
+        for i,a in enumerate(link_residue.getNames()):
+            if a in ic_atoms:
+                names.append(a)
+                anchor.append(coords[i])
+        order = np.argsort(names)
+        key = (tree, link_patch, link_residue.getResnames()[0], tuple(np.array(names)[order]))
+        return key, np.array(anchor)[order]
+
+    def cache_glycan(self, key, anchor, glycan, bonds, link_residue = None):
+        """Stores a built glycan in glycan_cache. The glycan is centered on the anchor atoms
+        Parameters:
+            key: key returned by get_glycan_cache_key
+            anchor: coordinates of anchor atoms
+            glycan: AtomGroup of built glycan
+            bonds: list of bonds of glycan
+            link_residue: residue linked to the glycan (AtomGroup)
+        """
+        if anchor is not None and len(anchor) < 3:
+            return
+        glycan = glycan.copy()
+        link_id = None
+        if link_residue:
+            link_id = ','.join([link_residue.getSegnames()[0], link_residue.getChids()[0], str(link_residue.getResnums()[0]), link_residue.getIcodes()[0]])
+        if anchor is not None:
+            center = anchor.mean(axis = 0)
+            anchor = anchor - center
+            glycan.setCoords(glycan.getCoords() - center)
+        self.glycan_cache[key] = {'glycan': glycan, 'bonds': list(bonds), 'anchor': anchor, 'link_id': link_id}
+        while len(self.glycan_cache) > self.glycan_cache_size:
+            self.glycan_cache.popitem(last = False)
+
+    def get_cached_glycan(self, key, anchor, link_residue, chain, segname):
+        """Returns a copy of a glycan from glycan_cache superimposed onto the anchor atoms of link_residue and relabelled
+        Parameters:
+            key: key returned by get_glycan_cache_key
+            anchor: coordinates of anchor atoms
+            link_residue: residue linked to the glycan (AtomGroup)
+            chain: chain for new glycan
+            segname: segname for new glycan
+        Returns:
+            glycan: structure of the glycan (AtomGroup)
+            bonds: list of bonds of glycan
+        """
+        cached = self.glycan_cache.pop(key)
+        self.glycan_cache[key] = cached
+        glycan = cached['glycan'].copy()
+        glycan.setTitle(segname)
+        n = glycan.numAtoms()
+        if anchor is not None:
+            t = calcTransformation(cached['anchor'], anchor)
+            glycan.setCoords(applyTransformation(t, glycan.getCoords()))
+
+        #relabel residue ids in bonds
+        ids = {}
+        for s,c,r,ic in zip(glycan.getSegnames(), glycan.getChids(), glycan.getResnums(), glycan.getIcodes()):
+            ids[','.join([s, c, str(r), ic])] = ','.join([segname, chain, str(r), ic])
+        if link_residue:
+            ids[cached['link_id']] = ','.join([link_residue.getSegnames()[0], link_residue.getChids()[0], str(link_residue.getResnums()[0]), link_residue.getIcodes()[0]])
+        bonds = []
+        for b in cached['bonds']:
+            bond = []
+            for a in b:
+                res_id,name = a.rsplit(',', 1)
+                bond.append(ids.get(res_id, res_id) + ',' + name)
+            bonds.append(tuple(bond))
+
+        glycan.setSegnames([segname]*n)
+        glycan.setChids([chain]*n)
+        return glycan, bonds
     
+    def glycosylate_sequon(self, sequon_id, glycan_name, link_patch = 'NGLB', chain = 'G', segname = None, hydrogens = False):
+        """Builds a glycan on a sequon and prepares it for sampling. Existing glycans are extended.
+        Parameters:
+            sequon_id: id of the linked residue; 'segname,chain,resid,icode'
+            glycan_name: name of glycan in connect_topology
+            link_patch: name of patch used to link glycan to sequon
+            chain: chain of new glycan
+            segname: segname of new glycan. Default chain of sequon + resid
+            hydrogens: include torsionals of hydrogens
+        Returns:
+            sequon_id
+            molecule: Molecule instance with patches, atom types and torsionals defined (None if glycan could not be built)
+            timing: dictionary with the time spent in each stage
+        """
+        timing = {}
+        t0 = time.time()
+        sequon = self.get_residue(sequon_id)
+        if not sequon:
+            print 'WARNING: residue %s not found' % sequon_id
+            return sequon_id, None, timing
+        seg,ch,resid,i = sequon_id.split(',')
+        if not segname:
+            segname = ch + resid
+        #extend existing glycan
+        if sequon_id in self.glycanMolecules:
+            template = self.glycanMolecules[sequon_id]
+            template_tree = self.build_connectivity_tree(template.rootRes, template.interresidue_connectivity)
+            glycan,bonds = self.glycosylate(glycan_name, template_glycan_tree = template_tree, template_glycan = template.atom_group, link_residue = sequon, link_patch = link_patch, chain = chain, segname = segname)
+        else:
+            glycan,bonds = self.glycosylate(glycan_name, link_residue = sequon, link_patch = link_patch, chain = chain, segname = segname)
+        t1 = time.time()
+        timing['glycosylate'] = t1 - t0
+        if not glycan:
+            return sequon_id, None, timing
+
+        molecule = Molecule(sequon_id)
+        molecule.set_AtomGroup(glycan, bonds = bonds)
+        t0 = time.time()
+        timing['set_AtomGroup'] = t0 - t1
+        self.assign_patches(molecule)
+        t1 = time.time()
+        timing['assign_patches'] = t1 - t0
+        molecule.set_atom_type(self.assign_atom_type(molecule))
+        t0 = time.time()
+        timing['assign_atom_type'] = t0 - t1
+        molecule.define_torsionals(hydrogens = hydrogens)
+        timing['define_torsionals'] = time.time() - t0
+        return sequon_id, molecule, timing
+
+    def glycosylate_all(self, glycosylation, link_patch = 'NGLB', chain = 'G', hydrogens = False, nprocs = 1):
+        """Builds all the glycans of a glycoprotein and prepares them for sampling. Each site is independent, so the glycans can be built in a pool of processes.
+        Parameters:
+            glycosylation: dictionary with sequon ids (see sequons) as keys and glycan names as values
+            link_patch: name of patch used to link glycans to sequons
+            chain: chain of new glycans
+            hydrogens: include torsionals of hydrogens
+            nprocs: number of processes. Default 1 (serial)
+        Returns:
+            glycanMolecules: dictionary with sequon ids as keys and Molecule instances as values. glycanMolecules of the Glycosylator is not modified
+            timing: dictionary with the total time spent in each stage and the wall time ('total')
+        """
+        global GLYCOSYLATOR_WORKER
+        t0 = time.time()
+        tasks = []
+        for sequon_id in sorted(glycosylation.keys()):
+            tasks.append((sequon_id, glycosylation[sequon_id], link_patch, chain, None, hydrogens))
+
+        if nprocs > 1 and len(tasks) > 1:
+            #workers inherit the Glycosylator when they are forked
+            GLYCOSYLATOR_WORKER = self
+            pool = multiprocessing.Pool(min(nprocs, len(tasks)))
+            try:
+                results = pool.map(glycosylate_sequon_worker, tasks)
+            finally:
+                pool.close()
+                pool.join()
+                GLYCOSYLATOR_WORKER = None
+        else:
+            results = [self.glycosylate_sequon(*t) for t in tasks]
+
+        glycanMolecules = {}
+        timing = defaultdict(float)
+        for sequon_id,molecule,t in results:
+            if molecule is None:
+                print 'WARNING: glycan %s could not be built on %s' % (glycosylation[sequon_id], sequon_id)
+            else:
+                glycanMolecules[sequon_id] = molecule
+            for stage,dt in t.items():
+                timing[stage] += dt
+        timing['total'] = time.time() - t0
+        return glycanMolecules, dict(timing)
+
     def connect_tree_to_topology(self, connect_tree):
         """Converts a connect tree to a connect topology
            In connect tree the connectivity is represented as a string whereas it is a list in connect topology
@@ -2339,10 +4507,12 @@ class Glycosylator:
         
         return glycan_topo,connect_tree 
 
-    def identify_glycan(self, molecule):
-        """Identifies glycan name
+    def get_glycan_keys(self, molecule):
+        """Returns the unit keys ('resname patch1 patch2 ...') of a glycan
         Parameters:
             molecule: Molecule object
+        Returns:
+            set of unit keys
         """
         G = molecule.interresidue_connectivity
         connect_tree = self.build_connectivity_tree(molecule.rootRes, G) 
@@ -2350,13 +4520,48 @@ class Glycosylator:
         target=[]
         for r in connect_tree.keys():
             target.append(G.node[r]['resname'] + ' ' + connect_tree[r])
-        len_target=len(target)
+        return set(target)
+
+    def find_glycan_supersets(self, molecule):
+        """Returns the names of the glycans in connect_topology that contain a (truncated) glycan
+        Glycans of a lazily loaded library are all indexed before the first search (see index_glycan_library)
+        Parameters:
+            molecule: Molecule object
+        """
+        self.index_glycan_library()
+        return sorted(self.glycan_index.supersets(self.get_glycan_keys(molecule)))
+
+    def find_nearest_glycans(self, molecule, k = 5):
+        """Returns the k glycans of connect_topology that share the most units with a glycan
+        Glycans of a lazily loaded library are all indexed before the first search (see index_glycan_library)
+        Parameters:
+            molecule: Molecule object
+            k: number of glycans
+        Returns:
+            list of (glycan name, number of shared units, number of differing units)
+        """
+        self.index_glycan_library()
+        return self.glycan_index.nearest(self.get_glycan_keys(molecule), k)
+
+    def identify_glycan(self, molecule):
+        """Identifies glycan name
+        Parameters:
+            molecule: Molecule object
+        """
+        target = self.get_glycan_keys(molecule)
         
-        for gk in self.glycan_keys:
-            if len(set(target) & set(self.glycan_keys[gk])) == len_target and len(set(self.glycan_keys[gk])) == len_target:
+        gk = ''
+        h = self.get_glycan_hash(target)
+        #read glycans with the same hash from a lazily loaded library
+        if self.glycan_library is not None and h not in self.glycan_hashes:
+            for name in self.glycan_library.find(glycan_hash = h):
+                if name not in self.glycan_keys:
+                    self.add_glycan_key(name)
+        #glycans with the same hash are verified
+        for name in self.glycan_hashes.get(h, []):
+            if set(self.glycan_keys[name]) == target:
+                gk = name
                 break
-            else:
-                gk = ''
         
         if gk:
             molecule.id = gk
@@ -2488,7 +4693,7 @@ class Glycosylator:
 class Sampler():
     """Class to sample conformations, based on a 
     """
-    def __init__(self, molecules, envrionment, dihe_parameters, vdw_parameters, clash_dist = 1.8, grid_resolution = 1.5):
+    def __init__(self, molecules, envrionment, dihe_parameters, vdw_parameters, clash_dist = 1.8, grid_resolution = 1.5, parameter_tables = None):
         """ 
         Parameters
             molecules: list of Molecules instances
@@ -2496,6 +4701,7 @@ class Sampler():
             dihe_parameters: dictionary of parameters for dihedrals from CHARMMParameters. Atomtype as key and [k, n, d] as values
             vdw_parameters: dictionary of parameters for van der Waals from CHARMMParameters. Atomtype as key and [r, e] as values
             clash_dist = threshold for defining a clash (A)
+            parameter_tables: CHARMMParameterTables built from the same parameters. Built from dihe_parameters and vdw_parameters if not provided
         """
         self.molecules = molecules
         self.environment = envrionment
@@ -2503,6 +4709,9 @@ class Sampler():
         self.cutoff_dist =  10.
         self.dihe_parameters = dihe_parameters
         self.vdw_parameters = vdw_parameters
+        if parameter_tables is None:
+            parameter_tables = CHARMMParameterTables({'DIHEDRALS': dihe_parameters, 'NONBONDED': vdw_parameters})
+        self.parameter_tables = parameter_tables
         self.energy = {}
         self.energy_lookup = []
         self.nbr_clashes = np.zeros(len(self.molecules))
@@ -2512,6 +4721,8 @@ class Sampler():
         self.exclude1_3 = []
         self.genes = []
         self.sample = []
+        self.archive = None
+        self.archive_keys = []
         #size of environment
         if self.environment:
             self.grid_resolution = grid_resolution
@@ -2543,19 +4754,13 @@ class Sampler():
             keys.sort()
             charges = nx.get_node_attributes(molecule.connectivity, 'charge')
             names = nx.get_node_attributes(molecule.connectivity, 'name')
-            charge = []
-            vdw = []
-            for k in keys:
-                charge.append(charges[k])
-                e,r = vdw_parameters[types[k]][:2]
-                #increase the r_min for hydrogen atoms
-                if r < 1.:
-                    r = 1.340
-                vdw.append([e,r])
+            charge = [charges[k] for k in keys]
+            e,r = self.parameter_tables.get_vdw([types[k] for k in keys])
+            #increase the r_min for hydrogen atoms
+            r = np.where(r < 1., 1.340, r)
 
             self.charges.append(charge)
-            self.vdw.append(vdw)
-            lookup = []
+            self.vdw.append(np.column_stack((e, r)))
             
             self.build_1_3_exclude_list(mol_id)
             self.count_self_exclude(mol_id)
@@ -2566,34 +4771,7 @@ class Sampler():
             
             self.interresidue_torsionals.append(molecule.get_interresidue_torsionals(self.patches))
             self.energy['skip'] = self.compute_inv_cum_sum_dihedral([[0.35, 1.0, 0.0]])
-            for dihe in molecule.torsionals:
-                atypes = []
-                for d in dihe:
-                    atypes.append(types[d])
-                k1 = '-'.join(atypes)
-                atypes.reverse()
-                k2 = '-'.join(atypes)
-                if k1 in self.energy:
-                    lookup.append(k1)   
-                    continue
-                if k2 in self.energy:
-                    lookup.append(k2)   
-                    continue
-
-                if k1 in dihe_parameters:
-                    k = k1
-                elif k2 in dihe_parameters:
-                    k = k2
-                else:
-                    print 'Missing parameters for ' + k1
-                    print 'This dihedral will be skipped'
-                    lookup.append('skip')
-                    continue
-                par_list = dihe_parameters[k]
-                self.energy[k] = self.compute_inv_cum_sum_dihedral(par_list)
-                lookup.append(k)
-
-            self.energy_lookup.append(lookup)
+            self.energy_lookup.append(self.build_energy_lookup(molecule, types))
 
         self.molecule_coordinates = np.zeros((idx,3))
         self.count_total_clashes_fast()
@@ -2602,6 +4780,31 @@ class Sampler():
         #    self.molecule_coordinates[i0:i1, :] = molecule.atom_group.getCoords() 
         #self.non_bonded_energy = np.array(self.non_bonded_energy) 
     
+    def build_energy_lookup(self, molecule, types):
+        """Finds the dihedral parameters of all torsionals of a molecule and computes the missing inverse transform samplings
+        Parameters:
+            molecule: Molecule instance
+            types: dictionary with atom serial number as key and atom type as value
+        Returns:
+            lookup: list of dihedral keys (key in dihe_parameters or 'skip' if parameters are missing)
+        """
+        if not molecule.torsionals:
+            return []
+        atypes = [[types[d] for d in dihe] for dihe in molecule.torsionals]
+        rows = self.parameter_tables.get_dihedral_rows(atypes)
+        lookup = []
+        for a,row in zip(atypes, rows):
+            if row < 0:
+                print 'Missing parameters for ' + '-'.join(a)
+                print 'This dihedral will be skipped'
+                lookup.append('skip')
+                continue
+            k = self.parameter_tables.dihedral_keys[row]
+            if k not in self.energy:
+                self.energy[k] = self.compute_inv_cum_sum_dihedral(self.dihe_parameters[k])
+            lookup.append(k)
+        return lookup
+
     def compute_inv_cum_sum_dihedral(self, par_list, n_points = 100):
         """Computes the an interpolation of the inverse transform sampling of a CHARMM
         dihedral term: sum(k*[1-cos(n*phi -d)]).
@@ -2628,20 +4831,11 @@ class Sampler():
         idx[1:] = np.diff(cum_values) > 0.0
         x = cum_values[idx]
         y = phi[idx]
-        inv_cdf = InterpolatedUnivariateSpline(x, y)
+        inv_cdf = interpolate.InterpolatedUnivariateSpline(x, y)
         return inv_cdf
     
     def parse_patches(self, fname):
-        lines  = readLinesFromFile(fname)
-        self.patches = defaultdict(list) 
-        for line in lines:
-            line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
-            if line:
-                if line[0]=='PRES':
-                    patch = line[1]
-                if line[0]=='DIHE':
-                    dihe = [line[1:5], list(pairwise(map(float, line[5:])))] 
-                    self.patches[patch].append(dihe) 
+        self.patches = read_patch_dihedrals(fname)
 
     def get_uniform(self, interp_fn, angle):
         """Returns a number between [0:1[ which corresponds to an angle, 
@@ -2657,7 +4851,7 @@ class Sampler():
             angle = 180 - angle
         x = np.linspace(0, 1, 10)
         y = [interp_fn(i) - angle for i in x]
-        spl = InterpolatedUnivariateSpline(x, y)
+        spl = interpolate.InterpolatedUnivariateSpline(x, y)
         r = spl.roots()
         if not r:
             return 1.
@@ -2668,15 +4862,7 @@ class Sampler():
         """list with set of neighboring atoms
         """
         molecule = self.molecules[mol_id]
-        G = molecule.connectivity
-        exclude_mol = []
-        for a in sorted(G.nodes()):
-            exclude = set()
-            for n in G.neighbors(a):
-                exclude.add(n)
-                exclude.update(G.neighbors(n))
-            exclude_mol.append(exclude)
-        self.exclude1_3.append(exclude_mol)
+        self.exclude1_3.append(molecule.get_compact_connectivity().get_exclude_1_3())
     
     def count_self_exclude(self, mol_id):
         """Counts the number bonds and 1_3 exclusion for each molecule
@@ -3140,7 +5326,69 @@ class Sampler():
             if idx.any(): 
                 offspring[idx] = np.squeeze(np.random.rand(np.sum(idx)))
     
-    def remove_clashes_GA_iterative(self, n_iter = 10, n_individues = 5, n_generation = 50, pop_size=40, mutation_rate=0.01, crossover_rate=0.9):
+    def set_archive(self, archive, keys = None):
+        """Streams all the conformers stored during sampling (n_conformers > 1) to an EnsembleArchive
+        Parameters:
+            archive: EnsembleArchive opened in 'a' or 'w' mode (None to stop archiving)
+            keys: key of each molecule in the archive. Default molecule names
+        """
+        self.archive = archive
+        if keys is None:
+            keys = [molecule.name for molecule in self.molecules]
+        self.archive_keys = list(keys)
+        if archive is not None:
+            for key,molecule in zip(self.archive_keys, self.molecules):
+                archive.add_molecule(key, molecule)
+
+    def _archive_conformers(self, mol_ids):
+        """Appends the current conformation of molecules to the archive
+        """
+        if self.archive is None:
+            return
+        for mol_id in mol_ids:
+            molecule = self.molecules[mol_id]
+            key = self.archive_keys[mol_id]
+            coords = molecule.atom_group.getCoords()
+            torsionals = self.archive.header['molecules'][key]['torsionals']
+            self.archive.append(key, coords, [self.nbr_clashes[mol_id]], measure_dihedrals(coords, molecule.get_torsional_atoms(torsionals)))
+
+    def _store_conformers(self, sorted_population, n_conformers, mol_ids = []):
+        """Adds the n_conformers fittest individues to the ensembles of the molecules. The score of a conformer is the number of clashes of its molecule
+        Parameters:
+            sorted_population: sorted indices of population fitness
+            n_conformers: number of individues to store
+            mol_ids: only consider subgroup of molecules with index
+        """
+        if not len(mol_ids):
+            mol_ids = np.arange(len(self.molecules))
+        for p in sorted_population[:n_conformers]:
+            self._build_individue(self.population[p], mol_ids)
+            self.count_total_clashes_fast()
+            for mol_id in mol_ids:
+                self.molecules[mol_id].add_conformer(self.nbr_clashes[mol_id])
+            self._archive_conformers(mol_ids)
+
+    def _finalize_ensembles(self, n_conformers, rmsd_threshold):
+        """Adds the final conformation of each molecule to its ensemble, removes duplicates and keeps the n_conformers best conformers
+        """
+        self.count_total_clashes_fast()
+        for mol_id,molecule in enumerate(self.molecules):
+            molecule.add_conformer(self.nbr_clashes[mol_id])
+            molecule.remove_duplicate_conformers(rmsd_threshold)
+            molecule.keep_best_conformers(n_conformers)
+
+    def remove_clashes_GA_iterative(self, n_iter = 10, n_individues = 5, n_generation = 50, pop_size=40, mutation_rate=0.01, crossover_rate=0.9, n_conformers = 1, rmsd_threshold = 0.5):
+        """Removes clashes by sampling the torsionals of the molecules with the most clashes with a genetic algorithm
+        Parameters:
+            n_iter: number of iterations (selection of molecules)
+            n_individues: number of molecules sampled in each iteration
+            n_generation: number of generations in each iteration
+            pop_size: size of population
+            mutation_rate: probability of mutation of each gene
+            crossover_rate: probability of crossover
+            n_conformers: number of conformers kept in the ensemble of each molecule (see Molecule.add_conformers). The best individues of each iteration are stored if > 1, and streamed to the archive (see set_archive)
+            rmsd_threshold: minimum RMSD between conformers of an ensemble
+        """
         fast = False 
         clash = True
         n_individues =  np.min((n_individues, len(self.molecules)))
@@ -3190,13 +5438,26 @@ class Sampler():
                 gen_cnt += 1 
                 print "="*70
             sorted_population = self._evaluate_population(clash = clash, fast = fast, mol_ids = selected_molecules)
+            if n_conformers > 1:
+                self._store_conformers(sorted_population, n_conformers, mol_ids = selected_molecules)
             self._build_individue(self.population[sorted_population[0]], mol_ids = selected_molecules)
     
         sorted_population = self._evaluate_population(clash = clash, fast = fast, mol_ids = selected_molecules)
         self._build_individue(self.population[sorted_population[0]], mol_ids = selected_molecules)
+        if n_conformers > 1:
+            self._finalize_ensembles(n_conformers, rmsd_threshold)
     
 
-    def remove_clashes_GA(self, n_generation = 50, pop_size=40, mutation_rate=0.01, crossover_rate=0.9):
+    def remove_clashes_GA(self, n_generation = 50, pop_size=40, mutation_rate=0.01, crossover_rate=0.9, n_conformers = 1, rmsd_threshold = 0.5):
+        """Removes clashes by sampling the torsionals of all molecules with a genetic algorithm
+        Parameters:
+            n_generation: number of generations
+            pop_size: size of population
+            mutation_rate: probability of mutation of each gene
+            crossover_rate: probability of crossover
+            n_conformers: number of conformers kept in the ensemble of each molecule (see Molecule.add_conformers). The best individues of the last generation are stored if > 1, and streamed to the archive (see set_archive)
+            rmsd_threshold: minimum RMSD between conformers of an ensemble
+        """
         torsionals,n_torsionals = self._get_all_torsional_angles()
         length = len(torsionals)
         self.population = np.random.rand(pop_size, length)
@@ -3244,7 +5505,11 @@ class Sampler():
             i += 1 
             print "="*70
         sorted_population = self._evaluate_population(clash = clash, fast = fast)
+        if n_conformers > 1:
+            self._store_conformers(sorted_population, n_conformers)
         self._build_individue(self.population[sorted_population[0]])
+        if n_conformers > 1:
+            self._finalize_ensembles(n_conformers, rmsd_threshold)
 
 #####################################################################################
 #                               PSO Sampler                                         #
@@ -3252,7 +5517,7 @@ class Sampler():
 class SamplerPSO():
     """Class to sample conformations, based on a PSO optimization
     """
-    def __init__(self, molecules, envrionment, dihe_parameters, vdw_parameters, clash_dist = 1.8, grid_resolution = 1.5):
+    def __init__(self, molecules, envrionment, dihe_parameters, vdw_parameters, clash_dist = 1.8, grid_resolution = 1.5, parameter_tables = None):
         """ 
         Parameters
             molecules: list of Molecules instances
@@ -3260,17 +5525,23 @@ class SamplerPSO():
             dihe_parameters: dictionary of parameters for dihedrals from CHARMMParameters. Atomtype as key and [k, n, d] as values
             vdw_parameters: dictionary of parameters for van der Waals from CHARMMParameters. Atomtype as key and [r, e] as values
             clash_dist = threshold for defining a clash (A)
+            parameter_tables: CHARMMParameterTables built from the same parameters. Built from dihe_parameters and vdw_parameters if not provided
         """
         self.molecules = molecules
         self.environment = envrionment
         self.clash_dist = clash_dist
         self.cutoff_dist =  10.
         self.dihe_parameters = dihe_parameters
+        if parameter_tables is None:
+            parameter_tables = CHARMMParameterTables({'DIHEDRALS': dihe_parameters, 'NONBONDED': vdw_parameters})
+        self.parameter_tables = parameter_tables
         self.energy = {}
         self.energy_lookup = []
         self.nbr_clashes = np.zeros(len(self.molecules))
         self.exclude1_3 = []
         self.swarm = []
+        self.archive = None
+        self.archive_keys = []
         #size of environment
         if self.environment:
             self.grid_resolution = grid_resolution
@@ -3304,40 +5575,37 @@ class SamplerPSO():
 
             self.interresidue_torsionals.append(molecule.get_interresidue_torsionals(self.patches))
             self.energy['skip'] = self.compute_inv_cum_sum_dihedral([[0.35, 1.0, 0.0]])
-            lookup =[]
-            for dihe in molecule.torsionals:
-                atypes = []
-                for d in dihe:
-                    atypes.append(types[d])
-                k1 = '-'.join(atypes)
-                atypes.reverse()
-                k2 = '-'.join(atypes)
-                if k1 in self.energy:
-                    lookup.append(k1)   
-                    continue
-                if k2 in self.energy:
-                    lookup.append(k2)   
-                    continue
-
-                if k1 in dihe_parameters:
-                    k = k1
-                elif k2 in dihe_parameters:
-                    k = k2
-                else:
-                    print 'Missing parameters for ' + k1
-                    print 'This dihedral will be skipped'
-                    lookup.append('skip')
-                    continue
-                par_list = dihe_parameters[k]
-                self.energy[k] = self.compute_inv_cum_sum_dihedral(par_list)
-                lookup.append(k)
-
-            self.energy_lookup.append(lookup)
+            self.energy_lookup.append(self.build_energy_lookup(molecule, types))
 
         self.molecule_coordinates = np.zeros((idx,3))
         self.count_total_clashes_fast()
 
     
+    def build_energy_lookup(self, molecule, types):
+        """Finds the dihedral parameters of all torsionals of a molecule and computes the missing inverse transform samplings
+        Parameters:
+            molecule: Molecule instance
+            types: dictionary with atom serial number as key and atom type as value
+        Returns:
+            lookup: list of dihedral keys (key in dihe_parameters or 'skip' if parameters are missing)
+        """
+        if not molecule.torsionals:
+            return []
+        atypes = [[types[d] for d in dihe] for dihe in molecule.torsionals]
+        rows = self.parameter_tables.get_dihedral_rows(atypes)
+        lookup = []
+        for a,row in zip(atypes, rows):
+            if row < 0:
+                print 'Missing parameters for ' + '-'.join(a)
+                print 'This dihedral will be skipped'
+                lookup.append('skip')
+                continue
+            k = self.parameter_tables.dihedral_keys[row]
+            if k not in self.energy:
+                self.energy[k] = self.compute_inv_cum_sum_dihedral(self.dihe_parameters[k])
+            lookup.append(k)
+        return lookup
+
     def compute_inv_cum_sum_dihedral(self, par_list, n_points = 100):
         """Computes the an interpolation of the inverse transform sampling of a CHARMM
         dihedral term: sum(k*[1-cos(n*phi -d)]).
@@ -3365,20 +5633,11 @@ class SamplerPSO():
         x = cum_values[idx]
         y = phi[idx]
 
-        inv_cdf = InterpolatedUnivariateSpline(x, y)
+        inv_cdf = interpolate.InterpolatedUnivariateSpline(x, y)
         return inv_cdf
     
     def parse_patches(self, fname):
-        lines  = readLinesFromFile(fname)
-        self.patches = defaultdict(list) 
-        for line in lines:
-            line = line.split('\n')[0].split('!')[0].split() #remove comments and endl
-            if line:
-                if line[0]=='PRES':
-                    patch = line[1]
-                if line[0]=='DIHE':
-                    dihe = [line[1:5], list(pairwise(map(float, line[5:])))] 
-                    self.patches[patch].append(dihe) 
+        self.patches = read_patch_dihedrals(fname)
 
     def get_uniform(self, interp_fn, angle):
         """Returns a number between [0:1[ which corresponds to an angle, 
@@ -3394,7 +5653,7 @@ class SamplerPSO():
             angle = 180 - angle
         x = np.linspace(0, 1, 10)
         y = [interp_fn(i) - angle for i in x]
-        spl = InterpolatedUnivariateSpline(x, y)
+        spl = interpolate.InterpolatedUnivariateSpline(x, y)
         r = spl.roots()
         if not r:
             return 1.
@@ -3405,15 +5664,7 @@ class SamplerPSO():
         """list with set of neighboring atoms
         """
         molecule = self.molecules[mol_id]
-        G = molecule.connectivity
-        exclude_mol = []
-        for a in sorted(G.nodes()):
-            exclude = set()
-            for n in G.neighbors(a):
-                exclude.add(n)
-                exclude.update(G.neighbors(n))
-            exclude_mol.append(exclude)
-        self.exclude1_3.append(exclude_mol)
+        self.exclude1_3.append(molecule.get_compact_connectivity().get_exclude_1_3())
     
     def count_self_exclude(self, mol_id):
         """Counts the number bonds and 1_3 exclusion for each molecule
@@ -3558,6 +5809,57 @@ class SamplerPSO():
         print "Best energy: ", '%e' % energies[ee[0]], "|| Median energy: ", '%e' % np.median(energies), "|| Worst energy: ", '%e' % energies[ee[-1]]
         return ee
 
+    def set_archive(self, archive, keys = None):
+        """Streams all the conformers stored during sampling (n_conformers > 1) to an EnsembleArchive
+        Parameters:
+            archive: EnsembleArchive opened in 'a' or 'w' mode (None to stop archiving)
+            keys: key of each molecule in the archive. Default molecule names
+        """
+        self.archive = archive
+        if keys is None:
+            keys = [molecule.name for molecule in self.molecules]
+        self.archive_keys = list(keys)
+        if archive is not None:
+            for key,molecule in zip(self.archive_keys, self.molecules):
+                archive.add_molecule(key, molecule)
+
+    def _archive_conformers(self, mol_ids):
+        """Appends the current conformation of molecules to the archive
+        """
+        if self.archive is None:
+            return
+        for mol_id in mol_ids:
+            molecule = self.molecules[mol_id]
+            key = self.archive_keys[mol_id]
+            coords = molecule.atom_group.getCoords()
+            torsionals = self.archive.header['molecules'][key]['torsionals']
+            self.archive.append(key, coords, [self.nbr_clashes[mol_id]], measure_dihedrals(coords, molecule.get_torsional_atoms(torsionals)))
+
+    def _store_conformers(self, n_conformers, mol_ids = []):
+        """Adds the best positions of the n_conformers best particles to the ensembles of the molecules. The score of a conformer is the number of clashes of its molecule
+        Parameters:
+            n_conformers: number of particles to store
+            mol_ids: only consider subgroup of molecules with index
+        """
+        if not len(mol_ids):
+            mol_ids = np.arange(len(self.molecules))
+        particles = sorted([p for p in self.swarm if len(p.pos_best)], key = lambda p: p.lowest_energy)
+        for p in particles[:n_conformers]:
+            self._build_molecule(p.pos_best, mol_ids)
+            self.count_total_clashes_fast()
+            for mol_id in mol_ids:
+                self.molecules[mol_id].add_conformer(self.nbr_clashes[mol_id])
+            self._archive_conformers(mol_ids)
+
+    def _finalize_ensembles(self, n_conformers, rmsd_threshold):
+        """Adds the final conformation of each molecule to its ensemble, removes duplicates and keeps the n_conformers best conformers
+        """
+        self.count_total_clashes_fast()
+        for mol_id,molecule in enumerate(self.molecules):
+            molecule.add_conformer(self.nbr_clashes[mol_id])
+            molecule.remove_duplicate_conformers(rmsd_threshold)
+            molecule.keep_best_conformers(n_conformers)
+
     class Particle:
         """ This class implements the functions needed for taking care of the Particles
             Parameters:
@@ -3605,7 +5907,18 @@ class SamplerPSO():
 
 
     
-    def remove_clashes_PSO(self, n_generation, n_molecules, n_particles, n_iter, inertia = .75, cognitive_prm = 1.5, social_prm = 2., save_trajectory=False):
+    def remove_clashes_PSO(self, n_generation, n_molecules, n_particles, n_iter, inertia = .75, cognitive_prm = 1.5, social_prm = 2., save_trajectory=False, n_conformers = 1, rmsd_threshold = 0.5):
+        """Removes clashes by sampling the torsionals of the molecules with the most clashes with a particle swarm optimization
+        Parameters:
+            n_generation: number of generations (selection of molecules)
+            n_molecules: number of molecules sampled in each generation
+            n_particles: number of particles
+            n_iter: number of iterations in each generation
+            inertia, cognitive_prm, social_prm: parameters of particles
+            save_trajectory: save best positions in PSO_trajectory.pdb
+            n_conformers: number of conformers kept in the ensemble of each molecule (see Molecule.add_conformers). The best particles of each generation are stored if > 1, and streamed to the archive (see set_archive)
+            rmsd_threshold: minimum RMSD between conformers of an ensemble
+        """
 
         n_molecules =  np.min((n_molecules, len(self.molecules)))
 
@@ -3680,12 +5993,156 @@ class SamplerPSO():
                     particle.update_position(pos_best_global)
                 iter_cnt += 1 
                 print "="*70
+            if n_conformers > 1:
+                self._store_conformers(n_conformers, mol_ids = selected_molecules)
             self._build_molecule(pos_best_global, mol_ids = selected_molecules)
             
+        if n_conformers > 1:
+            self._finalize_ensembles(n_conformers, rmsd_threshold)
         print "Best energy", lowest_energy_global            
         if save_trajectory:
             writePDB('PSO_trajectory.pdb', molecule_trajectory)
 
+#####################################################################################
+#                               Analysis                                            #
+#####################################################################################
+class TorsionalStatistics:
+    """Distributions of the interresidue torsional angles (phi/psi/omega) of ensembles of glycans, grouped by patch.
+    The angles of all frames of a molecule are measured at once (see measure_dihedrals) and compared to the preferred intervals of the patches
+    Attributes:
+        patches: preferred intervals of each patch (see read_patch_dihedrals)
+        angles: dictionary with patch as key and list of arrays (n_frames, n_dihedrals) as values
+    """
+    def __init__(self, fname = None):
+        """
+        Parameters:
+            fname: path to patch dihedrals. Default support/topology/pres.top
+        """
+        if fname is None:
+            fname = os.path.join(GLYCOSYLATOR_PATH, 'support/topology/pres.top')
+        self.patches = read_patch_dihedrals(fname)
+        self.angles = defaultdict(list)
+
+    def get_linkages(self, molecule):
+        """Returns the torsionals of a molecule that correspond to the dihedrals of its patches
+        Parameters:
+            molecule: Molecule with patches assigned in interresidue_connectivity
+        Returns:
+            linkages: list of [patch, atom indices of torsionals (n_dihedrals, 4), offsets between torsionals and patch dihedrals]
+        """
+        linkages = []
+        for key,(patch,deltas) in molecule.get_interresidue_torsionals(self.patches).items():
+            t_ids = [int(t) for t in key.split('-') if t]
+            #skip linkages for which some dihedrals are not rotatable
+            if len(t_ids) != len(self.patches[patch]):
+                continue
+            atoms = molecule.get_torsional_atoms([molecule.torsionals[t] for t in t_ids])
+            linkages.append([patch, atoms, np.array(deltas)])
+        return linkages
+
+    def add_coords(self, molecule, coords, linkages = None):
+        """Adds the interresidue torsional angles of frames of a molecule
+        Parameters:
+            molecule: Molecule
+            coords: array (n_frames, n_atoms, 3)
+            linkages: output of get_linkages. Computed if not provided
+        """
+        if linkages is None:
+            linkages = self.get_linkages(molecule)
+        if not linkages:
+            return
+        coords = np.asarray(coords).reshape(-1, molecule.atom_group.numAtoms(), 3)
+        atoms = np.concatenate([l[1] for l in linkages])
+        deltas = np.concatenate([l[2] for l in linkages])
+        angles = measure_dihedrals(coords, atoms) - deltas
+        angles = (angles + 180.) % 360. - 180.
+        i = 0
+        for patch,a,d in linkages:
+            self.angles[patch].append(angles[:, i:i+len(a)])
+            i += len(a)
+
+    def add_molecule(self, molecule):
+        """Adds the interresidue torsional angles of the ensemble of a molecule (current coordinates if the ensemble is empty)
+        """
+        coords,scores = molecule.get_ensemble()
+        if not len(coords):
+            coords = molecule.atom_group.getCoords()[np.newaxis]
+        self.add_coords(molecule, coords)
+
+    def add_archive(self, archive, key, molecule, chunk_size = 1000):
+        """Adds the interresidue torsional angles of all the frames of a molecule in an EnsembleArchive. Frames are read chunk by chunk
+        Parameters:
+            archive: EnsembleArchive
+            key: key of molecule in archive
+            molecule: Molecule with the same atoms as the archived molecule (provides the torsionals and patches)
+            chunk_size: number of frames read at once
+        """
+        linkages = self.get_linkages(molecule)
+        coords = archive.get_coords(key)
+        for i in range(0, len(coords), chunk_size):
+            self.add_coords(molecule, coords[i:i + chunk_size], linkages)
+
+    def get_angles(self, patch):
+        """Returns the angles (n_samples, n_dihedrals) of all linkages with a patch
+        """
+        if not self.angles[patch]:
+            return np.zeros((0, len(self.patches[patch])))
+        return np.concatenate(self.angles[patch])
+
+    def get_histograms(self, bins = 72):
+        """Histograms of the angles of each dihedral
+        Parameters:
+            bins: number of bins between -180 and 180
+        Returns:
+            histograms: dictionary with patch as key and [counts (n_dihedrals, bins), bin edges] as value
+        """
+        edges = np.linspace(-180., 180., bins + 1)
+        histograms = {}
+        for patch in self.angles:
+            angles = self.get_angles(patch)
+            counts = np.array([np.histogram(a, edges)[0] for a in angles.T]).reshape(-1, bins)
+            histograms[patch] = [counts, edges]
+        return histograms
+
+    def get_ramachandran(self, patch, x = -1, y = -2, bins = 72):
+        """2D histogram of two dihedrals of a patch. In pres.top phi is the last dihedral and psi the one before
+        Parameters:
+            patch: name of patch
+            x, y: index of dihedrals (default phi and psi)
+            bins: number of bins between -180 and 180
+        Returns:
+            counts: array (bins, bins)
+            edges: bin edges
+        """
+        angles = self.get_angles(patch)
+        edges = np.linspace(-180., 180., bins + 1)
+        counts = np.histogram2d(angles[:, x], angles[:, y], [edges, edges])[0]
+        return counts,edges
+
+    def get_compliance(self):
+        """Fraction of angles within the preferred intervals of their patch
+        Returns:
+            compliance: dictionary with patch as key and [fraction for each dihedral, fraction of samples in which all dihedrals are in the same preferred conformation] as value
+        """
+        compliance = {}
+        for patch in self.angles:
+            angles = self.get_angles(patch)
+            if not len(angles):
+                continue
+            dihedrals = self.patches[patch]
+            n_conformations = min([len(d[1]) for d in dihedrals])
+            inside = np.zeros((len(angles), len(dihedrals), n_conformations), dtype = bool)
+            per_dihedral = np.zeros(len(dihedrals))
+            for j,(names,intervals) in enumerate(dihedrals):
+                intervals = np.sort(np.array(intervals), axis = 1)
+                a = angles[:, j, np.newaxis]
+                in_interval = (a >= intervals[:, 0]) & (a <= intervals[:, 1])
+                per_dihedral[j] = np.mean(np.any(in_interval, axis = 1))
+                inside[:, j, :] = in_interval[:, :n_conformations]
+            joint = np.mean(np.any(np.all(inside, axis = 1), axis = 1))
+            compliance[patch] = [per_dihedral, joint]
+        return compliance
+
 #####################################################################################
 #                                Drawer                                            #
 #####################################################################################
@@ -3725,18 +6182,18 @@ class Drawer():
             shape,color = self.Symbols[name]
             color = self.Colors[color]/255.
             if shape == 'circle':
-                patch = Circle(pos, self.side)
+                patch = mpatches.Circle(pos, self.side)
                 return patch,color
             if shape == 'square':
-                return Rectangle(pos-self.side, 2*self.side, 2*self.side),color
+                return mpatches.Rectangle(pos-self.side, 2*self.side, 2*self.side),color
             if shape == 'triangle':
-                return Polygon([(pos[0]-self.side, pos[1]), (pos[0]+self.side, pos[1]-self.side), (pos[0]+self.side, pos[1]+self.side)]),color
+                return mpatches.Polygon([(pos[0]-self.side, pos[1]), (pos[0]+self.side, pos[1]-self.side), (pos[0]+self.side, pos[1]+self.side)]),color
             if shape == 'rhombus':
                 if axis:
                     angle = 135 if direction == -1 else -45.
                 else:
                     angle = -135 if direction == -1 else 45.
-                return Rectangle(pos, 2*self.side, 2*self.side, angle=angle),color
+                return mpatches.Rectangle(pos, 2*self.side, 2*self.side, angle=angle),color
 
     def draw_protein_fragment(self, pos = [0., 0.], length = 10, protein_color = [.7, .7, .7], sequon_color = [.5, .5, .5], ax = None, axis = 0):
         """
@@ -3756,7 +6213,7 @@ class Drawer():
         p_fragment = np.array([0., 0.])
         p_fragment[axis] = -shape[axis]/2
         p_fragment[np.mod(axis+1, 2)] = -(self.side * 3.5) 
-        protein = Rectangle(p_fragment - self.side, shape[0], shape[1])
+        protein = mpatches.Rectangle(p_fragment - self.side, shape[0], shape[1])
         patches = []
         colors = []
         patches.append(protein)
@@ -3764,10 +6221,10 @@ class Drawer():
         new_pos = np.array([0., 0.])
         new_pos[axis] = pos[axis] 
         new_pos[np.mod(axis+1, 2)] = pos[np.mod(axis+1, 2)] -(self.side * 3.5) 
-        patches.append(Rectangle(new_pos - self.side, 2*self.side, 2*self.side)) 
+        patches.append(mpatches.Rectangle(new_pos - self.side, 2*self.side, 2*self.side)) 
         colors.append(sequon_color)
 
-        p = PatchCollection(patches, zorder = 3) 
+        p = mcollections.PatchCollection(patches, zorder = 3) 
         p.set_edgecolors([.2, .2, .2])
         p.set_linewidth(2)
         p.set_facecolors(colors)
@@ -3796,7 +6253,7 @@ class Drawer():
         shape = [0, 0]
         shape[axis] = length/self.scaling
         shape[np.mod(axis+1, 2)] = 2*self.side
-        protein = Rectangle(np.array(pos) - self.side, shape[0], shape[1])
+        protein = mpatches.Rectangle(np.array(pos) - self.side, shape[0], shape[1])
         patches = []
         colors = []
         patches.append(protein)
@@ -3816,7 +6273,7 @@ class Drawer():
             new_pos = np.array([0., 0.])
             new_pos[axis] = pos[axis] + r
             new_pos[np.mod(axis+1, 2)] = pos[np.mod(axis+1, 2)] 
-            patches.append(Rectangle(new_pos - self.side, 2*self.side, 2*self.side)) 
+            patches.append(mpatches.Rectangle(new_pos - self.side, 2*self.side, 2*self.side)) 
             colors.append(color)
 
             new_pos[np.mod(axis+1, 2)] = direction * (self.side * 3.5) 
@@ -3841,7 +6298,7 @@ class Drawer():
                 self.draw_tree(tree, root, names, r_pos, direction = direction, ax= ax, axis=axis)
 
 
-        p = PatchCollection(patches, zorder = 3) 
+        p = mcollections.PatchCollection(patches, zorder = 3) 
         p.set_edgecolors([.2, .2, .2])
         p.set_linewidth(2)
         p.set_facecolors(colors)
@@ -3912,7 +6369,7 @@ class Drawer():
             patch,color = self.get_shape(names[node], pos[node], direction, axis)
             patches.append(patch)
             colors.append(color)
-        p = PatchCollection(patches, zorder = 3) 
+        p = mcollections.PatchCollection(patches, zorder = 3) 
         p.set_edgecolors([.2, .2, .2])
         p.set_linewidth(2)
         p.set_facecolors(colors)
@@ -632,36 +632,18 @@ class GlycosylatorGUI(tk.Tk):
             self.display_db(self.frame_userg, self.user_glycans, self.user_images, self.user_canvas)
 
     def import_glycans(self, filename):
-        """Import connectivity topology from sql database
+        """Import connectivity topology from sql database (see glycosylator.GlycanLibrary)
         This function will initialize connect_topology
         Parameters:
             filename: path to database
         """
         try:
-            conn = sqlite3.connect(filename)
-        except:
+            library = glc.GlycanLibrary(filename, readonly = True)
+        except sqlite3.Error:
             print "Error while connecting to the database " + filename
             return -1
-        cursor =  conn.cursor()
-        cursor.execute("SELECT * FROM glycans")
-        glycans = cursor.fetchall()
-
-        connect_topology = {}
-        for glycan in glycans:
-            name,tree =  glycan
-            residue = {}
-            residue['UNIT'] = []
-            nbr_unit = 0
-            for unit in tree.split('|'):
-                unit = unit.split(' ')
-                nbr_unit += 1
-                if len(unit) > 2:
-                    residue['UNIT'].append([unit[0],unit[1], unit[2:]])
-                else:
-                    residue['UNIT'].append([unit[0], ' ', []])
-                
-            residue['#UNIT'] = nbr_unit
-            connect_topology[name] = residue
+        connect_topology = dict(library.items())
+        library.close()
         return connect_topology 
     
     def export_library(self):
@@ -672,35 +654,15 @@ class GlycosylatorGUI(tk.Tk):
     
     def export_glycans(self, filename, connect_topology):
         """Export connectivity topology to sql database
-        This function will export a SQL database with all the user glycans.
+        This function will export a SQL database with all the user glycans. Glycans already in the database are removed.
         """
         try:
-            conn = sqlite3.connect(filename)
-        except:
+            library = glc.GlycanLibrary(filename)
+        except sqlite3.Error:
             print "Error while connecting to the database " + filename
             return -1
-        cursor =  conn.cursor()
-        tn = 'glycans'
-        gn = 'glycan_name'
-        
-        self.selected_glycan[1] = 'glycan_tree'
-        cursor.execute("DROP TABLE IF EXISTS {tn}".format(tn = tn))
-        cursor.execute("CREATE TABLE {tn} ({gn} text, {gt} text)".format(tn =  tn, gn = gn, gt = gt))
-
-        for key in connect_topology.keys():
-            units = connect_topology[key]['UNIT']
-            glycan = []
-            for unit in units:
-                v = []
-                v.extend(unit[0:2])
-                v.extend(unit[2])
-                glycan.append(' '.join(v))
-            glycan = '|'.join(glycan)
-            
-            cursor.execute("INSERT INTO {tn} VALUES (\'{gn}\', \'{gt}\')".format(tn = tn, gn = key, gt = glycan))
-
-        conn.commit()
-        conn.close()
+        library.replace(connect_topology.items())
+        library.close()
 
     def add_glycan_form(self):
         """Adds a glycan to a library. 
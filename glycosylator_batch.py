@@ -0,0 +1,262 @@
+#! /usr/bin/env python
+'''
+----------------------------------------------------------------------------
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+2016 Thomas Lemmin
+----------------------------------------------------------------------------
+
+Batch glycosylation of several structures. The force field is loaded once and
+each structure is processed in a worker process: load, detect sequons,
+glycosylate, sample and write.
+
+The manifest is a JSON file:
+{
+    "topology": ["support/topology/DUMMY.top"],
+    "connectivity": ["support/topology/mannose.top"],
+    "sampling": {"n_iter": 10, "n_individues": 5, "n_generation": 10, "pop_size": 30},
+    "structures": [
+        {"name": "5fyl", "input": "5fyl.pdb", "output": "5fyl_glycosylated.pdb",
+         "glycosylation": {"88": "MAN9_3;4,2", ",G,133,": "MAN9_3;4,2"}}
+    ]
+}
+Keys of a glycosylation map are sequon ids (segname,chain,resid,icode), residue
+numbers of sequons or '*' for all sequons. Relative paths are relative to the manifest,
+except outputs when --output-dir is given.
+"sampling" can be set for each structure and is disabled with false.
+
+Results are appended to a report (JSON lines) with the timing of each stage and
+the peak memory (memory_MB). With --nprocs > 1 each structure runs in its own worker
+process and the peak memory is that of the structure; with --nprocs 1 it is the peak
+of the whole batch so far (process_peak_memory_MB). Structures that are already
+reported as done are skipped, so a batch can be restarted after failures.
+'''
+
+import os, sys, argparse
+import json
+import time
+import resource
+import traceback
+import multiprocessing
+import glycosylator as gl
+from prody import confProDy
+
+#Glycosylator and manifest shared with the worker processes
+BATCH_GLYCOSYLATOR = None
+BATCH_SETTINGS = {}
+
+def get_path(path, root):
+    """Returns path relative to root (directory of manifest) if path is not absolute
+    """
+    if os.path.isabs(path):
+        return path
+    return os.path.join(root, path)
+
+def to_str(data):
+    """Converts the unicode strings of a JSON object to str
+    """
+    if isinstance(data, unicode):
+        return str(data)
+    if isinstance(data, list):
+        return [to_str(d) for d in data]
+    if isinstance(data, dict):
+        return dict([(to_str(k), to_str(v)) for k,v in data.items()])
+    return data
+
+def read_manifest(fname, output_dir = None):
+    """Reads the manifest and sets the default values of each structure
+    Parameters:
+        fname: path to manifest
+        output_dir: directory of the output structures. Default relative to manifest
+    Returns:
+        manifest: dictionary
+    """
+    with open(fname) as f:
+        manifest = to_str(json.load(f))
+    root = os.path.dirname(os.path.abspath(fname))
+    manifest.setdefault('topofile', os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.rtf'))
+    manifest.setdefault('paramfile', os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.prm'))
+    manifest.setdefault('topology', [os.path.join(gl.GLYCOSYLATOR_PATH, 'support/topology/DUMMY.top')])
+    manifest.setdefault('connectivity', [os.path.join(gl.GLYCOSYLATOR_PATH, 'support/topology/mannose.top')])
+    manifest.setdefault('link_patch', 'NGLB')
+    manifest.setdefault('sampling', {})
+    for key in ['topofile', 'paramfile']:
+        manifest[key] = get_path(manifest[key], root)
+    for key in ['topology', 'connectivity']:
+        manifest[key] = [get_path(f, root) for f in manifest[key]]
+    for structure in manifest['structures']:
+        structure['input'] = get_path(structure['input'], root)
+        structure.setdefault('name', os.path.splitext(os.path.basename(structure['input']))[0])
+        structure.setdefault('output', structure['name'] + '_glycosylated.pdb')
+        if output_dir:
+            structure['output'] = os.path.join(output_dir, structure['output'])
+        else:
+            structure['output'] = get_path(structure['output'], root)
+        structure.setdefault('sampling', manifest['sampling'])
+    return manifest
+
+def read_report(fname):
+    """Returns the names of the structures reported as done
+    """
+    done = set()
+    if not os.path.exists(fname):
+        return done
+    with open(fname) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get('status') == 'done':
+                done.add(entry['name'])
+    return done
+
+def get_glycosylation(myGlycosylator, glycosylation):
+    """Converts a glycosylation map to sequon ids
+    Parameters:
+        myGlycosylator: Glycosylator with loaded glycoprotein
+        glycosylation: dictionary with sequon ids, residue numbers or '*' as keys and glycan names as values
+    Returns:
+        dictionary with sequon ids as keys and glycan names as values
+    """
+    sequons = {}
+    for key,glycan_name in glycosylation.items():
+        if key == '*':
+            selected = myGlycosylator.sequons.keys()
+        elif ',' in key:
+            selected = [key]
+        else:
+            selected = [s for s in myGlycosylator.sequons if s.split(',')[2] == key]
+        if not selected:
+            print 'WARNING: no sequon found for', key
+        for sequon_id in selected:
+            #explicit sequon ids take precedence over '*'
+            if key == '*' and sequon_id in sequons:
+                continue
+            sequons[sequon_id] = glycan_name
+    return sequons
+
+def get_memory():
+    """Returns the peak memory (MB) of the process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def glycosylate_structure(structure):
+    """Loads a structure, glycosylates its sequons, removes clashes and writes the glycoprotein
+    Parameters:
+        structure: entry of the manifest
+    Returns:
+        report: dictionary with status, timing and peak memory
+    """
+    myGlycosylator = BATCH_GLYCOSYLATOR
+    report = {'name': structure['name'], 'input': structure['input'], 'output': structure['output'], 'timing': {}}
+    timing = report['timing']
+    t0 = time.time()
+    try:
+        t = time.time()
+        myGlycosylator.load_glycoprotein(structure['input'])
+        myGlycosylator.build_glycan_topology(patch = BATCH_SETTINGS['link_patch'])
+        timing['load'] = time.time() - t
+        report['sequons'] = len(myGlycosylator.sequons)
+
+        glycosylation = get_glycosylation(myGlycosylator, structure.get('glycosylation', {}))
+        glycanMolecules,t = myGlycosylator.glycosylate_all(glycosylation, link_patch = BATCH_SETTINGS['link_patch'])
+        timing['glycosylate'] = t
+        report['glycans'] = len(glycanMolecules)
+        myGlycosylator.glycanMolecules.update(glycanMolecules)
+        for k,g in glycanMolecules.items():
+            myGlycosylator.glycans[k] = [g.rootRes, g.interresidue_connectivity]
+            myGlycosylator.names.update(g.get_names())
+
+        sampling = structure['sampling']
+        if sampling is not False and myGlycosylator.glycanMolecules:
+            t = time.time()
+            parameters = myGlycosylator.builder.Parameters.parameters
+            mySampler = gl.Sampler(myGlycosylator.glycanMolecules.values(), myGlycosylator.protein, parameters['DIHEDRALS'], parameters['NONBONDED'], clash_dist = sampling.get('clash_dist', 1.8))
+            mySampler.remove_clashes_GA_iterative(n_iter = sampling.get('n_iter', 10), n_individues = sampling.get('n_individues', 5), n_generation = sampling.get('n_generation', 10),
+                                                  pop_size = sampling.get('pop_size', 30), mutation_rate = sampling.get('mutation_rate', 0.01))
+            timing['sample'] = time.time() - t
+            report['clashes'] = float(sum(mySampler.nbr_clashes))
+
+        t = time.time()
+        myGlycosylator.write_glycoprotein(structure['output'])
+        timing['write'] = time.time() - t
+        report['status'] = 'done'
+    except Exception:
+        report['status'] = 'failed'
+        report['error'] = traceback.format_exc()
+    timing['total'] = time.time() - t0
+    report[BATCH_SETTINGS['memory_key']] = get_memory()
+    return report
+
+def main(args):
+    global BATCH_GLYCOSYLATOR, BATCH_SETTINGS
+    confProDy(verbosity = 'none')
+    manifest = read_manifest(args.manifest, args.output_dir)
+    report_file = args.report or os.path.splitext(args.manifest)[0] + '_report.json'
+    if args.output_dir:
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+
+    done = set()
+    if not args.restart:
+        done = read_report(report_file)
+    structures = [s for s in manifest['structures'] if not (s['name'] in done and os.path.exists(s['output']))]
+    print 'Structures: %d (%d already done)' % (len(manifest['structures']), len(manifest['structures']) - len(structures))
+    if not structures:
+        return 0
+
+    #force field is loaded once and inherited by the worker processes
+    t = time.time()
+    BATCH_GLYCOSYLATOR = gl.Glycosylator(manifest['topofile'], manifest['paramfile'])
+    for f in manifest['topology']:
+        BATCH_GLYCOSYLATOR.builder.Topology.read_topology(f)
+    for f in manifest['connectivity']:
+        BATCH_GLYCOSYLATOR.read_connectivity_topology(f)
+    #serial structures share one process, whose peak memory includes the previous structures
+    BATCH_SETTINGS = {'link_patch': manifest['link_patch'], 'memory_key': 'memory_MB' if args.nprocs > 1 else 'process_peak_memory_MB'}
+    print 'Force field loaded in %.2fs' % (time.time() - t)
+
+    if args.nprocs > 1:
+        pool = multiprocessing.Pool(args.nprocs, maxtasksperchild = 1)
+        results = pool.imap_unordered(glycosylate_structure, structures)
+    else:
+        pool = None
+        results = (glycosylate_structure(s) for s in structures)
+
+    failed = 0
+    with open(report_file, 'a') as f:
+        for report in results:
+            f.write(json.dumps(report) + '\n')
+            f.flush()
+            print '%s: %s (%.1fs, %s %.0f MB)' % (report['name'], report['status'], report['timing']['total'], BATCH_SETTINGS['memory_key'], report[BATCH_SETTINGS['memory_key']])
+            if report['status'] != 'done':
+                failed += 1
+                print report['error']
+    if pool:
+        pool.close()
+        pool.join()
+    print 'Report written to', report_file
+    return failed
+
+if __name__ == '__main__':
+    par = argparse.ArgumentParser(description = 'Glycosylates all the structures of a manifest')
+    par.add_argument('manifest', help = 'JSON manifest with structures and glycosylation maps')
+    par.add_argument('--nprocs', type = int, default = 1, help = 'number of worker processes')
+    par.add_argument('--output-dir', default = None, help = 'directory for output structures')
+    par.add_argument('--report', default = None, help = 'report file (JSON lines). Default <manifest>_report.json')
+    par.add_argument('--restart', action = 'store_true', help = 'process all structures, even those reported as done')
+    args = par.parse_args()
+    sys.exit(main(args))
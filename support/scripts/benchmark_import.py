@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Measures the time needed to import glycosylator in a fresh interpreter (e.g. the startup of a batch worker).
+Each import runs in a new process. The import time of each dependency is measured the same way,
+and modules that should only be loaded on first use (matplotlib) are reported if they are imported.
+
+Usage: python benchmark_import.py [--n 10] [--max-time 1.5]
+"""
+
+import os, sys, argparse
+import subprocess
+import json
+
+GLYCOSYLATOR_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+DEPENDENCIES = ['numpy', 'networkx', 'prody', 'scipy.spatial', 'scipy.interpolate', 'sqlite3', 'matplotlib.pyplot']
+#modules that glycosylator imports lazily
+LAZY_MODULES = ['matplotlib', 'matplotlib.pyplot']
+
+MEASURE = """
+import sys, time, json
+sys.path.insert(0, %r)
+t = time.time()
+import %s
+t = time.time() - t
+print json.dumps({'time': t, 'modules': [m for m in %r if m in sys.modules]})
+"""
+
+def measure_import(module, n):
+    """Imports a module in n new processes
+    Parameters:
+        module: name of module
+        n: number of repetitions
+    Returns:
+        times: list of import times (s)
+        modules: lazy modules that were loaded by the import
+    """
+    times = []
+    modules = set()
+    for i in range(n):
+        output = subprocess.check_output([sys.executable, '-c', MEASURE % (GLYCOSYLATOR_PATH, module, LAZY_MODULES)])
+        result = json.loads(output.strip().split('\n')[-1])
+        times.append(result['time'])
+        modules.update(result['modules'])
+    return times,sorted(modules)
+
+def main():
+    par = argparse.ArgumentParser(description = 'Measures the import time of glycosylator')
+    par.add_argument('--n', type = int, default = 10, help = 'number of repetitions')
+    par.add_argument('--max-time', type = float, default = None, help = 'fails (exit code 1) if the median import time of glycosylator is larger (s)')
+    par.add_argument('--dependencies', action = 'store_true', help = 'also measure the import time of each dependency')
+    args = par.parse_args()
+
+    modules = ['glycosylator']
+    if args.dependencies:
+        modules += DEPENDENCIES
+    status = 0
+    for module in modules:
+        times,loaded = measure_import(module, args.n)
+        print '%-20s median %.3fs  min %.3fs  max %.3fs' % (module, sorted(times)[len(times)/2], min(times), max(times))
+        if module == 'glycosylator':
+            median = sorted(times)[len(times)/2]
+            if loaded:
+                print 'WARNING: glycosylator imports ' + ', '.join(loaded)
+                status = 1
+            if args.max_time is not None and median > args.max_time:
+                print 'WARNING: import time larger than %.3fs' % args.max_time
+                status = 1
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Searches in glycan libraries imported from a SQLite database, eagerly or lazily
+
+Usage: python -m unittest discover tests
+"""
+
+import os, sys
+import hashlib
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import glycosylator as gl
+from prody import confProDy
+
+class TestLazyGlycanLibrary(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        confProDy(verbosity = 'none')
+        cls.database = os.path.join(gl.GLYCOSYLATOR_PATH, 'support/topology/mannose.db')
+        with open(cls.database, 'rb') as f:
+            cls.digest = hashlib.sha1(f.read()).hexdigest()
+        cls.glycosylator = gl.Glycosylator(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.rtf'), os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.prm'))
+        cls.glycosylator.import_connectivity_topology(cls.database)
+        cls.glycosylator.load_glycoprotein(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/examples/env_4tvp.pdb'))
+
+    def get_lazy_glycosylator(self):
+        lazy = gl.Glycosylator(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.rtf'), os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.prm'))
+        lazy.import_connectivity_topology(self.database, lazy = True)
+        return lazy
+
+    def test_import_is_readonly(self):
+        self.get_lazy_glycosylator()
+        with open(self.database, 'rb') as f:
+            self.assertEqual(hashlib.sha1(f.read()).hexdigest(), self.digest)
+
+    def test_supersets(self):
+        lazy = self.get_lazy_glycosylator()
+        for molecule in self.glycosylator.glycanMolecules.values():
+            self.assertEqual(lazy.find_glycan_supersets(molecule), self.glycosylator.find_glycan_supersets(molecule))
+
+    def test_nearest(self):
+        lazy = self.get_lazy_glycosylator()
+        for molecule in self.glycosylator.glycanMolecules.values():
+            self.assertEqual(lazy.find_nearest_glycans(molecule, 5), self.glycosylator.find_nearest_glycans(molecule, 5))
+
+    def test_identify_after_search(self):
+        lazy = self.get_lazy_glycosylator()
+        molecule = self.glycosylator.glycanMolecules.values()[0]
+        lazy.find_nearest_glycans(molecule)
+        self.assertEqual(lazy.identify_glycan(molecule), self.glycosylator.identify_glycan(molecule))
+
+if __name__ == '__main__':
+    unittest.main()
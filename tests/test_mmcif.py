@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Reading and writing mmCIF files
+
+Usage: python -m unittest discover tests
+"""
+
+import os, sys
+import shutil
+import tempfile
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import glycosylator as gl
+
+ATOM_SITE = """data_test
+loop_
+_atom_site.group_PDB
+_atom_site.id
+_atom_site.type_symbol
+_atom_site.label_atom_id
+_atom_site.label_comp_id
+_atom_site.label_asym_id
+_atom_site.label_seq_id
+_atom_site.auth_seq_id
+_atom_site.Cartn_x
+_atom_site.Cartn_y
+_atom_site.Cartn_z
+HETATM 1 C C1' NAG A . 1 0.0 0.0 0.0
+HETATM 2 O "O5'" NAG A . 1 1.4 0.0 0.0
+HETATM 3 C 'C2' NAG A . 1 0.0 1.4 0.0
+ATOM 4 N N ALA B 7 ? 3.0 0.0 0.0
+#
+"""
+
+class TestReadMMCIF(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.cif')
+        with open(self.filename, 'w') as f:
+            f.write(ATOM_SITE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_quotes(self):
+        atom_group = gl.read_mmcif(self.filename)
+        self.assertEqual(list(atom_group.getNames()), ["C1'", "O5'", 'C2', 'N'])
+
+    def test_missing_auth_seq_id(self):
+        atom_group = gl.read_mmcif(self.filename)
+        self.assertEqual(list(atom_group.getResnums()), [1, 1, 1, 7])
+
+    def test_write_read(self):
+        atom_group = gl.read_mmcif(self.filename)
+        filename = os.path.join(self.directory, 'written.cif')
+        writer = gl.StructureWriter(filename)
+        writer.write(atom_group)
+        writer.close()
+        self.assertEqual(list(gl.read_mmcif(filename).getNames()), list(atom_group.getNames()))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Sampler and SamplerPSO with molecules without torsionals (e.g. crystal glycans without hydrogens)
+
+Usage: python -m unittest discover tests
+"""
+
+import os, sys
+import unittest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import glycosylator as gl
+from prody import confProDy
+
+class TestSamplerWithoutTorsionals(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        confProDy(verbosity = 'none')
+        cls.glycosylator = gl.Glycosylator(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.rtf'), os.path.join(gl.GLYCOSYLATOR_PATH, 'support/toppar_charmm/carbohydrates.prm'))
+        cls.glycosylator.builder.Topology.read_topology(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/topology/DUMMY.top'))
+        cls.glycosylator.read_connectivity_topology(os.path.join(gl.GLYCOSYLATOR_PATH, 'support/topology/mannose.top'))
+        parameters = cls.glycosylator.builder.Parameters.parameters
+        cls.dihe_parameters = parameters['DIHEDRALS']
+        cls.vdw_parameters = parameters['NONBONDED']
+
+    def get_molecule(self):
+        """Returns a single NAG, which has no torsionals without hydrogens
+        """
+        nag, bonds = self.glycosylator.glycosylate('NAG1_0;0,0')
+        molecule = gl.Molecule('nag')
+        molecule.set_AtomGroup(nag, bonds = bonds, update_bonds = False)
+        molecule.update_connectivity(update_bonds = False)
+        molecule.set_atom_type(self.glycosylator.assign_atom_type(molecule))
+        molecule.define_torsionals(hydrogens = False)
+        molecule.torsionals = []
+        return molecule
+
+    def test_parameter_search_empty(self):
+        tables = gl.CHARMMParameterTables({'DIHEDRALS': self.dihe_parameters, 'NONBONDED': self.vdw_parameters})
+        self.assertEqual(len(tables.get_dihedral_rows([])), 0)
+
+    def test_sampler(self):
+        molecule = self.get_molecule()
+        sampler = gl.Sampler([molecule], None, self.dihe_parameters, self.vdw_parameters)
+        self.assertEqual(sampler.energy_lookup, [[]])
+
+    def test_sampler_pso(self):
+        molecule = self.get_molecule()
+        sampler = gl.SamplerPSO([molecule], None, self.dihe_parameters, self.vdw_parameters)
+        self.assertEqual(sampler.energy_lookup, [[]])
+
+if __name__ == '__main__':
+    unittest.main()